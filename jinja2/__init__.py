@@ -39,7 +39,7 @@ from jinja2.loaders import BaseLoader, FileSystemLoader, PackageLoader, \
 
 # bytecode caches
 from jinja2.bccache import BytecodeCache, FileSystemBytecodeCache, \
-     MemcachedBytecodeCache
+     MemcachedBytecodeCache, PackedBytecodeCache, SharedMemoryBytecodeCache
 
 # undefined types
 from jinja2.runtime import Undefined, DebugUndefined, StrictUndefined, \
@@ -67,7 +67,7 @@ __all__ = [
     'ModuleLoader', 'environmentfilter', 'contextfilter', 'Markup', 'escape',
     'environmentfunction', 'contextfunction', 'clear_caches', 'is_undefined',
     'evalcontextfilter', 'evalcontextfunction', 'make_logging_undefined',
-    'select_autoescape',
+    'select_autoescape', 'PackedBytecodeCache', 'SharedMemoryBytecodeCache',
 ]
 
 
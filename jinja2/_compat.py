@@ -97,3 +97,109 @@ try:
     from urllib.parse import quote_from_bytes as url_quote
 except ImportError:
     from urllib import quote as url_quote
+
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6 has no ordered dict.  This is a stripped down version of
+    # the one in the standard library of Python 2.7 that implements what the
+    # caches need.  The keys are kept in a doubly linked list of
+    # ``[prev, next, key]`` lists so all operations are constant time.
+    class OrderedDict(dict):
+
+        def __init__(self, items=()):
+            dict.__init__(self)
+            self.__root = root = []
+            root[:] = [root, root, None]
+            self.__links = {}
+            self.update(items)
+
+        def __setitem__(self, key, value):
+            if key not in self:
+                root = self.__root
+                last = root[0]
+                last[1] = root[0] = self.__links[key] = [last, root, key]
+            dict.__setitem__(self, key, value)
+
+        def __delitem__(self, key):
+            dict.__delitem__(self, key)
+            prev, succ, key = self.__links.pop(key)
+            prev[1] = succ
+            succ[0] = prev
+
+        def __iter__(self):
+            root = self.__root
+            link = root[1]
+            while link is not root:
+                yield link[2]
+                link = link[1]
+
+        def __reversed__(self):
+            root = self.__root
+            link = root[0]
+            while link is not root:
+                yield link[2]
+                link = link[0]
+
+        def clear(self):
+            root = self.__root
+            root[:] = [root, root, None]
+            self.__links.clear()
+            dict.clear(self)
+
+        def update(self, items=()):
+            if hasattr(items, 'keys'):
+                items = [(key, items[key]) for key in items.keys()]
+            for key, value in items:
+                self[key] = value
+
+        def pop(self, key, *default):
+            if key in self:
+                value = dict.__getitem__(self, key)
+                del self[key]
+                return value
+            if default:
+                return default[0]
+            raise KeyError(key)
+
+        def popitem(self, last=True):
+            if not self:
+                raise KeyError('dictionary is empty')
+            if last:
+                key = next(reversed(self))
+            else:
+                key = next(iter(self))
+            return key, self.pop(key)
+
+        def setdefault(self, key, default=None):
+            if key in self:
+                return dict.__getitem__(self, key)
+            self[key] = default
+            return default
+
+        def keys(self):
+            return list(self)
+
+        def values(self):
+            return [dict.__getitem__(self, key) for key in self]
+
+        def items(self):
+            return [(key, dict.__getitem__(self, key)) for key in self]
+
+        iterkeys = __iter__
+
+        def itervalues(self):
+            return iter(self.values())
+
+        def iteritems(self):
+            return iter(self.items())
+
+        def copy(self):
+            return self.__class__(self.items())
+
+        def __reduce__(self):
+            return self.__class__, (self.items(),)
+
+        def __repr__(self):
+            return '%s(%r)' % (self.__class__.__name__, self.items())
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja2.asyncbccache
+    ~~~~~~~~~~~~~~~~~~~
+
+    Bytecode caches for asyncio based key value stores.  This module is
+    only available on Python versions with async generator support.
+
+    :copyright: (c) 2017 by the Jinja Team.
+    :license: BSD, see LICENSE for more details.
+"""
+import asyncio
+
+from jinja2.bccache import BytecodeCache
+
+
+class AsyncKeyValueBytecodeCache(BytecodeCache):
+    """Works like the :class:`~jinja2.MemcachedBytecodeCache` but for
+    clients of key value stores with an asyncio interface.  Templates loaded
+    with :meth:`Environment.get_template_async`, which includes templates
+    extended, included or imported by templates rendered in async mode,
+    load and store their bytecode without blocking the event loop.
+
+    The minimal interface for the client passed to the constructor is this:
+
+    .. class:: MinimalAsyncClientInterface
+
+        .. method:: set(key, value[, timeout])
+
+            A coroutine that stores the bytecode in the cache.  `value` is a
+            bytestring and `timeout` the timeout of the key in seconds if
+            provided.
+
+        .. method:: get(key)
+
+            A coroutine that returns the value for the cache key or `None`
+            if the item does not exist in the cache.
+
+    If the client also provides a ``delete(key)`` coroutine it's used to
+    remove the bytecode of invalidated templates.
+
+    When templates are loaded synchronously outside of a running event loop
+    the client is called through the event loop.  Inside a running event
+    loop the cache can't be waited for, so loading skips the cache and
+    writes and deletions are scheduled as tasks.
+
+    This bytecode cache does not support clearing of used items in the cache.
+    The clear method is a no-operation function.
+
+    .. versionadded:: 2.10
+    """
+
+    def __init__(self, client, prefix='jinja2/bytecode/', timeout=None,
+                 ignore_errors=True):
+        self.client = client
+        self.prefix = prefix
+        self.timeout = timeout
+        self.ignore_errors = ignore_errors
+
+    async def load_bytecode_async(self, bucket):
+        try:
+            code = await self.client.get(self.prefix + bucket.key)
+        except Exception:
+            if not self.ignore_errors:
+                raise
+            code = None
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    async def dump_bytecode_async(self, bucket):
+        args = (self.prefix + bucket.key, bucket.bytecode_to_string())
+        if self.timeout is not None:
+            args += (self.timeout,)
+        try:
+            await self.client.set(*args)
+        except Exception:
+            if not self.ignore_errors:
+                raise
+
+    async def delete_bytecode_async(self, bucket):
+        delete = getattr(self.client, 'delete', None)
+        if delete is None:
+            return
+        try:
+            await delete(self.prefix + bucket.key)
+        except Exception:
+            if not self.ignore_errors:
+                raise
+
+    def _run(self, coro, wait):
+        loop = asyncio.get_event_loop()
+        if not loop.is_running():
+            return loop.run_until_complete(coro)
+        if wait:
+            coro.close()
+        else:
+            asyncio.ensure_future(coro, loop=loop)
+
+    def load_bytecode(self, bucket):
+        self._run(self.load_bytecode_async(bucket), True)
+
+    def dump_bytecode(self, bucket):
+        self._run(self.dump_bytecode_async(bucket), False)
+
+    def delete_bytecode(self, bucket):
+        self._run(self.delete_bytecode_async(bucket), False)
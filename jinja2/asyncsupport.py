@@ -15,7 +15,9 @@ import inspect
 from functools import update_wrapper
 
 from jinja2.utils import concat, internalcode, Markup
-from jinja2.environment import TemplateModule
+from jinja2.environment import Template, TemplateModule
+from jinja2.metrics import default_timer
+from jinja2.exceptions import TemplateNotFound, TemplatesNotFound
 from jinja2.runtime import LoopContextBase, _last_iteration
 
 
@@ -62,11 +64,20 @@ async def render_async(self, *args, **kwargs):
 
     vars = dict(*args, **kwargs)
     ctx = self.new_context(vars)
+    metrics = self.environment.metrics
+    if metrics is not None:
+        start = default_timer()
 
     try:
-        return await concat_async(self.root_render_func(ctx))
+        rv = await concat_async(self.root_render_func(ctx))
     except Exception:
         exc_info = sys.exc_info()
+    else:
+        if metrics is not None:
+            metrics.timing('render', default_timer() - start, self.name)
+        return rv
+    if metrics is not None:
+        metrics.increment('render.error', self.name)
     return self.environment.handle_exception(exc_info, True)
 
 
@@ -138,6 +149,185 @@ async def make_module_async(self, vars=None, shared=False, locals=None):
     return TemplateModule(self, context, body_stream)
 
 
+@internalcode
+async def get_template_async(self, name, parent=None, globals=None):
+    if isinstance(name, Template):
+        return name
+    if parent is not None:
+        name = self.join_path(name, parent)
+    return await self._load_template_async(name, self.make_globals(globals))
+
+
+@internalcode
+async def select_template_async(self, names, parent=None, globals=None):
+    if not names:
+        raise TemplatesNotFound(message=u'Tried to select from an empty list '
+                                        u'of templates.')
+    globals = self.make_globals(globals)
+    for name in names:
+        if isinstance(name, Template):
+            return name
+        if parent is not None:
+            name = self.join_path(name, parent)
+        try:
+            return await self._load_template_async(name, globals)
+        except TemplateNotFound:
+            pass
+    raise TemplatesNotFound(names)
+
+
+@internalcode
+async def get_or_select_template_async(self, template_name_or_list,
+                                       parent=None, globals=None):
+    if isinstance(template_name_or_list, str):
+        return await self.get_template_async(template_name_or_list, parent,
+                                             globals)
+    elif isinstance(template_name_or_list, Template):
+        return template_name_or_list
+    return await self.select_template_async(template_name_or_list, parent,
+                                            globals)
+
+
+@internalcode
+async def load_template_async(self, name, globals):
+    template = self._get_cached_template(name)
+    if template is None:
+        if self.metrics is not None:
+            self.metrics.increment('template_cache.miss', name)
+        template = self._get_shared_template(name, globals)
+        if template is None:
+            template = await self.loader.load_async(self, name, globals)
+        self._cache_template(name, template)
+    elif self.metrics is not None:
+        self.metrics.increment('template_cache.hit', name)
+    return template
+
+
+async def get_source_async(self, environment, template):
+    return self.get_source(environment, template)
+
+
+@internalcode
+async def load_async(self, environment, name, globals=None):
+    from jinja2.loaders import BaseLoader
+    if type(self).load is not BaseLoader.load:
+        return self.load(environment, name, globals)
+
+    code = None
+    if globals is None:
+        globals = {}
+    source, filename, uptodate = await self.get_source_async(environment,
+                                                             name)
+    bcc = environment.bytecode_cache
+    if bcc is not None:
+        bucket = await bcc.get_bucket_async(environment, name, filename,
+                                            source)
+        code = bucket.code
+        if environment.metrics is not None:
+            environment.metrics.increment(code is None and
+                                          'bytecode_cache.miss' or
+                                          'bytecode_cache.hit', name)
+    if code is None:
+        code = environment.compile(source, name, filename)
+    if bcc is not None and bucket.code is None:
+        bucket.code = code
+        await bcc.set_bucket_async(bucket)
+    return environment.template_class.from_code(environment, code,
+                                                globals, uptodate)
+
+
+async def prefix_get_source_async(self, environment, template):
+    loader, name = self.get_loader(template)
+    try:
+        return await loader.get_source_async(environment, name)
+    except TemplateNotFound:
+        raise TemplateNotFound(template)
+
+
+@internalcode
+async def prefix_load_async(self, environment, name, globals=None):
+    loader, local_name = self.get_loader(name)
+    try:
+        return await loader.load_async(environment, local_name, globals)
+    except TemplateNotFound:
+        raise TemplateNotFound(name)
+
+
+async def choice_get_source_async(self, environment, template):
+    for loader in self.loaders:
+        try:
+            return await loader.get_source_async(environment, template)
+        except TemplateNotFound:
+            pass
+    raise TemplateNotFound(template)
+
+
+@internalcode
+async def choice_load_async(self, environment, name, globals=None):
+    for loader in self.loaders:
+        try:
+            return await loader.load_async(environment, name, globals)
+        except TemplateNotFound:
+            pass
+    raise TemplateNotFound(name)
+
+
+async def load_bytecode_async(self, bucket):
+    self.load_bytecode(bucket)
+
+
+async def dump_bytecode_async(self, bucket):
+    self.dump_bytecode(bucket)
+
+
+async def get_bucket_async(self, environment, name, filename, source):
+    from jinja2.bccache import Bucket
+    bucket = Bucket(environment, self.get_cache_key(name, filename),
+                    self.get_source_checksum(source))
+    await self.load_bytecode_async(bucket)
+    return bucket
+
+
+async def set_bucket_async(self, bucket):
+    await self.dump_bytecode_async(bucket)
+
+
+def patch_environment():
+    from jinja2 import Environment
+    Environment.get_template_async = update_wrapper(
+        get_template_async, Environment.get_template_async)
+    Environment.select_template_async = update_wrapper(
+        select_template_async, Environment.select_template_async)
+    Environment.get_or_select_template_async = update_wrapper(
+        get_or_select_template_async,
+        Environment.get_or_select_template_async)
+    Environment._load_template_async = load_template_async
+
+
+def patch_loaders():
+    from jinja2.loaders import BaseLoader, PrefixLoader, ChoiceLoader
+    BaseLoader.get_source_async = update_wrapper(
+        get_source_async, BaseLoader.get_source_async)
+    BaseLoader.load_async = update_wrapper(
+        load_async, BaseLoader.load_async)
+    PrefixLoader.get_source_async = prefix_get_source_async
+    PrefixLoader.load_async = prefix_load_async
+    ChoiceLoader.get_source_async = choice_get_source_async
+    ChoiceLoader.load_async = choice_load_async
+
+
+def patch_bytecode_cache():
+    from jinja2.bccache import BytecodeCache
+    BytecodeCache.load_bytecode_async = update_wrapper(
+        load_bytecode_async, BytecodeCache.load_bytecode_async)
+    BytecodeCache.dump_bytecode_async = update_wrapper(
+        dump_bytecode_async, BytecodeCache.dump_bytecode_async)
+    BytecodeCache.get_bucket_async = update_wrapper(
+        get_bucket_async, BytecodeCache.get_bucket_async)
+    BytecodeCache.set_bucket_async = update_wrapper(
+        set_bucket_async, BytecodeCache.set_bucket_async)
+
+
 def patch_template():
     from jinja2 import Template
     Template.generate = wrap_generate_func(Template.generate)
@@ -167,6 +357,9 @@ def patch_filters():
 
 
 def patch_all():
+    patch_environment()
+    patch_loaders()
+    patch_bytecode_cache()
     patch_template()
     patch_runtime()
     patch_filters()
@@ -188,6 +381,7 @@ async def auto_aiter(iterable):
 
 
 class AsyncLoopContext(LoopContextBase):
+    __slots__ = ('_async_iterator', '_after', '_length')
 
     def __init__(self, async_iterator, after, length, recurse=None,
                  depth0=0):
@@ -19,12 +19,17 @@ import os
 import sys
 import stat
 import errno
+import mmap
+import struct
 import marshal
+import threading
 import tempfile
 import fnmatch
+import zlib
 from hashlib import sha1
 from jinja2.utils import open_if_exists
-from jinja2._compat import BytesIO, pickle, PY2, text_type
+from jinja2.exceptions import TemplateSyntaxError
+from jinja2._compat import BytesIO, pickle, PY2, text_type, iteritems
 
 
 # marshal works better on 3.x, one hack less required
@@ -45,7 +50,7 @@ else:
         return marshal.loads(f.read())
 
 
-bc_version = 3
+bc_version = 4
 
 # magic version used to only change with new jinja versions.  With 2.6
 # we change this to also take Python version changes into account.  The
@@ -56,6 +61,41 @@ bc_magic = 'j2'.encode('ascii') + \
     pickle.dumps(bc_version, 2) + \
     pickle.dumps((sys.version_info[0] << 24) | sys.version_info[1])
 
+# header of the file used by the packed bytecode cache followed by the
+# records.  Every record starts with the record magic, the length of the
+# key, the length of the checksum, the length of the marshalled code and
+# the CRC32 of the key, checksum and code.
+_pack_header = b'j2pack\x02' + bc_magic
+_record_header = struct.Struct('<4sHHII')
+_record_magic = b'j2rc'
+
+# os.replace is missing on Python 2, rename replaces files on POSIX as well
+_replace_file = getattr(os, 'replace', os.rename)
+
+try:
+    import fcntl
+except ImportError:
+    def _lock_file(fd):
+        pass
+    _unlock_file = _lock_file
+else:
+    def _lock_file(fd):
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+    def _unlock_file(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def _read_header(fd):
+    os.lseek(fd, 0, 0)
+    return os.read(fd, len(_pack_header))
+
+
+def _write_all(fd, data):
+    written = os.write(fd, data)
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
 
 class Bucket(object):
     """Buckets are used to store the bytecode for one template.  It's created
@@ -157,6 +197,15 @@ class BytecodeCache(object):
         """
         raise NotImplementedError()
 
+    def delete_bytecode(self, bucket):
+        """Subclasses can override this method to remove the bytecode of a
+        bucket from the cache.  It's called when the environment invalidates
+        a template.  Outdated bytecode is rejected by its checksum anyways,
+        so the default implementation does nothing.
+
+        .. versionadded:: 2.10
+        """
+
     def clear(self):
         """Clears the cache.  This method is not used by Jinja2 but should be
         implemented to allow applications to clear the bytecode cache used
@@ -191,6 +240,52 @@ class BytecodeCache(object):
         """Put the bucket into the cache."""
         self.dump_bytecode(bucket)
 
+    def remove_bucket(self, environment, name, filename):
+        """Remove the bucket for the given template from the cache."""
+        bucket = Bucket(environment, self.get_cache_key(name, filename), None)
+        self.delete_bytecode(bucket)
+
+    def load_bytecode_async(self, bucket):
+        """An async version of :meth:`load_bytecode` that is used when
+        templates are loaded with :meth:`Environment.get_template_async`.
+        Caches talking to a network service can override this together with
+        :meth:`dump_bytecode_async` so that they don't block the event loop.
+        The default implementation calls :meth:`load_bytecode`.
+
+        .. versionadded:: 2.10
+        """
+        # see asyncsupport for the actual implementation
+        raise NotImplementedError('This feature is not available for this '
+                                  'version of Python')
+
+    def dump_bytecode_async(self, bucket):
+        """An async version of :meth:`dump_bytecode`.  The default
+        implementation calls :meth:`dump_bytecode`.
+
+        .. versionadded:: 2.10
+        """
+        # see asyncsupport for the actual implementation
+        raise NotImplementedError('This feature is not available for this '
+                                  'version of Python')
+
+    def get_bucket_async(self, environment, name, filename, source):
+        """An async version of :meth:`get_bucket`.
+
+        .. versionadded:: 2.10
+        """
+        # see asyncsupport for the actual implementation
+        raise NotImplementedError('This feature is not available for this '
+                                  'version of Python')
+
+    def set_bucket_async(self, bucket):
+        """An async version of :meth:`set_bucket`.
+
+        .. versionadded:: 2.10
+        """
+        # see asyncsupport for the actual implementation
+        raise NotImplementedError('This feature is not available for this '
+                                  'version of Python')
+
 
 class FileSystemBytecodeCache(BytecodeCache):
     """A bytecode cache that stores bytecode on the filesystem.  It accepts
@@ -275,6 +370,12 @@ class FileSystemBytecodeCache(BytecodeCache):
         finally:
             f.close()
 
+    def delete_bytecode(self, bucket):
+        try:
+            os.remove(self._get_cache_filename(bucket))
+        except OSError:
+            pass
+
     def clear(self):
         # imported lazily here because google app-engine doesn't support
         # write access on the file system and the function does not exist
@@ -322,6 +423,9 @@ class MemcachedBytecodeCache(BytecodeCache):
             Returns the value for the cache key.  If the item does not
             exist in the cache the return value must be `None`.
 
+    If the client also provides a ``delete(key)`` method it's used to
+    remove the bytecode of invalidated templates.
+
     The other arguments to the constructor are the prefix for all keys that
     is added before the actual cache key and the timeout for the bytecode in
     the cache system.  We recommend a high (or no) timeout.
@@ -360,3 +464,414 @@ class MemcachedBytecodeCache(BytecodeCache):
         except Exception:
             if not self.ignore_memcache_errors:
                 raise
+
+    def delete_bytecode(self, bucket):
+        delete = getattr(self.client, 'delete', None)
+        if delete is None:
+            return
+        try:
+            delete(self.prefix + bucket.key)
+        except Exception:
+            if not self.ignore_memcache_errors:
+                raise
+
+
+class PackedBytecodeCache(BytecodeCache):
+    """A bytecode cache that stores the bytecode of all templates in a
+    single append-only file.  The file is memory mapped and the code is
+    unmarshalled straight from the mapping, so once the file is mapped
+    loading a template does not need any file system calls.  This works
+    well for forking servers where many worker processes start at once and
+    load the same set of templates.
+
+    New bytecode is appended to the end of the file under an exclusive lock
+    (on platforms with `fcntl`), so several processes can share one file.
+    Writing a bucket again leaves the outdated record behind.  Once the
+    outdated records take up more than `compact_ratio` of a file that is
+    bigger than `compact_size` bytes the file is compacted: the current
+    records are written to a new file that atomically replaces the old
+    one.  Other processes notice appended records and replaced files the
+    next time they miss a template.  Records that were not written
+    completely, for example because a process died while writing, are
+    skipped and removed by the next process that writes to the file.
+
+    >>> bcc = PackedBytecodeCache('/tmp/jinja_cache.pack')
+
+    This bytecode cache supports clearing of the cache using the clear method.
+
+    .. versionadded:: 2.10
+    """
+
+    def __init__(self, filename, compact_ratio=0.5,
+                 compact_size=1024 * 1024):
+        self.filename = filename
+        self.compact_ratio = compact_ratio
+        self.compact_size = compact_size
+        self._lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+        self._reset_state()
+
+    def _reset_state(self):
+        self._inode = None
+        self._map = None
+        self._view = None
+        self._mapped_size = 0
+        # key -> (checksum, code offset, code length, record start, end)
+        self._index = {}
+        self._scanned = len(_pack_header)
+        self._dead = 0
+
+    def _close(self):
+        if self._view is not None:
+            self._view.release()
+        if self._map is not None:
+            self._map.close()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._reset_state()
+
+    def _is_current(self, st):
+        """Checks if the file described by the stat result `st` is still
+        the cache file and was not replaced by another process.
+        """
+        try:
+            return os.stat(self.filename).st_ino == st.st_ino
+        except OSError:
+            return False
+
+    def _open(self):
+        """Opens the cache file and makes sure it starts with the header of
+        this version.  Files with another header (for example written by
+        another Python version) are replaced with an empty file.
+        """
+        while 1:
+            fd = os.open(self.filename, os.O_RDWR | os.O_CREAT | os.O_APPEND |
+                         getattr(os, 'O_BINARY', 0), 0o600)
+            usable = False
+            try:
+                _lock_file(fd)
+                try:
+                    st = os.fstat(fd)
+                    if self._is_current(st):
+                        if st.st_size == 0:
+                            _write_all(fd, _pack_header)
+                            usable = True
+                        elif _read_header(fd) != _pack_header:
+                            self._replace([])
+                        else:
+                            usable = True
+                finally:
+                    _unlock_file(fd)
+            finally:
+                if not usable:
+                    os.close(fd)
+            if usable:
+                self._fd = fd
+                self._pid = os.getpid()
+                self._inode = st.st_ino
+                return
+
+    def _check_process(self):
+        """Closes the file if it was opened before the process forked.
+        The file lock belongs to the open file, so processes that share it
+        would not exclude each other.
+        """
+        if self._fd is not None and self._pid != os.getpid():
+            self._close()
+
+    def _lock_current(self):
+        """Opens the cache file if necessary and locks it.  If another
+        process replaced the file in the meantime the new file is opened.
+        """
+        self._check_process()
+        while 1:
+            if self._fd is None:
+                self._open()
+            _lock_file(self._fd)
+            if self._is_current(os.fstat(self._fd)):
+                return
+            _unlock_file(self._fd)
+            self._close()
+
+    def _refresh(self):
+        """Maps records appended by other processes and reopens the file if
+        it was replaced.
+        """
+        self._check_process()
+        if self._fd is not None and \
+           not self._is_current(os.fstat(self._fd)):
+            self._close()
+        if self._fd is None:
+            self._open()
+        size = os.fstat(self._fd).st_size
+        if size > self._mapped_size:
+            if self._view is not None:
+                self._view.release()
+                self._view = None
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+            if not PY2:
+                self._view = memoryview(self._map)
+            self._mapped_size = size
+        self._scan()
+
+    def _scan(self):
+        buf = self._map
+        size = self._mapped_size
+        pos = self._scanned
+        while pos + _record_header.size <= size:
+            magic, key_len, checksum_len, code_len, crc = \
+                _record_header.unpack_from(buf, pos)
+            if magic != _record_magic:
+                # a broken record, nothing after it can be trusted.  The
+                # next process that writes to the file removes it.
+                break
+            start = pos + _record_header.size
+            code_offset = start + key_len + checksum_len
+            end = code_offset + code_len
+            if end > size:
+                # another process is still writing this record or died
+                # while writing it
+                break
+            if zlib.crc32(buf[start:end]) & 0xffffffff != crc:
+                # a torn record, skip it and let compaction remove it
+                self._dead += end - pos
+                pos = end
+                continue
+            key = buf[start:start + key_len].decode('ascii')
+            checksum = buf[start + key_len:code_offset]
+            old = self._index.get(key)
+            if old is not None:
+                self._dead += old[4] - old[3]
+            self._index[key] = (checksum, code_offset, code_len, pos, end)
+            pos = end
+        self._scanned = pos
+
+    def _load_code(self, offset, length):
+        if PY2:
+            return marshal.loads(self._map[offset:offset + length])
+        data = self._view[offset:offset + length]
+        try:
+            return marshal.loads(data)
+        finally:
+            data.release()
+
+    def load_bytecode(self, bucket):
+        checksum = bucket.checksum.encode('ascii')
+        self._lock.acquire()
+        try:
+            entry = self._index.get(bucket.key)
+            if entry is None or entry[0] != checksum:
+                self._refresh()
+                entry = self._index.get(bucket.key)
+                if entry is None or entry[0] != checksum:
+                    return
+            try:
+                bucket.code = self._load_code(entry[1], entry[2])
+            except (EOFError, ValueError, TypeError):
+                bucket.reset()
+        finally:
+            self._lock.release()
+
+    def dump_bytecode(self, bucket):
+        key = bucket.key.encode('ascii')
+        checksum = bucket.checksum.encode('ascii')
+        code = marshal.dumps(bucket.code)
+        data = key + checksum + code
+        record = _record_header.pack(_record_magic, len(key), len(checksum),
+                                     len(code),
+                                     zlib.crc32(data) & 0xffffffff) + data
+        self._lock.acquire()
+        try:
+            self._lock_current()
+            try:
+                self._refresh()
+                if self._scanned < self._mapped_size:
+                    # nobody else is writing, so the end of the file is a
+                    # broken record.  Nothing appended after it could be
+                    # found, the file has to be rewritten first.
+                    self._compact()
+                    self._lock_current()
+                    self._refresh()
+                _write_all(self._fd, record)
+                self._refresh()
+                if self._mapped_size > self.compact_size and \
+                   self._dead > self._mapped_size * self.compact_ratio:
+                    self._compact()
+            finally:
+                if self._fd is not None:
+                    _unlock_file(self._fd)
+        finally:
+            self._lock.release()
+
+    def delete_bytecode(self, bucket):
+        # a record can only be removed by rewriting the file.  The outdated
+        # record is rejected by its checksum anyways, so the next compaction
+        # takes care of it.
+        pass
+
+    def compact(self):
+        """Rewrites the cache file so that it only contains the current
+        record of every template.  This happens automatically once enough
+        outdated records piled up.
+        """
+        self._lock.acquire()
+        try:
+            self._lock_current()
+            try:
+                self._refresh()
+                self._compact()
+            finally:
+                if self._fd is not None:
+                    _unlock_file(self._fd)
+        finally:
+            self._lock.release()
+
+    def _compact(self):
+        # called with the file locked.  The old file is never truncated as
+        # other processes might still have it mapped.
+        records = [self._map[x[3]:x[4]] for x in
+                   sorted(self._index.values(), key=lambda x: x[3])]
+        self._replace(records)
+        _unlock_file(self._fd)
+        self._close()
+
+    def _replace(self, records):
+        fd, tmp = tempfile.mkstemp(prefix='.jinja2-pack-', dir=path.dirname(
+            path.abspath(self.filename)))
+        try:
+            try:
+                _write_all(fd, _pack_header)
+                for record in records:
+                    _write_all(fd, record)
+            finally:
+                os.close(fd)
+            _replace_file(tmp, self.filename)
+        except:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._lock_current()
+            self._replace([])
+            _unlock_file(self._fd)
+            self._close()
+        finally:
+            self._lock.release()
+
+
+class SharedMemoryBytecodeCache(BytecodeCache):
+    """A bytecode cache for pre-forking servers.  The master process fills
+    the cache with :meth:`preload` before forking the workers::
+
+        bcc = SharedMemoryBytecodeCache()
+        env = Environment(loader=FileSystemLoader('templates'),
+                          bytecode_cache=bcc)
+        bcc.preload(env)
+
+    The bytecode of all templates is stored in an anonymous shared memory
+    map that the workers inherit, so they neither recompile templates nor
+    touch the file system to load bytecode, and all workers use the same
+    physical memory for it.  The bytecode is stored in the format of
+    :meth:`Bucket.bytecode_to_string`, so outdated entries are rejected like
+    with any other cache.
+
+    Bytecode for templates that were not preloaded is loaded from and
+    written to the `fallback` bytecode cache if one is given.  Otherwise
+    workers compile such templates themselves.
+
+    This bytecode cache supports clearing of the cache using the clear method.
+
+    .. versionadded:: 2.10
+    """
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback
+        self._map = None
+        # key -> (offset, length) of the bytecode in the shared memory
+        self._index = {}
+
+    def preload(self, environment, names=None, extensions=None,
+                filter_func=None, ignore_errors=True):
+        """Compiles templates of `environment` and stores their bytecode in
+        shared memory.  Per default all templates the loader can list are
+        compiled, `extensions` and `filter_func` are passed to
+        :meth:`~Environment.list_templates`.  Alternatively a list of
+        template `names` can be provided.
+
+        Templates with syntax errors are skipped unless `ignore_errors` is
+        set to `False`.  Preloading again adds to the existing entries.  This
+        must happen before the workers are forked, the workers don't see
+        entries preloaded afterwards.  Returns the number of templates that
+        were preloaded.
+        """
+        if names is None:
+            names = environment.list_templates(extensions, filter_func)
+        entries = dict((key, self._get_data(key)) for key in self._index)
+        rv = 0
+        for name in names:
+            source, filename, _ = environment.loader.get_source(environment,
+                                                                name)
+            bucket = Bucket(environment, self.get_cache_key(name, filename),
+                            self.get_source_checksum(source))
+            try:
+                bucket.code = environment.compile(source, name, filename)
+            except TemplateSyntaxError:
+                if not ignore_errors:
+                    raise
+                continue
+            entries[bucket.key] = bucket.bytecode_to_string()
+            rv += 1
+        self._store(entries)
+        return rv
+
+    def _store(self, entries):
+        index = {}
+        offset = 0
+        for key, data in iteritems(entries):
+            index[key] = (offset, len(data))
+            offset += len(data)
+        shared = None
+        if offset:
+            shared = mmap.mmap(-1, offset)
+            for key, data in iteritems(entries):
+                start = index[key][0]
+                shared[start:start + len(data)] = data
+        if self._map is not None:
+            self._map.close()
+        self._map = shared
+        self._index = index
+
+    def _get_data(self, key):
+        offset, length = self._index[key]
+        return self._map[offset:offset + length]
+
+    def load_bytecode(self, bucket):
+        if bucket.key in self._index:
+            bucket.bytecode_from_string(self._get_data(bucket.key))
+        if bucket.code is None and self.fallback is not None:
+            self.fallback.load_bytecode(bucket)
+
+    def dump_bytecode(self, bucket):
+        if self.fallback is not None:
+            self.fallback.dump_bytecode(bucket)
+
+    def delete_bytecode(self, bucket):
+        # the entry stays in the shared memory but is no longer used by
+        # this process
+        self._index.pop(bucket.key, None)
+        if self.fallback is not None:
+            self.fallback.delete_bytecode(bucket)
+
+    def clear(self):
+        self._store({})
+        if self.fallback is not None:
+            self.fallback.clear()
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja2.cache
+    ~~~~~~~~~~~~
+
+    Eviction policies for the template cache of the environment.  Per
+    default the environment uses a :class:`~jinja2.utils.LRUCache` that
+    only counts templates.  The policies in this module can be passed as
+    `cache_size` to the environment instead if the number of templates is
+    not a good measurement for the cost of the cache.
+
+    :copyright: (c) 2017 by the Jinja Team.
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+from types import CodeType
+from threading import Lock
+from jinja2.utils import missing
+from jinja2._compat import string_types, OrderedDict
+
+
+def _code_weight(code):
+    rv = len(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            rv += _code_weight(const)
+        elif isinstance(const, string_types) or type(const) is bytes:
+            rv += len(const)
+    return rv
+
+
+def template_weight(template):
+    """The default weight function of the :class:`WeightedLRUCache`.  It
+    returns an estimate of the number of bytes the compiled code of the
+    template takes up.  As the static template data ends up as constants
+    in the code this also accounts for the size of the template source.
+    """
+    funcs = [template.root_render_func]
+    funcs.extend(template.blocks.values())
+    return sum(_code_weight(f.__code__) for f in funcs)
+
+
+class CachePolicy(object):
+    """Baseclass for the template cache policies.  A policy behaves like
+    a mapping of cache keys to templates and keeps track of the number of
+    cache hits, misses and evictions in the :attr:`hits`, :attr:`misses`
+    and :attr:`evictions` attributes.
+
+    Subclasses have to implement :meth:`copy_empty` and usually override
+    some of the hooks that are called with the lock held.  The entries are
+    stored in an ordered dict which holds the least recently used key first.
+    """
+
+    def __init__(self):
+        self._mapping = OrderedDict()
+        self._lock = Lock()
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        """Reset the hit, miss and eviction counters."""
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def copy_empty(self):
+        """Return a new and empty cache with the same configuration.  This
+        is used for overlay environments.
+        """
+        raise NotImplementedError()
+
+    def _is_stale(self, key):
+        """Return `True` if the entry must not be returned anymore."""
+        return False
+
+    def _on_access(self, key):
+        """Called for every lookup, no matter if it was a hit or miss."""
+
+    def _admit(self, key, value):
+        """Return `False` if the value should not be added to the cache."""
+        return True
+
+    def _over_capacity(self):
+        """Return `True` as long as entries have to be evicted."""
+        raise NotImplementedError()
+
+    def _insert(self, key, value):
+        self._mapping[key] = value
+
+    def _discard(self, key):
+        del self._mapping[key]
+
+    def _evict(self):
+        self._discard(next(iter(self._mapping)))
+        self.evictions += 1
+
+    def get(self, key, default=None):
+        """Return an item from the cache or `default`."""
+        self._lock.acquire()
+        try:
+            self._on_access(key)
+            rv = self._mapping.get(key, missing)
+            if rv is not missing and self._is_stale(key):
+                self._discard(key)
+                self.evictions += 1
+                rv = missing
+            if rv is missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._mapping[key] = self._mapping.pop(key)
+            return rv
+        finally:
+            self._lock.release()
+
+    def __getitem__(self, key):
+        rv = self.get(key, missing)
+        if rv is missing:
+            raise KeyError(key)
+        return rv
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            if key in self._mapping:
+                self._discard(key)
+            if not self._admit(key, value):
+                self.evictions += 1
+                return
+            self._insert(key, value)
+            while self._mapping and self._over_capacity():
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def __delitem__(self, key):
+        self._lock.acquire()
+        try:
+            self._discard(key)
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._mapping
+
+    def __len__(self):
+        return len(self._mapping)
+
+    def __iter__(self):
+        """Iterate over all keys, the most recently used key first."""
+        return reversed(tuple(self._mapping))
+
+    def keys(self):
+        """Return a list of all keys ordered by most recent usage."""
+        return list(self)
+
+    def values(self):
+        """Return a list of all values ordered by most recent usage."""
+        return [x[1] for x in self.items()]
+
+    def items(self):
+        """Return a list of items ordered by most recent usage."""
+        result = list(self._mapping.items())
+        result.reverse()
+        return result
+
+    def clear(self):
+        """Clear the cache.  The statistics are left untouched."""
+        self._lock.acquire()
+        try:
+            for key in list(self._mapping):
+                self._discard(key)
+        finally:
+            self._lock.release()
+
+    def __repr__(self):
+        return '<%s %d items, hits=%d, misses=%d, evictions=%d>' % (
+            self.__class__.__name__,
+            len(self),
+            self.hits,
+            self.misses,
+            self.evictions
+        )
+
+
+class WeightedLRUCache(CachePolicy):
+    """A least recently used cache that evicts templates once the total
+    weight of all cached templates exceeds `max_weight`.  Per default the
+    weight of a template is calculated by :func:`template_weight` which
+    estimates the size of the compiled code in bytes.  A different `weigh`
+    function can be provided which is passed the template.
+
+    A template that is heavier than `max_weight` on its own is not cached
+    at all.
+    """
+
+    def __init__(self, max_weight, weigh=template_weight):
+        CachePolicy.__init__(self)
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.total_weight = 0
+        self._weights = {}
+
+    def copy_empty(self):
+        return self.__class__(self.max_weight, self.weigh)
+
+    def _admit(self, key, value):
+        weight = self.weigh(value)
+        if weight > self.max_weight:
+            return False
+        self._weights[key] = weight
+        return True
+
+    def _over_capacity(self):
+        return self.total_weight > self.max_weight
+
+    def _insert(self, key, value):
+        self.total_weight += self._weights[key]
+        self._mapping[key] = value
+
+    def _discard(self, key):
+        del self._mapping[key]
+        self.total_weight -= self._weights.pop(key)
+
+
+class TTLCache(CachePolicy):
+    """A least recently used cache for up to `capacity` templates where
+    entries expire `ttl` seconds after they were added.  Expired templates
+    are evicted when they are looked up the next time or when
+    :meth:`purge_expired` is called.  `timer` is the function used to get
+    the current time.
+    """
+
+    def __init__(self, capacity, ttl, timer=time.time):
+        CachePolicy.__init__(self)
+        self.capacity = capacity
+        self.ttl = ttl
+        self.timer = timer
+        self._expires = {}
+
+    def copy_empty(self):
+        return self.__class__(self.capacity, self.ttl, self.timer)
+
+    def purge_expired(self):
+        """Evict all expired templates."""
+        self._lock.acquire()
+        try:
+            now = self.timer()
+            for key, expires in list(self._expires.items()):
+                if expires <= now:
+                    self._discard(key)
+                    self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def _is_stale(self, key):
+        return self._expires[key] <= self.timer()
+
+    def _over_capacity(self):
+        return len(self._mapping) > self.capacity
+
+    def _insert(self, key, value):
+        self._expires[key] = self.timer() + self.ttl
+        self._mapping[key] = value
+
+    def _discard(self, key):
+        del self._mapping[key]
+        del self._expires[key]
+
+
+class _FrequencySketch(object):
+    """A count-min sketch with small saturating counters that estimates how
+    often a key was accessed.  After `sample_size` increments all counters
+    are halved so that the estimates adapt to a changing working set.
+    """
+
+    # multipliers for the hash of the key, one per row.  The index is taken
+    # from the high bits of the product which are well mixed.
+    seeds = (0x9e3779b97f4a7c15, 0xc2b2ae3d27d4eb4f,
+             0x165667b19e3779f9, 0xd6e8feb86659fd93)
+    max_count = 15
+
+    def __init__(self, capacity, sample_size):
+        bits = 4
+        while 1 << bits < capacity:
+            bits += 1
+        self._shift = 64 - bits
+        self._rows = [[0] * (1 << bits) for _ in self.seeds]
+        self.sample_size = sample_size
+        self._additions = 0
+
+    def _indexes(self, key):
+        h = hash(key) & 0xffffffffffffffff
+        for seed in self.seeds:
+            yield ((h * seed) & 0xffffffffffffffff) >> self._shift
+
+    def frequency(self, key):
+        return min(row[idx] for row, idx in
+                   zip(self._rows, self._indexes(key)))
+
+    def increment(self, key):
+        for row, idx in zip(self._rows, self._indexes(key)):
+            if row[idx] < self.max_count:
+                row[idx] += 1
+        self._additions += 1
+        if self._additions >= self.sample_size:
+            self._reset()
+
+    def _reset(self):
+        for row in self._rows:
+            for idx, count in enumerate(row):
+                row[idx] = count >> 1
+        self._additions >>= 1
+
+
+class LFUCache(CachePolicy):
+    """A frequency based cache for up to `capacity` templates that uses
+    the TinyLFU admission policy.  Every lookup is recorded in a compact
+    frequency sketch.  Once the cache is full a new template is only added
+    if it was requested more often recently than the least recently used
+    template it would replace, which protects frequently used templates
+    from being flushed out by a scan over rarely used ones.  Rejected
+    templates are counted as evictions.
+
+    The frequencies are aged after `sample_size` lookups which defaults to
+    ten times the capacity.
+    """
+
+    def __init__(self, capacity, sample_size=None):
+        CachePolicy.__init__(self)
+        self.capacity = capacity
+        if sample_size is None:
+            sample_size = capacity * 10
+        self.sample_size = sample_size
+        self._sketch = _FrequencySketch(capacity, sample_size)
+
+    def copy_empty(self):
+        return self.__class__(self.capacity, self.sample_size)
+
+    def _on_access(self, key):
+        self._sketch.increment(key)
+
+    def _admit(self, key, value):
+        if len(self._mapping) < self.capacity:
+            return True
+        victim = next(iter(self._mapping))
+        return self._sketch.frequency(key) > self._sketch.frequency(victim)
+
+    def _over_capacity(self):
+        return len(self._mapping) > self.capacity
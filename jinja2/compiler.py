@@ -15,9 +15,10 @@ from functools import update_wrapper
 from jinja2 import nodes
 from jinja2.nodes import EvalContext
 from jinja2.visitor import NodeVisitor
-from jinja2.optimizer import Optimizer
+from jinja2.optimizer import Optimizer, optimize_template
 from jinja2.exceptions import TemplateAssertionError
 from jinja2.utils import Markup, concat, escape
+from jinja2.runtime import CountingLoopContext
 from jinja2._compat import range_type, text_type, string_types, \
      iteritems, NativeStringIO, imap, izip
 from jinja2.idtracking import Symbols, VAR_LOAD_PARAMETER, \
@@ -76,6 +77,8 @@ def generate(node, environment, name, filename, stream=None,
     """Generate the python source for a node tree."""
     if not isinstance(node, nodes.Template):
         raise TypeError('Can\'t compile non template nodes')
+    if optimized:
+        node = optimize_template(node, environment, name)
     generator = environment.code_generator_class(environment, name, filename,
                                                  stream, defer_init,
                                                  optimized)
@@ -125,6 +128,7 @@ class MacroRef(object):
         self.accesses_caller = False
         self.accesses_kwargs = False
         self.accesses_varargs = False
+        self.binder = None
 
 
 class Frame(object):
@@ -234,6 +238,63 @@ class UndeclaredNameVisitor(NodeVisitor):
         """Stop visiting a blocks."""
 
 
+class LoopAttributeVisitor(NodeVisitor):
+    """Collects the attributes of the loop variables that are accessed.
+    If a loop variable is used in any other way than looking up a constant
+    attribute `attributes` is set to `None`.
+    """
+
+    def __init__(self, names):
+        self.names = set(names)
+        self.attributes = set()
+
+    def visit_Getattr(self, node):
+        if isinstance(node.node, nodes.Name) and node.node.ctx == 'load' \
+           and node.node.name in self.names:
+            self.attributes.add(node.attr)
+        else:
+            self.generic_visit(node)
+
+    def visit_Name(self, node):
+        if node.ctx == 'load' and node.name in self.names:
+            self.give_up()
+
+    def give_up(self):
+        self.attributes = None
+        raise VisitorExit()
+
+    def visit_Include(self, node):
+        # the loop is passed on with the local variables
+        if node.with_context:
+            self.give_up()
+        self.generic_visit(node)
+
+    visit_Import = visit_FromImport = visit_Include
+
+    def visit_OverlayScope(self, node):
+        self.give_up()
+
+    def visit_Block(self, node):
+        """Stop visiting a blocks.  Scoped blocks get the loop with the
+        local variables.
+        """
+        if node.scoped:
+            self.give_up()
+
+
+def find_loop_attributes(nodes, names):
+    """Return the set of attributes looked up on the loop variables in
+    `names` or `None` if the variables are used in another way.
+    """
+    visitor = LoopAttributeVisitor(names)
+    try:
+        for node in nodes:
+            visitor.visit(node)
+    except VisitorExit:
+        pass
+    return visitor.attributes
+
+
 class CompilerExit(Exception):
     """Raised if the compiler encountered a situation where it just
     doesn't make sense to further process the code.  Any block that
@@ -272,6 +333,10 @@ class CodeGenerator(NodeVisitor):
         # more optimizations.
         self.has_known_extends = False
 
+        # if set the output is passed to a `write` function instead of
+        # being yielded
+        self.writer_mode = False
+
         # the current line number
         self.code_lineno = 1
 
@@ -281,6 +346,11 @@ class CodeGenerator(NodeVisitor):
 
         # the debug information
         self.debug_info = []
+
+        # the names the render functions look up with `resolve_slots`.  The
+        # position of a name is its slot index.
+        self.slot_names = []
+        self._slot_indexes = {}
         self._write_debug_info = None
 
         # the number of new lines before the next write()
@@ -353,13 +423,16 @@ class CodeGenerator(NodeVisitor):
     def start_write(self, frame, node=None):
         """Yield or write into the frame buffer."""
         if frame.buffer is None:
-            self.writeline('yield ', node)
+            if self.writer_mode:
+                self.writeline('write(', node)
+            else:
+                self.writeline('yield ', node)
         else:
             self.writeline('%s.append(' % frame.buffer, node)
 
     def end_write(self, frame):
         """End the writing process started by `start_write`."""
-        if frame.buffer is not None:
+        if frame.buffer is not None or self.writer_mode:
             self.write(')')
 
     def simple_write(self, s, frame, node=None):
@@ -472,20 +545,39 @@ class CodeGenerator(NodeVisitor):
                 self.writeline('%s = environment.%s[%r]' %
                                (mapping[name], dependency, name))
 
+    def slot_index(self, name):
+        """Returns the index of a name in the slot names of the template."""
+        rv = self._slot_indexes.get(name)
+        if rv is None:
+            rv = self._slot_indexes[name] = len(self.slot_names)
+            self.slot_names.append(name)
+        return rv
+
     def enter_frame(self, frame):
         undefs = []
+        resolves = []
         for target, (action, param) in iteritems(frame.symbols.loads):
             if action == VAR_LOAD_PARAMETER:
                 pass
             elif action == VAR_LOAD_RESOLVE:
-                self.writeline('%s = %s(%r)' %
-                               (target, self.get_resolve_func(), param))
+                resolves.append((target, param))
             elif action == VAR_LOAD_ALIAS:
                 self.writeline('%s = %s' % (target, param))
             elif action == VAR_LOAD_UNDEFINED:
                 undefs.append(target)
             else:
                 raise NotImplementedError('unknown load instruction')
+        # the values of several names are resolved at once from the
+        # context and then loaded by their slot index
+        if len(resolves) > 1 and self.get_context_ref() == 'context':
+            self.writeline('slots = resolve_slots(slot_names)')
+            for target, param in resolves:
+                self.writeline('%s = slots[%d]' %
+                               (target, self.slot_index(param)))
+        else:
+            for target, param in resolves:
+                self.writeline('%s = %s(%r)' %
+                               (target, self.get_resolve_func(), param))
         if undefs:
             self.writeline('%s = missing' % ' = '.join(undefs))
 
@@ -576,9 +668,30 @@ class CodeGenerator(NodeVisitor):
         self.return_buffer_contents(frame, force_unescaped=True)
         self.leave_frame(frame, with_python_scope=True)
         self.outdent()
+        self.macro_binder(macro_ref)
 
         return frame, macro_ref
 
+    def macro_binder(self, macro_ref):
+        """Dump a function that binds the arguments of a macro call for
+        macros without special arguments.  Python does the binding and
+        `Macro` only falls back to its own argument handling if it fails.
+        """
+        if macro_ref.accesses_caller or macro_ref.accesses_kwargs or \
+           macro_ref.accesses_varargs:
+            return
+        names = [x.name for x in macro_ref.node.args]
+        for name in names:
+            if is_python_keyword(name) or name in ('None', 'True', 'False'):
+                return
+        macro_ref.binder = self.temporary_identifier()
+        self.writeline('def %s(%s):' % (macro_ref.binder, ', '.join(
+            '%s=missing' % name for name in names)))
+        self.indent()
+        self.writeline('return (%s%s)' % (', '.join(names),
+                                          len(names) == 1 and ',' or ''))
+        self.outdent()
+
     def macro_def(self, macro_ref, frame):
         """Dump the macro definition for the def created by macro_body."""
         arg_tuple = ', '.join(repr(x.name) for x in macro_ref.node.args)
@@ -586,9 +699,10 @@ class CodeGenerator(NodeVisitor):
         if len(macro_ref.node.args) == 1:
             arg_tuple += ','
         self.write('Macro(environment, macro, %r, (%s), %r, %r, %r, '
-                   'context.eval_ctx.autoescape)' %
+                   'context.eval_ctx.autoescape, %s)' %
                    (name, arg_tuple, macro_ref.accesses_kwargs,
-                    macro_ref.accesses_varargs, macro_ref.accesses_caller))
+                    macro_ref.accesses_varargs, macro_ref.accesses_caller,
+                    macro_ref.binder))
 
     def position(self, node):
         """Return a human readable position for the node."""
@@ -608,8 +722,15 @@ class CodeGenerator(NodeVisitor):
         through a dead branch.
         """
         self.writeline('resolve = context.resolve_or_missing')
+        self.writeline('resolve_slots = context.resolve_slots')
         self.writeline('undefined = environment.undefined')
-        self.writeline('if 0: yield None')
+        self.writeline('if environment.metrics is not None:')
+        self.indent()
+        self.writeline('undefined = metered_undefined(environment, %r)' %
+                       self.name)
+        self.outdent()
+        if not self.writer_mode:
+            self.writeline('if 0: yield None')
 
     def push_parameter_definitions(self, frame):
         """Pushes all parameter targets from the given frame into a local
@@ -708,10 +829,6 @@ class CodeGenerator(NodeVisitor):
         # environment into a local name
         envenv = not self.defer_init and ', environment=environment' or ''
 
-        # do we have an extends tag at all?  If not, we can save some
-        # overhead by just not processing any inheritance code.
-        have_extends = node.find(nodes.Extends) is not None
-
         # find all blocks
         for block in node.find_all(nodes.Block):
             if block.name in self.blocks:
@@ -733,9 +850,58 @@ class CodeGenerator(NodeVisitor):
         # add the load name
         self.writeline('name = %r' % self.name)
 
+        # and the names of the templates this template references so that
+        # the environment can track dependencies.  meta imports the code
+        # generator so it can only be imported here.
+        from jinja2.meta import find_referenced_templates
+        self.writeline('referenced_templates = %r' % (tuple(sorted(set(
+            x for x in find_referenced_templates(node) if x is not None))),))
+
+        self.render_functions(node, eval_ctx, envenv)
+
+        # the variants of the render functions that write the output
+        # through a callable instead of yielding it
+        if self.environment.policies.get('compiler.write_functions') and \
+           not self.environment.is_async:
+            self.extends_so_far = 0
+            self.has_known_extends = False
+            self.writer_mode = True
+            self.render_functions(node, eval_ctx, envenv)
+            self.writer_mode = False
+            self.writeline('root.write_func = write_root', extra=1)
+            for name in self.blocks:
+                self.writeline('block_%s.write_func = write_block_%s' %
+                               (name, name))
+
+        self.writeline('blocks = {%s}' % ', '.join('%r: block_%s' % (x, x)
+                                                   for x in self.blocks),
+                       extra=1)
+
+        self.writeline('slot_names = %r' % (tuple(self.slot_names),))
+
+        # add a function that returns the debug info
+        self.writeline('debug_info = %r' % '&'.join('%s=%s' % x for x
+                                                    in self.debug_info))
+
+    def render_func(self, name):
+        """Like :meth:`func` for the root and block render functions."""
+        if self.writer_mode:
+            return self.func('write_' + name)
+        return self.func(name)
+
+    def writer_args(self):
+        return self.writer_mode and 'write, ' or ''
+
+    def render_functions(self, node, eval_ctx, envenv):
+        """Writes the root render function and the block functions."""
+        # do we have an extends tag at all?  If not, we can save some
+        # overhead by just not processing any inheritance code.
+        have_extends = node.find(nodes.Extends) is not None
+
         # generate the root render function.
-        self.writeline('%s(context, missing=missing%s):' %
-                       (self.func('root'), envenv), extra=1)
+        self.writeline('%s(context, %smissing=missing%s):' %
+                       (self.render_func('root'), self.writer_args(), envenv),
+                       extra=1)
         self.indent()
         self.write_commons()
 
@@ -761,7 +927,10 @@ class CodeGenerator(NodeVisitor):
                 self.indent()
                 self.writeline('if parent_template is not None:')
             self.indent()
-            if supports_yield_from and not self.environment.is_async:
+            if self.writer_mode:
+                self.writeline('write_events(parent_template.'
+                               'root_render_func, context, write)')
+            elif supports_yield_from and not self.environment.is_async:
                 self.writeline('yield from parent_template.'
                                'root_render_func(context)')
             else:
@@ -775,9 +944,9 @@ class CodeGenerator(NodeVisitor):
 
         # at this point we now have the blocks collected and can visit them too.
         for name, block in iteritems(self.blocks):
-            self.writeline('%s(context, missing=missing%s):' %
-                           (self.func('block_' + name), envenv),
-                           block, 1)
+            self.writeline('%s(context, %smissing=missing%s):' %
+                           (self.render_func('block_' + name),
+                            self.writer_args(), envenv), block, 1)
             self.indent()
             self.write_commons()
             # It's important that we do not make this frame a child of the
@@ -800,14 +969,6 @@ class CodeGenerator(NodeVisitor):
             self.leave_frame(block_frame, with_python_scope=True)
             self.outdent()
 
-        self.writeline('blocks = {%s}' % ', '.join('%r: block_%s' % (x, x)
-                                                   for x in self.blocks),
-                       extra=1)
-
-        # add a function that returns the debug info
-        self.writeline('debug_info = %r' % '&'.join('%s=%s' % x for x
-                                                    in self.debug_info))
-
     def visit_Block(self, node, frame):
         """Call a block and register it for the template."""
         level = 0
@@ -826,7 +987,10 @@ class CodeGenerator(NodeVisitor):
         else:
             context = self.get_context_ref()
 
-        if supports_yield_from and not self.environment.is_async and \
+        if self.writer_mode and frame.buffer is None:
+            self.writeline('write_events(context.blocks[%r][0], %s, write)'
+                           % (node.name, context), node)
+        elif supports_yield_from and not self.environment.is_async and \
            frame.buffer is None:
             self.writeline('yield from context.blocks[%r][0](%s)' % (
                            node.name, context), node)
@@ -868,7 +1032,12 @@ class CodeGenerator(NodeVisitor):
             else:
                 self.outdent()
 
-        self.writeline('parent_template = environment.get_template(', node)
+        if self.environment.is_async:
+            self.writeline('parent_template = await '
+                           'environment.get_template_async(', node)
+        else:
+            self.writeline('parent_template = environment.get_template(',
+                           node)
         self.visit(node.template, frame)
         self.write(', %r)' % self.name)
         self.writeline('for name, parent_block in parent_template.'
@@ -902,7 +1071,11 @@ class CodeGenerator(NodeVisitor):
         elif isinstance(node.template, (nodes.Tuple, nodes.List)):
             func_name = 'select_template'
 
-        self.writeline('template = environment.%s(' % func_name, node)
+        if self.environment.is_async:
+            self.writeline('template = await environment.%s_async('
+                           % func_name, node)
+        else:
+            self.writeline('template = environment.%s(' % func_name, node)
         self.visit(node.template, frame)
         self.write(', %r)' % self.name)
         if node.ignore_missing:
@@ -915,7 +1088,12 @@ class CodeGenerator(NodeVisitor):
             self.indent()
 
         skip_event_yield = False
-        if node.with_context:
+        if node.with_context and self.writer_mode and frame.buffer is None:
+            self.writeline('write_events(template.root_render_func, '
+                           'template.new_context(context.get_all(), True, '
+                           '%s), write)' % self.dump_local_context(frame))
+            skip_event_yield = True
+        elif node.with_context:
             loop = self.environment.is_async and 'async for' or 'for'
             self.writeline('%s event in template.root_render_func('
                            'template.new_context(context.get_all(), True, '
@@ -925,7 +1103,7 @@ class CodeGenerator(NodeVisitor):
                            'template._get_default_module_async())'
                            '._body_stream:')
         else:
-            if supports_yield_from:
+            if supports_yield_from and not self.writer_mode:
                 self.writeline('yield from template._get_default_module()'
                                '._body_stream')
                 skip_event_yield = True
@@ -947,10 +1125,13 @@ class CodeGenerator(NodeVisitor):
         if frame.toplevel:
             self.write('context.vars[%r] = ' % node.target)
         if self.environment.is_async:
-            self.write('await ')
-        self.write('environment.get_template(')
-        self.visit(node.template, frame)
-        self.write(', %r).' % self.name)
+            self.write('await (await environment.get_template_async(')
+            self.visit(node.template, frame)
+            self.write(', %r)).' % self.name)
+        else:
+            self.write('environment.get_template(')
+            self.visit(node.template, frame)
+            self.write(', %r).' % self.name)
         if node.with_context:
             self.write('make_module%s(context.get_all(), True, %s)'
                        % (self.environment.is_async and '_async' or '',
@@ -965,10 +1146,15 @@ class CodeGenerator(NodeVisitor):
     def visit_FromImport(self, node, frame):
         """Visit named imports."""
         self.newline(node)
-        self.write('included_template = %senvironment.get_template('
-                   % (self.environment.is_async and 'await ' or ''))
-        self.visit(node.template, frame)
-        self.write(', %r).' % self.name)
+        if self.environment.is_async:
+            self.write('included_template = await (await '
+                       'environment.get_template_async(')
+            self.visit(node.template, frame)
+            self.write(', %r)).' % self.name)
+        else:
+            self.write('included_template = environment.get_template(')
+            self.visit(node.template, frame)
+            self.write(', %r).' % self.name)
         if node.with_context:
             self.write('make_module%s(context.get_all(), True, %s)'
                        % (self.environment.is_async and '_async' or '',
@@ -1035,6 +1221,16 @@ class CodeGenerator(NodeVisitor):
             'forloop' in find_undeclared(node.iter_child_nodes(
                                          only=('body',)), ('forloop',))
 
+        # loops that only need the index don't have to look ahead in the
+        # iterable, they get a cheaper loop context.
+        loop_context = 'LoopContext'
+        if extended_loop and not node.recursive:
+            attributes = find_loop_attributes(node.iter_child_nodes(
+                only=('body',)), ('loop', 'forloop'))
+            if attributes is not None and \
+               attributes <= CountingLoopContext.supported_attributes:
+                loop_context = 'CountingLoopContext'
+
         loop_ref = None
         forloop_ref = None
         if extended_loop:
@@ -1099,7 +1295,8 @@ class CodeGenerator(NodeVisitor):
             if self.environment.is_async:
                 self.write(', %s, %s in await make_async_loop_context(' % (loop_ref, forloop_ref))
             else:
-                self.write(', %s, %s in LoopContext(' % (loop_ref, forloop_ref))
+                self.write(', %s, %s in %s(' % (loop_ref, forloop_ref,
+                                                loop_context))
         else:
             self.write(' in ')
 
@@ -1287,12 +1484,12 @@ class CodeGenerator(NodeVisitor):
                 if isinstance(item, list):
                     val = repr(concat(item))
                     if frame.buffer is None:
-                        self.writeline('yield ' + val)
+                        self.simple_write(val, frame)
                     else:
                         self.writeline(val + ',')
                 else:
                     if frame.buffer is None:
-                        self.writeline('yield ', item)
+                        self.start_write(frame, item)
                     else:
                         self.newline(item)
                     close = 1
@@ -1313,6 +1510,8 @@ class CodeGenerator(NodeVisitor):
                     self.write(')' * close)
                     if frame.buffer is not None:
                         self.write(',')
+                    else:
+                        self.end_write(frame)
             if frame.buffer is not None:
                 # close the open parentheses
                 self.outdent()
@@ -1328,7 +1527,7 @@ class CodeGenerator(NodeVisitor):
                 else:
                     format.append('%s')
                     arguments.append(item)
-            self.writeline('yield ')
+            self.start_write(frame)
             self.write(repr(concat(format)) + ' % (')
             self.indent()
             for argument in arguments:
@@ -1357,6 +1556,7 @@ class CodeGenerator(NodeVisitor):
                 self.write(')' * close + ', ')
             self.outdent()
             self.writeline(')')
+            self.end_write(frame)
 
         if outdent_later:
             self.outdent()
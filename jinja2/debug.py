@@ -261,6 +261,8 @@ def fake_exc_info(exc_info, filename, lineno):
             location = 'template'
         else:
             function = tb.tb_frame.f_code.co_name
+            if function.startswith('write_'):
+                function = function[6:]
             if function == 'root':
                 location = 'top-level template code'
             elif function.startswith('block_'):
@@ -47,6 +47,12 @@ DEFAULT_POLICIES = {
     'truncate.leeway':      5,
     'json.dumps_function':  None,
     'json.dumps_kwargs':    {'sort_keys': True},
+    'compiler.write_functions':     False,
+    'optimizer.inline_macros':      False,
+    'optimizer.inline_constants':   False,
+    'optimizer.dead_branches':      False,
+    'optimizer.hoist_filters':      False,
+    'optimizer.merge_output':       False,
 }
 
 
@@ -10,7 +10,12 @@
 """
 import os
 import sys
+import codecs
+import json
+import time
+import marshal
 import weakref
+from hashlib import sha1
 from functools import reduce, partial
 from jinja2 import nodes
 from jinja2.defaults import BLOCK_START_STRING, \
@@ -19,23 +24,34 @@ from jinja2.defaults import BLOCK_START_STRING, \
      LINE_COMMENT_PREFIX, TRIM_BLOCKS, NEWLINE_SEQUENCE, \
      DEFAULT_FILTERS, DEFAULT_TESTS, DEFAULT_NAMESPACE, \
      DEFAULT_POLICIES, KEEP_TRAILING_NEWLINE, LSTRIP_BLOCKS
-from jinja2.lexer import get_lexer, TokenStream
+from jinja2.lexer import get_lexer, get_lexer_key, TokenStream
 from jinja2.parser import Parser
 from jinja2.nodes import EvalContext
 from jinja2.compiler import generate, CodeGenerator
-from jinja2.runtime import Undefined, new_context, Context
+from jinja2.runtime import Undefined, new_context, Context, write_events
+from jinja2.cache import CachePolicy
+from jinja2.bccache import bc_magic
+from jinja2.metrics import default_timer
+from jinja2.meta import find_referenced_templates
 from jinja2.exceptions import TemplateSyntaxError, TemplateNotFound, \
      TemplatesNotFound, TemplateRuntimeError
 from jinja2.utils import import_string, LRUCache, Markup, missing, \
-     concat, consume, internalcode, have_async_gen
+     concat, consume, internalcode, have_async_gen, DependencyGraph
 from jinja2._compat import imap, ifilter, string_types, iteritems, \
      text_type, reraise, implements_iterator, implements_to_string, \
      encode_filename, PY2, PYPY
 
 
+# magic header of the files written by `Environment.snapshot_cache`.  The
+# magic of the bytecode cache follows it.
+_snapshot_magic = b'j2snapshot'
+
 # for direct template usage we have up to ten living environments
 _spontaneous_environments = LRUCache(10)
 
+# the parse cache of all environments created with ``parse_cache=True``
+_shared_parse_cache = LRUCache(400)
+
 # the function to create jinja traceback objects.  This is dynamically
 # imported on the first exception in the exception handler.
 _make_traceback = None
@@ -59,6 +75,8 @@ def get_spontaneous_environment(*args):
 
 def create_cache(size):
     """Return the cache class for the given size."""
+    if isinstance(size, CachePolicy):
+        return size
     if size == 0:
         return None
     if size < 0:
@@ -66,15 +84,146 @@ def create_cache(size):
     return LRUCache(size)
 
 
+def create_parse_cache(parse_cache):
+    """Return the parse cache for the `parse_cache` argument of the
+    environment.
+    """
+    if parse_cache is None or parse_cache is False:
+        return None
+    if parse_cache is True:
+        return _shared_parse_cache
+    return parse_cache
+
+
+def _copy_tree(node, environment):
+    """Copy a node tree for the parse cache and bind it to `environment`.
+    Only nodes and lists are copied, the parser never puts other mutable
+    values into the tree.
+    """
+    rv = object.__new__(node.__class__)
+    rv.__dict__.update(node.__dict__)
+    rv.environment = environment
+    for field in node.fields:
+        value = getattr(node, field, None)
+        if isinstance(value, nodes.Node):
+            setattr(rv, field, _copy_tree(value, environment))
+        elif isinstance(value, list):
+            setattr(rv, field, [_copy_tree(x, environment)
+                                if isinstance(x, nodes.Node) else x
+                                for x in value])
+    return rv
+
+
+def _finalize_shape(finalize):
+    """The part of `finalize` the generated code depends on.  Finalize
+    functions that need the context are only called at runtime, all others
+    are applied to constant output when the template is compiled.
+    """
+    if finalize is None:
+        return None
+    for attr in 'contextfunction', 'evalcontextfunction':
+        if getattr(finalize, attr, False):
+            return attr
+    return finalize
+
+
 def copy_cache(cache):
     """Create an empty copy of the given cache."""
     if cache is None:
         return None
     elif type(cache) is dict:
         return {}
+    elif isinstance(cache, CachePolicy):
+        return cache.copy_empty()
     return LRUCache(cache.capacity)
 
 
+# the environment the worker processes of `compile_templates` compile
+# templates with.  It's inherited when the process is forked because
+# environments usually can't be pickled.
+_compile_worker_environment = None
+
+
+def _init_compile_worker(environment):
+    global _compile_worker_environment
+    _compile_worker_environment = environment
+
+
+def _compile_module_worker(args):
+    name, py_compile = args
+    try:
+        rv = _compile_worker_environment._compile_module(name, py_compile)
+    except TemplateSyntaxError as e:
+        return name, None, (e.__class__, e.message, e.lineno, e.name,
+                            e.filename, e.translated)
+    return name, rv, None
+
+
+def _rebuild_syntax_error(cls, message, lineno, name, filename, translated):
+    rv = cls(message, lineno, name, filename)
+    rv.translated = translated
+    return rv
+
+
+def _compile_chunksize(count, workers):
+    # a few chunks per worker balance the load without sending every
+    # single template back and forth.
+    return max(1, min(64, count // (workers * 4)))
+
+
+def _load_compile_manifest(filename, py_compile):
+    """Loads the manifest of an incremental `compile_templates`.  If it does
+    not exist or was written for different settings an empty one is
+    returned which causes a full compilation.
+    """
+    from jinja2 import __version__
+    rv = {
+        'jinja_version':    __version__,
+        'py_compile':       py_compile,
+        'templates':        {}
+    }
+    try:
+        f = open(filename, 'r')
+    except IOError:
+        return rv
+    try:
+        try:
+            manifest = json.load(f)
+        except ValueError:
+            return rv
+    finally:
+        f.close()
+    if manifest.get('jinja_version') == rv['jinja_version'] and \
+       manifest.get('py_compile') == py_compile:
+        rv['templates'] = manifest.get('templates') or {}
+    return rv
+
+
+def _write_compile_manifest(filename, manifest):
+    f = open(filename, 'w')
+    try:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+
+
+def _make_compile_pool(environment, workers):
+    """Creates the process pool for `compile_templates`."""
+    import multiprocessing
+    context = multiprocessing
+    if hasattr(multiprocessing, 'get_context'):
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            context = None
+    elif not hasattr(os, 'fork'):
+        context = None
+    if context is None:
+        raise RuntimeError('compiling templates with workers requires '
+                           'a platform that supports fork')
+    return context.Pool(workers, _init_compile_worker, (environment,))
+
+
 def load_extensions(environment, extensions):
     """Load the extensions from the list and bind it to the environment.
     Returns a dict of instantiated environments.
@@ -209,9 +358,16 @@ class Environment(object):
             ``0`` templates are recompiled all the time, if the cache size is
             ``-1`` the cache will not be cleaned.
 
+            Instead of a size a :class:`~jinja2.cache.CachePolicy` can be
+            passed which then decides which templates are evicted.  See
+            :ref:`cache-policies` for more information.
+
             .. versionchanged:: 2.8
                The cache size was increased to 400 from a low 50.
 
+            .. versionchanged:: 2.10
+               Cache policies can be passed as cache size.
+
         `auto_reload`
             Some loaders load templates from locations where the template
             sources may change (ie: file system or database).  If
@@ -220,6 +376,17 @@ class Environment(object):
             will reload the template.  For higher performance it's possible to
             disable that.
 
+        `auto_reload_interval`
+            If set to a number of seconds the loader is asked if a cached
+            template is up to date at most once in that interval.  This
+            avoids a file system check for every template (including all
+            includes and parent templates) on every render when
+            ``auto_reload`` is enabled.  Defaults to ``0`` which checks every
+            time.  Alternatively an :class:`~jinja2.watcher.InotifyWatcher`
+            can be used to drop changed templates from the cache.
+
+            .. versionadded:: 2.10
+
         `bytecode_cache`
             If set to a bytecode cache object, this object will provide a
             cache for the internal Jinja bytecode so that templates don't
@@ -231,6 +398,26 @@ class Environment(object):
             If set to true this enables async template execution which allows
             you to take advantage of newer Python features.  This requires
             Python 3.6 or later.
+
+        `parse_cache`
+            If set to ``True`` the syntax trees of parsed sources are
+            stored in a cache shared by all environments in the process
+            that enabled it.  Environments with the same lexer settings and
+            extensions then only parse a source loaded under the same
+            template name once.  Alternatively a
+            :class:`~jinja2.utils.LRUCache` can be passed which is then
+            shared by the environments it is passed to.  Per default no
+            parse cache is used.
+
+            .. versionadded:: 2.10
+
+        `metrics`
+            A :class:`~jinja2.metrics.MetricsSink` that receives render
+            times, template and bytecode cache hits, compile times and the
+            number of undefined values.  See :ref:`metrics` for more
+            information.  Per default no metrics are collected.
+
+            .. versionadded:: 2.10
     """
 
     #: if this environment is sandboxed.  Modifying this variable won't make
@@ -283,7 +470,10 @@ class Environment(object):
                  cache_size=400,
                  auto_reload=True,
                  bytecode_cache=None,
-                 enable_async=False):
+                 enable_async=False,
+                 auto_reload_interval=0,
+                 parse_cache=None,
+                 metrics=None):
         # !!Important notice!!
         #   The constructor accepts quite a few arguments that should be
         #   passed by keyword rather than position.  However it's important to
@@ -325,6 +515,14 @@ class Environment(object):
         self.cache = create_cache(cache_size)
         self.bytecode_cache = bytecode_cache
         self.auto_reload = auto_reload
+        self.auto_reload_interval = auto_reload_interval
+        self.dependency_graph = DependencyGraph()
+        self.parse_cache = create_parse_cache(parse_cache)
+        self.metrics = metrics
+
+        # the templates loaded by this environment and its overlays.  It's
+        # passed on to overlays which use it to share the compiled code.
+        self._shared_templates = weakref.WeakValueDictionary()
 
         # configurable policies
         self.policies = DEFAULT_POLICIES.copy()
@@ -361,7 +559,8 @@ class Environment(object):
                 extensions=missing, optimized=missing,
                 undefined=missing, finalize=missing, autoescape=missing,
                 loader=missing, cache_size=missing, auto_reload=missing,
-                bytecode_cache=missing):
+                bytecode_cache=missing, auto_reload_interval=missing,
+                metrics=missing):
         """Create a new overlay environment that shares all the data with the
         current environment except for cache and the overridden attributes.
         Extensions cannot be removed for an overlayed environment.  An overlayed
@@ -389,6 +588,7 @@ class Environment(object):
             rv.cache = create_cache(cache_size)
         else:
             rv.cache = copy_cache(self.cache)
+        rv.dependency_graph = DependencyGraph()
 
         rv.extensions = {}
         for key, value in iteritems(self.extensions):
@@ -420,7 +620,7 @@ class Environment(object):
                         return getattr(obj, attr)
                     except AttributeError:
                         pass
-            return self.undefined(obj=obj, name=argument)
+            return self._lookup_undefined(obj, argument)
 
     def getattr(self, obj, attribute):
         """Get an item or attribute of an object but prefer the attribute.
@@ -433,7 +633,16 @@ class Environment(object):
         try:
             return obj[attribute]
         except (TypeError, LookupError, AttributeError):
-            return self.undefined(obj=obj, name=attribute)
+            return self._lookup_undefined(obj, attribute)
+
+    def _lookup_undefined(self, obj, name):
+        """Returns the undefined object for a missing attribute or item and
+        counts it in the metrics sink.  The lookup does not know the
+        template, so the counter has no template name.
+        """
+        if self.metrics is not None:
+            self.metrics.increment('undefined')
+        return self.undefined(obj=obj, name=name)
 
     def call_filter(self, name, value, args=None, kwargs=None,
                     context=None, eval_ctx=None):
@@ -494,7 +703,51 @@ class Environment(object):
 
     def _parse(self, source, name, filename):
         """Internal parsing function used by `parse` and `compile`."""
-        return Parser(self, source, name, encode_filename(filename)).parse()
+        if self.parse_cache is None:
+            return Parser(self, source, name,
+                          encode_filename(filename)).parse()
+        # extensions may preprocess or filter the source depending on the
+        # name of the template so the name is part of the key as well
+        key = (sha1(text_type(source).encode('utf-8')).digest(),
+               get_lexer_key(self), tuple(sorted(self.extensions)),
+               name, filename)
+        tree = self.parse_cache.get(key)
+        if tree is not None:
+            return _copy_tree(tree, self)
+        rv = Parser(self, source, name, encode_filename(filename)).parse()
+        # the compiler modifies the tree it's given, so the cache keeps
+        # its own copy which is not bound to an environment.
+        self.parse_cache[key] = _copy_tree(rv, None)
+        return rv
+
+    def reparse(self, ast, source, start, end, text, name=None,
+                filename=None):
+        """Parse `source` after the characters from `start` to `end` were
+        replaced with `text` and return the new abstract syntax tree.  `ast`
+        has to be the tree of the unmodified `source`.  Only the top-level
+        nodes of the template that are touched by the edit are lexed and
+        parsed again, all others are taken over from `ast`::
+
+            ast = env.reparse(None, u'', 0, 0, source)
+            ast = env.reparse(ast, source, 10, 12, u'{{ foo }}')
+
+        Only trees returned by this method can be re-parsed incrementally,
+        for other trees (or `None`) the whole new source is parsed.  The
+        same happens if the edit cannot be handled incrementally, for
+        example because an extension preprocesses the source.  Because
+        nodes are shared and the line numbers of the nodes behind the edit
+        are updated in place `ast` should not be used after this call.
+
+        .. versionadded:: 2.10
+        """
+        from jinja2.incremental import reparse
+        try:
+            return reparse(self, ast, source, start, end, text, name,
+                           encode_filename(filename))
+        except TemplateSyntaxError:
+            exc_info = sys.exc_info()
+        self.handle_exception(exc_info, source_hint=source[:start] + text +
+                              source[end:])
 
     def lex(self, source, name=None, filename=None):
         """Lex the given sourcecode and return a generator that yields
@@ -573,19 +826,24 @@ class Environment(object):
            `defer_init` parameter added.
         """
         source_hint = None
+        metrics = self.metrics
+        if metrics is not None:
+            start = default_timer()
         try:
             if isinstance(source, string_types):
                 source_hint = source
                 source = self._parse(source, name, filename)
             source = self._generate(source, name, filename,
                                     defer_init=defer_init)
-            if raw:
-                return source
-            if filename is None:
-                filename = '<template>'
-            else:
-                filename = encode_filename(filename)
-            return self._compile(source, filename)
+            if not raw:
+                if filename is None:
+                    filename = '<template>'
+                else:
+                    filename = encode_filename(filename)
+                source = self._compile(source, filename)
+            if metrics is not None:
+                metrics.timing('compile', default_timer() - start, name)
+            return source
         except TemplateSyntaxError:
             exc_info = sys.exc_info()
         self.handle_exception(exc_info, source_hint=source_hint)
@@ -637,7 +895,8 @@ class Environment(object):
 
     def compile_templates(self, target, extensions=None, filter_func=None,
                           zip='deflated', log_function=None,
-                          ignore_errors=True, py_compile=False):
+                          ignore_errors=True, py_compile=False,
+                          workers=None, incremental=False):
         """Finds all the templates the loader can find, compiles them
         and stores them in `target`.  If `zip` is `None`, instead of in a
         zipfile, the templates will be stored in a directory.
@@ -658,7 +917,27 @@ class Environment(object):
         on pypy and Python 3 where pyc files are not picked up by itself and
         don't give much benefit.
 
+        If `workers` is set to a number greater than one the templates are
+        compiled by a pool of that many processes.  The workers are forked
+        from the current process so the environment does not have to be
+        pickled, which means this is not available on platforms without
+        `fork`.  The files are still written by the current process in the
+        order of :meth:`list_templates` so the output is the same as without
+        workers.
+
+        If `incremental` is set to `True` a manifest with the checksums of
+        the template sources and the templates they extend, include or import
+        is stored next to the target (the target name with a ``.manifest``
+        suffix).  On the next incremental run only templates that changed or
+        depend on a changed template are compiled again, and modules of
+        templates that no longer exist are removed.  Dynamic template names
+        cannot be tracked.  If the configuration of the environment changes
+        a full compilation is required.
+
         .. versionadded:: 2.4
+
+        .. versionchanged:: 2.10
+           The `workers` and `incremental` parameters were added.
         """
         from jinja2.loaders import ModuleLoader
 
@@ -672,7 +951,6 @@ class Environment(object):
                 py_compile = False
             else:
                 import imp
-                import marshal
                 py_header = imp.get_magic() + \
                     u'\xff\xff\xff\xff'.encode('iso-8859-15')
 
@@ -680,6 +958,12 @@ class Environment(object):
                 if sys.version_info >= (3, 3):
                     py_header += u'\x00\x00\x00\x00'.encode('iso-8859-15')
 
+        def module_filename(name):
+            filename = ModuleLoader.get_module_filename(name)
+            if py_compile:
+                filename += 'c'
+            return filename
+
         def write_file(filename, data, mode):
             if zip:
                 info = ZipInfo(filename)
@@ -692,44 +976,192 @@ class Environment(object):
                 finally:
                     f.close()
 
+        def remove_file(filename):
+            if not zip:
+                try:
+                    os.remove(os.path.join(target, filename))
+                except OSError:
+                    pass
+
+        def compile_serially(names):
+            for name in names:
+                try:
+                    rv = self._compile_module(name, py_compile)
+                except TemplateSyntaxError as e:
+                    if not ignore_errors:
+                        raise
+                    yield name, None, e
+                else:
+                    yield name, rv, None
+
+        names = self.list_templates(extensions, filter_func)
+        to_compile = names
+        manifest = None
+        old_zip_file = None
+        if incremental:
+            manifest_filename = os.path.normpath(target) + '.manifest'
+            manifest = _load_compile_manifest(manifest_filename, py_compile)
+            to_compile, removed, manifest['templates'] = \
+                self._plan_incremental_compile(names, manifest['templates'])
+            for name in sorted(removed):
+                remove_file(module_filename(name))
+                log_function('Removed "%s"' % name)
+
+            # templates without a module (deleted or failed to compile
+            # before) are compiled again as well
+            if zip is not None:
+                existing = set()
+                if os.path.isfile(target):
+                    from zipfile import ZipFile
+                    old_zip_file = ZipFile(target, 'r')
+                    existing.update(old_zip_file.namelist())
+            elif os.path.isdir(target):
+                existing = set(os.listdir(target))
+            else:
+                existing = set()
+            to_compile = set(to_compile)
+            to_compile = [x for x in names if x in to_compile or
+                          module_filename(x) not in existing]
+            log_function('%d of %d templates need compiling' %
+                         (len(to_compile), len(names)))
+
+        pool = None
+        if workers is not None and workers > 1 and to_compile:
+            pool = _make_compile_pool(self, workers)
+
         if zip is not None:
             from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
-            zip_file = ZipFile(target, 'w', dict(deflated=ZIP_DEFLATED,
-                                                 stored=ZIP_STORED)[zip])
+            zip_target = target
+            if old_zip_file is not None:
+                zip_target = target + '.tmp'
+            zip_file = ZipFile(zip_target, 'w', dict(deflated=ZIP_DEFLATED,
+                                                     stored=ZIP_STORED)[zip])
             log_function('Compiling into Zip archive "%s"' % target)
         else:
             if not os.path.isdir(target):
                 os.makedirs(target)
             log_function('Compiling into folder "%s"' % target)
 
+        finished = False
         try:
-            for name in self.list_templates(extensions, filter_func):
-                source, filename, _ = self.loader.get_source(self, name)
-                try:
-                    code = self.compile(source, name, filename, True, True)
-                except TemplateSyntaxError as e:
-                    if not ignore_errors:
-                        raise
-                    log_function('Could not compile "%s": %s' % (name, e))
+            if pool is not None:
+                results = pool.imap(_compile_module_worker,
+                                    [(name, py_compile) for name in to_compile],
+                                    _compile_chunksize(len(to_compile),
+                                                       workers))
+            else:
+                results = compile_serially(to_compile)
+
+            # unchanged templates of an incremental compilation are copied
+            # over from the old archive in order, this keeps the archive the
+            # same as after a full compilation.
+            pending = set(to_compile)
+            for name in names:
+                if name not in pending:
+                    if old_zip_file is not None:
+                        filename = module_filename(name)
+                        write_file(filename, old_zip_file.read(filename), 'wb')
                     continue
 
-                filename = ModuleLoader.get_module_filename(name)
+                name, rv, error = next(results)
+                if error is not None:
+                    if isinstance(error, tuple):
+                        error = _rebuild_syntax_error(*error)
+                        if not ignore_errors:
+                            raise error
+                    if incremental:
+                        remove_file(module_filename(name))
+                    log_function('Could not compile "%s": %s' % (name, error))
+                    continue
 
+                filename, data = rv
                 if py_compile:
-                    c = self._compile(code, encode_filename(filename))
-                    write_file(filename + 'c', py_header +
-                               marshal.dumps(c), 'wb')
+                    write_file(filename, py_header + data, 'wb')
                     log_function('Byte-compiled "%s" as %s' %
-                                 (name, filename + 'c'))
+                                 (name, filename))
                 else:
-                    write_file(filename, code, 'w')
+                    write_file(filename, data, 'w')
                     log_function('Compiled "%s" as %s' % (name, filename))
+            finished = True
         finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
             if zip:
                 zip_file.close()
+            if old_zip_file is not None:
+                old_zip_file.close()
+                if finished:
+                    os.remove(target)
+                    os.rename(zip_target, target)
+                else:
+                    os.remove(zip_target)
+
+        if manifest is not None:
+            _write_compile_manifest(manifest_filename, manifest)
 
         log_function('Finished compiling templates')
 
+    def _plan_incremental_compile(self, names, entries):
+        """Decides which templates an incremental :meth:`compile_templates`
+        has to compile.  `entries` are the template entries of the old
+        manifest.  Returns the names that need compiling (in the order of
+        `names`), the names of removed templates and the new entries.
+        """
+        new_entries = {}
+        dirty = set()
+        for name in names:
+            source, _, _ = self.loader.get_source(self, name)
+            checksum = sha1(source.encode('utf-8')).hexdigest()
+            entry = entries.get(name)
+            if entry is not None and entry['checksum'] == checksum:
+                new_entries[name] = entry
+                continue
+            dirty.add(name)
+            try:
+                ast = self._parse(source, name, None)
+            except TemplateSyntaxError:
+                dependencies = []
+            else:
+                dependencies = sorted(set(x for x in
+                                          find_referenced_templates(ast)
+                                          if x is not None))
+            new_entries[name] = {'checksum': checksum,
+                                 'dependencies': dependencies}
+
+        removed = set(entries) - set(new_entries)
+        dirty.update(removed)
+
+        # templates depending on a changed template are compiled too
+        dependents = {}
+        for name, entry in iteritems(new_entries):
+            for dependency in entry['dependencies']:
+                dependents.setdefault(dependency, set()).add(name)
+        todo = list(dirty)
+        while todo:
+            for name in dependents.get(todo.pop(), ()):
+                if name not in dirty:
+                    dirty.add(name)
+                    todo.append(name)
+
+        return [x for x in names if x in dirty], removed, new_entries
+
+    def _compile_module(self, name, py_compile=False):
+        """Compiles the template with the given name for the module loader.
+        Returns the filename in the module folder and the generated source
+        code or, if `py_compile` is enabled, the marshalled bytecode.  This
+        is used by :meth:`compile_templates`.
+        """
+        from jinja2.loaders import ModuleLoader
+        source, filename, _ = self.loader.get_source(self, name)
+        code = self.compile(source, name, filename, True, True)
+        filename = ModuleLoader.get_module_filename(name)
+        if py_compile:
+            import marshal
+            c = self._compile(code, encode_filename(filename))
+            return filename + 'c', marshal.dumps(c)
+        return filename, code
+
     def list_templates(self, extensions=None, filter_func=None):
         """Returns a list of templates for this environment.  This requires
         that the loader supports the loader's
@@ -793,18 +1225,238 @@ class Environment(object):
 
     @internalcode
     def _load_template(self, name, globals):
+        template = self._get_cached_template(name)
+        if template is None:
+            if self.metrics is not None:
+                self.metrics.increment('template_cache.miss', name)
+            template = self._get_shared_template(name, globals)
+            if template is None:
+                template = self.loader.load(self, name, globals)
+            self._cache_template(name, template)
+        elif self.metrics is not None:
+            self.metrics.increment('template_cache.hit', name)
+        return template
+
+    def _code_signature(self):
+        """Environments with equal signatures generate the same code for a
+        template.  This covers everything the parser, optimizer and code
+        generator look at.
+        """
+        return (self.__class__,
+                self.code_generator_class,
+                get_lexer_key(self),
+                tuple(sorted(self.extensions)),
+                self.optimized,
+                self.autoescape,
+                _finalize_shape(self.finalize),
+                self.is_async,
+                self.filters,
+                self.tests,
+                self.policies,
+                getattr(self, 'intercepted_binops', None),
+                getattr(self, 'intercepted_unops', None))
+
+    def profile(self):
+        """Returns a :class:`~jinja2.profiler.RenderProfiler` that records
+        the time spent on the lines of the templates of this environment
+        while it's active::
+
+            with env.profile() as profiler:
+                template.render()
+            profiler.dump_stats('render.prof')
+
+        .. versionadded:: 2.10
+        """
+        from jinja2.profiler import RenderProfiler
+        return RenderProfiler(self)
+
+    def shares_code_with(self, other):
+        """Returns `True` if this environment generates the same code for
+        templates as `other`.  Overlays that only change runtime settings
+        like the globals or the undefined type share the compiled code
+        of templates with the environment they were created from and the
+        other overlays of it.
+
+        .. versionadded:: 2.10
+        """
+        return self is other or \
+            self._code_signature() == other._code_signature()
+
+    def _get_shared_template(self, name, globals):
+        """Creates the template from the code another environment compiled
+        for it if the code can be shared.
+        """
+        if self.cache is None:
+            return None
+        key = (weakref.ref(self.loader), name)
+        other = self._shared_templates.get(key)
+        # templates stay alive in reference cycles after they were removed
+        # from the cache, so only templates that are still cached by their
+        # environment are shared.  Clearing the cache is the way to reload
+        # templates without `auto_reload`, so outdated templates are never
+        # shared.
+        if other is None or other.environment.cache is None or \
+           key not in other.environment.cache or \
+           not self.shares_code_with(other.environment) or \
+           not other.is_up_to_date:
+            return None
+        return self.template_class.from_code(self, other._code, globals,
+                                             other._uptodate)
+
+    def _get_cached_template(self, name):
         if self.loader is None:
             raise TypeError('no loader for this environment specified')
-        cache_key = (weakref.ref(self.loader), name)
         if self.cache is not None:
-            template = self.cache.get(cache_key)
+            template = self.cache.get((weakref.ref(self.loader), name))
             if template is not None and (not self.auto_reload or
-                                         template.is_up_to_date):
+                                         self._is_up_to_date(template)):
                 return template
-        template = self.loader.load(self, name, globals)
+
+    def _cache_template(self, name, template):
+        self.dependency_graph.set_dependencies(
+            name, template._referenced_templates)
         if self.cache is not None:
-            self.cache[cache_key] = template
-        return template
+            if self.auto_reload_interval:
+                template._last_checked = time.time()
+            key = (weakref.ref(self.loader), name)
+            self.cache[key] = template
+            if getattr(template, '_code', None) is not None:
+                self._shared_templates[key] = template
+
+    def _is_up_to_date(self, template):
+        """Checks if a cached template is up to date but only asks the
+        loader once within the `auto_reload_interval`.
+        """
+        if not self.auto_reload_interval:
+            return template.is_up_to_date
+        now = time.time()
+        if now - template._last_checked < self.auto_reload_interval:
+            return True
+        if not template.is_up_to_date:
+            return False
+        template._last_checked = now
+        return True
+
+    def get_dependents(self, name, transitive=True):
+        """Returns the names of the loaded templates that extend, include or
+        import the template `name`.  Unless `transitive` is disabled this
+        includes templates that depend on it through other templates.
+        Dependencies are only known for templates that were loaded through
+        the loader and for hardcoded template names.
+
+        .. versionadded:: 2.10
+        """
+        return sorted(self.dependency_graph.get_dependents(name, transitive))
+
+    def invalidate_template(self, name, dependents=True):
+        """Removes the template `name` and, unless `dependents` is disabled,
+        all templates that depend on it from the template cache and the
+        bytecode cache.  Returns the names of the templates that were
+        removed from the template cache.
+
+        .. versionadded:: 2.10
+        """
+        if self.cache is None:
+            return []
+        names = set([name])
+        if dependents:
+            names.update(self.dependency_graph.get_dependents(name))
+        rv = set()
+        for key, template in list(self.cache.items()):
+            if key[1] not in names:
+                continue
+            self._shared_templates.pop(key, None)
+            try:
+                del self.cache[key]
+            except KeyError:
+                continue
+            rv.add(key[1])
+            if self.bytecode_cache is not None:
+                filename = template.filename
+                if filename == '<template>':
+                    filename = None
+                self.bytecode_cache.remove_bucket(self, key[1], filename)
+        return sorted(rv)
+
+    def snapshot_cache(self, filename):
+        """Writes the compiled code of all templates in the template cache
+        to `filename` so that another process can fill its cache with
+        :meth:`restore_cache` instead of loading and compiling the templates
+        on first use, for example after a deployment.  Templates that are
+        outdated or were not compiled from source (like the ones from the
+        :class:`ModuleLoader`) are left out.  Returns the number of templates
+        in the snapshot.
+
+        .. versionadded:: 2.10
+        """
+        entries = []
+        if self.cache is not None and self.loader is not None:
+            # least recently used first so restoring keeps the order
+            for key, template in reversed(list(self.cache.items())):
+                if key[0]() is not self.loader or \
+                   template._code is None or not template.is_up_to_date:
+                    continue
+                mtime = checksum = None
+                if template.filename is not None and \
+                   os.path.isfile(template.filename):
+                    mtime = os.path.getmtime(template.filename)
+                else:
+                    source = self.loader.get_source(self, key[1])[0]
+                    checksum = sha1(source.encode('utf-8')).hexdigest()
+                entries.append((key[1], template._code, mtime, checksum))
+        with open(filename, 'wb') as f:
+            f.write(_snapshot_magic + bc_magic)
+            marshal.dump(entries, f)
+        return len(entries)
+
+    def restore_cache(self, filename):
+        """Loads the templates from a snapshot written by
+        :meth:`snapshot_cache` into the template cache without asking the
+        loader.  Snapshots of another Jinja2 or Python version are ignored.
+        If :attr:`auto_reload` is enabled the templates are checked against
+        the modification time of their files, or the loader source for
+        templates that were not loaded from files.  Templates are restored
+        with the globals of the environment.  Returns the number of restored
+        templates.
+
+        .. versionadded:: 2.10
+        """
+        if self.loader is None:
+            raise TypeError('no loader for this environment specified')
+        if self.cache is None:
+            return 0
+        header = _snapshot_magic + bc_magic
+        with open(filename, 'rb') as f:
+            if f.read(len(header)) != header:
+                return 0
+            try:
+                entries = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                return 0
+        globals = self.make_globals(None)
+        for name, code, mtime, checksum in entries:
+            template = self.template_class.from_code(
+                self, code, globals,
+                self._make_snapshot_uptodate(name, code.co_filename,
+                                             mtime, checksum))
+            self._cache_template(name, template)
+        return len(entries)
+
+    def _make_snapshot_uptodate(self, name, filename, mtime, checksum):
+        if mtime is not None:
+            def uptodate():
+                try:
+                    return os.path.getmtime(filename) == mtime
+                except OSError:
+                    return False
+        else:
+            def uptodate():
+                try:
+                    source = self.loader.get_source(self, name)[0]
+                except TemplateNotFound:
+                    return False
+                return sha1(source.encode('utf-8')).hexdigest() == checksum
+        return uptodate
 
     @internalcode
     def get_template(self, name, parent=None, globals=None):
@@ -871,6 +1523,37 @@ class Environment(object):
             return template_name_or_list
         return self.select_template(template_name_or_list, parent, globals)
 
+    def get_template_async(self, name, parent=None, globals=None):
+        """An async version of :meth:`get_template`.  The template is loaded
+        through the async hooks of the loader and bytecode cache (see
+        :meth:`BaseLoader.load_async`).  Templates compiled in async mode use
+        this to load the templates they extend, include or import.
+
+        .. versionadded:: 2.10
+        """
+        # see asyncsupport for the actual implementation
+        raise NotImplementedError('This feature is not available for this '
+                                  'version of Python')
+
+    def select_template_async(self, names, parent=None, globals=None):
+        """An async version of :meth:`select_template`.
+
+        .. versionadded:: 2.10
+        """
+        # see asyncsupport for the actual implementation
+        raise NotImplementedError('This feature is not available for this '
+                                  'version of Python')
+
+    def get_or_select_template_async(self, template_name_or_list,
+                                     parent=None, globals=None):
+        """An async version of :meth:`get_or_select_template`.
+
+        .. versionadded:: 2.10
+        """
+        # see asyncsupport for the actual implementation
+        raise NotImplementedError('This feature is not available for this '
+                                  'version of Python')
+
     def from_string(self, source, globals=None, template_class=None):
         """Load a template from a string.  This parses the source given and
         returns a :class:`Template` object.
@@ -956,6 +1639,7 @@ class Template(object):
         exec(code, namespace)
         rv = cls._from_namespace(environment, namespace, globals)
         rv._uptodate = uptodate
+        rv._code = code
         return rv
 
     @classmethod
@@ -975,6 +1659,7 @@ class Template(object):
         t.name = namespace['name']
         t.filename = namespace['__file__']
         t.blocks = namespace['blocks']
+        t._referenced_templates = namespace.get('referenced_templates', ())
 
         # render function and module
         t.root_render_func = namespace['root']
@@ -983,6 +1668,8 @@ class Template(object):
         # debug and loader helpers
         t._debug_info = namespace['debug_info']
         t._uptodate = None
+        t._last_checked = 0
+        t._code = None
 
         # store the reference
         namespace['environment'] = environment
@@ -1001,10 +1688,54 @@ class Template(object):
         This will return the rendered template as unicode string.
         """
         vars = dict(*args, **kwargs)
+        metrics = self.environment.metrics
+        if metrics is not None:
+            start = default_timer()
+        try:
+            rv = concat(self.root_render_func(self.new_context(vars)))
+        except Exception:
+            exc_info = sys.exc_info()
+        else:
+            if metrics is not None:
+                metrics.timing('render', default_timer() - start, self.name)
+            return rv
+        if metrics is not None:
+            metrics.increment('render.error', self.name)
+        return self.environment.handle_exception(exc_info, True)
+
+    def render_to(self, fp, *args, **kwargs):
+        """Renders the template like :meth:`render` but passes the output
+        to `fp` piece by piece instead of joining it into a string.  `fp`
+        can be a file-like object with a `write` method or a callable.  To
+        write into a binary file wrap it in a writer of :mod:`codecs`::
+
+            template.render_to(codecs.getwriter('utf-8')(f), seq=rows)
+
+        If the ``compiler.write_functions`` policy is enabled when the
+        template is compiled the template code calls the `write` function
+        itself, without going through a generator.
+
+        .. versionadded:: 2.10
+        """
+        write = getattr(fp, 'write', fp)
+        if self.environment.is_async:
+            for event in self.generate(*args, **kwargs):
+                write(event)
+            return
+        vars = dict(*args, **kwargs)
+        metrics = self.environment.metrics
+        if metrics is not None:
+            start = default_timer()
         try:
-            return concat(self.root_render_func(self.new_context(vars)))
+            write_events(self.root_render_func, self.new_context(vars), write)
         except Exception:
             exc_info = sys.exc_info()
+        else:
+            if metrics is not None:
+                metrics.timing('render', default_timer() - start, self.name)
+            return
+        if metrics is not None:
+            metrics.increment('render.error', self.name)
         return self.environment.handle_exception(exc_info, True)
 
     def render_async(self, *args, **kwargs):
@@ -1220,7 +1951,7 @@ class TemplateStream(object):
             close = True
         try:
             if encoding is not None:
-                iterable = (x.encode(encoding, errors) for x in self)
+                iterable = self.iter_encoded(encoding, errors)
             else:
                 iterable = self
             if hasattr(fp, 'writelines'):
@@ -1232,37 +1963,99 @@ class TemplateStream(object):
             if close:
                 fp.close()
 
+    def iter_encoded(self, encoding='utf-8', errors='strict', size=8192,
+                     interval=None):
+        """Iterate over the stream as encoded bytestrings.  The stream is
+        encoded into a buffer that is yielded once it holds at least `size`
+        bytes, so the chunks can be passed to a socket as they are.  If
+        `interval` is given a chunk is also yielded if more than `interval`
+        seconds passed since the first byte went into the buffer.  This is
+        checked whenever the template produces output, so output generated
+        before a slow part of the template is sent once the slow part is
+        done at the latest.
+
+        The encoding is stateful across chunks, encodings with a byte order
+        mark only write it once.
+
+        .. versionadded:: 2.10
+        """
+        if size < 1:
+            raise ValueError('buffer size too small')
+        encode = codecs.getincrementalencoder(encoding)(errors).encode
+        buf = bytearray()
+        started = None
+
+        for item in self:
+            if not item:
+                continue
+            buf += encode(item)
+            if interval is not None and started is None:
+                started = time.time()
+            if len(buf) >= size or (started is not None and
+                                    time.time() - started >= interval):
+                yield bytes(buf)
+                del buf[:]
+                started = None
+
+        buf += encode(u'', True)
+        if buf:
+            yield bytes(buf)
+
     def disable_buffering(self):
         """Disable the output buffering."""
         self._next = partial(next, self._gen)
         self.buffered = False
 
-    def _buffered_generator(self, size):
+    def _buffered_generator(self, size, chars, interval):
         buf = []
         c_size = 0
+        c_chars = 0
+        started = None
         push = buf.append
 
         while 1:
             try:
-                while c_size < size:
+                while (size is None or c_size < size) and \
+                      (chars is None or c_chars < chars) and \
+                      (started is None or time.time() - started < interval):
                     c = next(self._gen)
                     push(c)
                     if c:
                         c_size += 1
+                        c_chars += len(c)
+                        if interval is not None and started is None:
+                            started = time.time()
             except StopIteration:
                 if not c_size:
                     return
             yield concat(buf)
             del buf[:]
             c_size = 0
+            c_chars = 0
+            started = None
 
-    def enable_buffering(self, size=5):
-        """Enable buffering.  Buffer `size` items before yielding them."""
-        if size <= 1:
+    def enable_buffering(self, size=5, chars=None, interval=None):
+        """Enable buffering.  Buffer `size` items before yielding them.
+
+        If `chars` is given the buffer is also yielded once the buffered
+        items have at least that many characters.  To buffer by characters
+        only `size` can be set to `None`.  If `interval` is given the buffer
+        is yielded once an item arrives more than `interval` seconds after
+        the first item was buffered.
+
+        .. versionchanged:: 2.10
+           Added the `chars` and `interval` parameters.
+        """
+        if size is None and chars is None:
+            raise TypeError('either size or chars has to be given')
+        if size is not None and size <= 1:
+            raise ValueError('buffer size too small')
+        if chars is not None and chars < 1:
             raise ValueError('buffer size too small')
 
         self.buffered = True
-        self._next = partial(next, self._buffered_generator(size))
+        self._next = partial(next, self._buffered_generator(size, chars,
+                                                            interval))
 
     def __iter__(self):
         return self
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja2.incremental
+    ~~~~~~~~~~~~~~~~~~
+
+    Re-parses edited templates incrementally.  Trees created by
+    :meth:`~jinja2.Environment.reparse` remember the source offset every
+    top-level node starts at.  After an edit only the top-level nodes
+    around the changed region are lexed and parsed again, the nodes before
+    and after it are taken over from the previous tree.
+
+    :copyright: (c) 2017 by the Jinja Team.
+    :license: BSD, see LICENSE for more details.
+"""
+from bisect import bisect_left
+from collections import deque
+from jinja2 import nodes
+from jinja2.ext import Extension
+from jinja2.lexer import CombinedLexer, Token, TokenStream, new_token, \
+     ignored_tokens, TOKEN_DATA, TOKEN_BLOCK_BEGIN, TOKEN_VARIABLE_BEGIN, \
+     TOKEN_RAW_BEGIN, TOKEN_RAW_END, TOKEN_COMMENT_BEGIN, \
+     TOKEN_LINESTATEMENT_BEGIN, TOKEN_LINECOMMENT_BEGIN
+from jinja2.parser import Parser
+
+
+# tokens the lexer emits while it is in the root state.  Lexing can be
+# restarted in the root state at the offset of any of these tokens.
+_root_tokens = frozenset([TOKEN_DATA, TOKEN_BLOCK_BEGIN, TOKEN_VARIABLE_BEGIN,
+                          TOKEN_RAW_BEGIN, TOKEN_COMMENT_BEGIN,
+                          TOKEN_LINESTATEMENT_BEGIN,
+                          TOKEN_LINECOMMENT_BEGIN])
+
+# tokens that are not passed on by `Lexer.wrap`
+_dropped_tokens = ignored_tokens | frozenset([TOKEN_RAW_BEGIN, TOKEN_RAW_END])
+
+
+class ParseState(object):
+    """Attached to trees created by :func:`reparse` as `_incremental`.
+    `starts` holds the offset in the prepared `source` every node of `body`
+    starts at.
+    """
+
+    def __init__(self, source, body, starts, last_identifier):
+        self.source = source
+        self.body = body
+        self.starts = starts
+        self.last_identifier = last_identifier
+
+    def matches(self, tree, source):
+        """Is this the state of `tree` parsed from `source`?  The body is
+        compared by identity as the tree might have been modified.
+        """
+        body = tree.body
+        if len(body) != len(self.body) or self.source != source:
+            return False
+        for a, b in zip(body, self.body):
+            if a is not b:
+                return False
+        return True
+
+
+def is_supported(environment):
+    """Incremental parsing needs the offsets of the tokens in the source.
+    They are not known if extensions preprocess the source or rewrite the
+    token stream.
+    """
+    if not isinstance(environment.lexer, CombinedLexer):
+        return False
+    for extension in environment.iter_extensions():
+        cls = type(extension)
+        for attr in 'preprocess', 'filter_stream':
+            func = getattr(cls, attr)
+            default = getattr(Extension, attr)
+            if getattr(func, '__func__', func) is not \
+               getattr(default, '__func__', default):
+                return False
+    return True
+
+
+def _track_offsets(stream, pos, offsets):
+    """Passes the raw tokens of `stream` through and appends the offset of
+    every token kept by `Lexer.wrap` to `offsets`.  Dropped tokens that
+    were lexed in the root state (comments, raw blocks) are accounted to
+    the next kept token.  Tokens that are not lexed in the root state get
+    `None` as offset.
+    """
+    in_raw = False
+    pending = None
+    for token in stream:
+        kind = token[1]
+        if kind in _root_tokens and not (in_raw and kind == TOKEN_DATA):
+            offset = pos
+        else:
+            offset = None
+        if kind in _dropped_tokens:
+            if kind == TOKEN_RAW_BEGIN:
+                in_raw = True
+            elif kind == TOKEN_RAW_END:
+                in_raw = False
+            if pending is None:
+                pending = offset
+        elif pending is not None:
+            offsets.append(pending)
+            pending = None
+        else:
+            offsets.append(offset)
+        pos += len(token[2])
+        yield token
+
+
+def tokenize(environment, source, pos, lineno, name, filename):
+    """Lexes the prepared `source` from `pos` on.  The tokens carry their
+    offset in the source as fourth item.
+    """
+    lexer = environment.lexer
+    offsets = deque()
+    pop_offset = offsets.popleft
+    stream = _track_offsets(lexer._tokeniter(source, name, filename, None,
+                                             False, pos, lineno),
+                            pos, offsets)
+
+    def generate():
+        for token in lexer.wrap(stream, name, filename):
+            yield new_token(Token, token + (pop_offset(),))
+    return TokenStream(generate(), name, filename)
+
+
+class RegionParser(Parser):
+    """Parses top-level nodes from a stream created by :func:`tokenize`."""
+
+    def __init__(self, environment, stream, name, filename,
+                 last_identifier=0):
+        Parser.__init__(self, environment, u'', name, filename)
+        self.stream = stream
+        self._last_identifier = last_identifier
+
+    def parse_nodes(self, resume=None):
+        """Parses top-level nodes like :meth:`subparse` and records their
+        offsets.  Before every node `resume` is called with the offset of
+        the node.  If it returns something other than `None` parsing stops
+        and the value is returned as third item next to the nodes and
+        their offsets.
+        """
+        body = []
+        starts = []
+        data_buffer = []
+        add_data = data_buffer.append
+        start = None
+
+        def flush_data():
+            if data_buffer:
+                lineno = data_buffer[0].lineno
+                body.append(nodes.Output(data_buffer[:], lineno=lineno))
+                starts.append(start)
+                del data_buffer[:]
+
+        while self.stream:
+            token = self.stream.current
+            if token.type == 'block_begin':
+                flush_data()
+                start = None
+            if start is None:
+                start = token[3]
+                if resume is not None:
+                    rv = resume(start)
+                    if rv is not None:
+                        return body, starts, rv
+            if token.type == 'data':
+                if token.value:
+                    add_data(nodes.TemplateData(token.value,
+                                                lineno=token.lineno))
+                next(self.stream)
+            elif token.type == 'variable_begin':
+                next(self.stream)
+                add_data(self.parse_tuple(with_condexpr=True))
+                self.stream.expect('variable_end')
+            elif token.type == 'block_begin':
+                next(self.stream)
+                rv = self.parse_statement()
+                if not isinstance(rv, list):
+                    rv = [rv]
+                body.extend(rv)
+                starts.extend([start] * len(rv))
+                self.stream.expect('block_end')
+                start = None
+            else:
+                raise AssertionError('internal parsing error')
+
+        flush_data()
+        return body, starts, None
+
+
+def _shift_lines(node, offset):
+    todo = deque([node])
+    while todo:
+        node = todo.popleft()
+        if node.lineno is not None:
+            node.lineno += offset
+        todo.extend(node.iter_child_nodes())
+
+
+def _make_tree(environment, body, state):
+    rv = nodes.Template(body, lineno=1)
+    rv.environment = environment
+    rv._incremental = state
+    return rv
+
+
+def parse(environment, source, name, filename):
+    """Parses the prepared `source` into a tree that can be re-parsed."""
+    parser = RegionParser(environment, tokenize(environment, source, 0, 1,
+                                                name, filename),
+                          name, filename)
+    body, starts, _ = parser.parse_nodes()
+    for node in body:
+        node.set_environment(environment)
+    return _make_tree(environment, body, ParseState(
+        source, list(body), starts, parser._last_identifier))
+
+
+def reparse(environment, tree, source, start, end, text, name=None,
+            filename=None):
+    """Implements :meth:`~jinja2.Environment.reparse`."""
+    new_source = source[:start] + text + source[end:]
+    if not is_supported(environment):
+        return environment._parse(new_source, name, filename)
+
+    lexer = environment.lexer
+    old = lexer._prepare_source(source)
+    new = lexer._prepare_source(new_source)
+    state = getattr(tree, '_incremental', None)
+    if state is None or not state.matches(tree, old) or \
+       not source.startswith(old) or not new_source.startswith(new):
+        return parse(environment, new, name, filename)
+
+    # the edit in offsets of the prepared sources.  As long as no line
+    # breaks were converted they only differ by a trailing newline.
+    start = min(start, len(old))
+    old_end = min(end, len(old))
+    new_end = min(start + len(text), len(new))
+    delta = len(new) - len(old)
+    line_offset = new.count('\n', start, new_end) - \
+        old.count('\n', start, old_end)
+
+    # the first node to parse again is the one the edit starts in, or the
+    # one in front of it if the edit starts at a node boundary.  If that
+    # node follows an output node the new data might be merged into it.
+    starts = state.starts
+    first = max(bisect_left(starts, start) - 1, 0)
+    if first > 0 and isinstance(tree.body[first - 1], nodes.Output):
+        first -= 1
+    if starts:
+        first = bisect_left(starts, starts[first])
+        pos = starts[first]
+    else:
+        pos = 0
+
+    def resume(offset):
+        # parsing can stop at a node boundary behind the edit that was a
+        # node boundary before as well.  The lexer looks at the character
+        # in front of a tag for `lstrip_blocks` and line comments, so that
+        # one must not be part of the edit either.
+        if offset is None or offset <= new_end:
+            return None
+        idx = bisect_left(starts, offset - delta)
+        if idx < len(starts) and starts[idx] == offset - delta:
+            return idx
+
+    parser = RegionParser(environment,
+                          tokenize(environment, new, pos,
+                                   new.count('\n', 0, pos) + 1,
+                                   name, filename),
+                          name, filename, state.last_identifier)
+    body, new_starts, stop = parser.parse_nodes(resume)
+    if stop is None:
+        stop = len(starts)
+    for node in body:
+        node.set_environment(environment)
+
+    tail = tree.body[stop:]
+    if line_offset:
+        for node in tail:
+            _shift_lines(node, line_offset)
+    body = tree.body[:first] + body + tail
+    new_starts = starts[:first] + new_starts + \
+        [x + delta for x in starts[stop:]]
+    return _make_tree(environment, body, ParseState(
+        new, list(body), new_starts, parser._last_identifier))
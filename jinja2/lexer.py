@@ -28,6 +28,9 @@ from jinja2._compat import iteritems, implements_iterator, text_type, intern
 # environments with the same lexer
 _lexer_cache = LRUCache(50)
 
+# creates tokens without going through `Token.__new__`
+new_token = tuple.__new__
+
 # static regular expressions
 whitespace_re = re.compile(r'\s+', re.U)
 string_re = re.compile(r"('([^'\\]*(?:\\.[^'\\]*)*)'"
@@ -61,6 +64,9 @@ del _make_name_re
 float_re = re.compile(r'(?<!\.)\d+\.\d+')
 newline_re = re.compile(r'(\r\n|\r|\n)')
 
+# all line breaks recognized by `unicode.splitlines` except for ``\n``
+line_break_re = re.compile(u'\r\n|[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+
 # internal the tokens and keep references to them
 TOKEN_ADD = intern('add')
 TOKEN_ASSIGN = intern('assign')
@@ -156,6 +162,21 @@ ignore_if_empty = frozenset([TOKEN_WHITESPACE, TOKEN_DATA,
                              TOKEN_COMMENT, TOKEN_LINECOMMENT])
 
 
+# lexing rules for the inside of tags.  They are the same for all lexers.
+_tag_rules = (
+    (whitespace_re, TOKEN_WHITESPACE, None),
+    (float_re, TOKEN_FLOAT, None),
+    (integer_re, TOKEN_INTEGER, None),
+    (name_re, TOKEN_NAME, None),
+    (string_re, TOKEN_STRING, None),
+    (sequence_re, TOKEN_SEQUENCE, None),
+    (operator_re, TOKEN_OPERATOR, None)
+)
+
+# the tag rules compiled for the combined lexer, created on first use
+_combined_tag_rules = None
+
+
 def _describe_token_type(token_type):
     if token_type in reverse_operators:
         return reverse_operators[token_type]
@@ -236,6 +257,12 @@ class Failure(object):
         raise self.error_class(self.message, lineno, filename)
 
 
+# token expressions with a value split into type and value.  The parser
+# builds some expressions from template content (like the names of blocks)
+# so the cache has to be bounded.
+_token_expressions = LRUCache(200)
+
+
 class Token(tuple):
     """Token class."""
     __slots__ = ()
@@ -261,7 +288,12 @@ class Token(tuple):
         if self.type == expr:
             return True
         elif ':' in expr:
-            return expr.split(':', 1) == [self.type, self.value]
+            try:
+                type, value = _token_expressions[expr]
+            except KeyError:
+                type, value = _token_expressions[expr] = \
+                    tuple(expr.split(':', 1))
+            return self.type == type and self.value == value
         return False
 
     def test_any(self, *iterable):
@@ -392,23 +424,30 @@ class TokenStream(object):
             next(self)
 
 
+def get_lexer_key(environment):
+    """Return the key of the lexer configuration of the environment.
+    Environments with the same key share a lexer.
+    """
+    return (environment.block_start_string,
+            environment.block_end_string,
+            environment.variable_start_string,
+            environment.variable_end_string,
+            environment.comment_start_string,
+            environment.comment_end_string,
+            environment.line_statement_prefix,
+            environment.line_comment_prefix,
+            environment.trim_blocks,
+            environment.lstrip_blocks,
+            environment.newline_sequence,
+            environment.keep_trailing_newline)
+
+
 def get_lexer(environment):
     """Return a lexer which is probably cached."""
-    key = (environment.block_start_string,
-           environment.block_end_string,
-           environment.variable_start_string,
-           environment.variable_end_string,
-           environment.comment_start_string,
-           environment.comment_end_string,
-           environment.line_statement_prefix,
-           environment.line_comment_prefix,
-           environment.trim_blocks,
-           environment.lstrip_blocks,
-           environment.newline_sequence,
-           environment.keep_trailing_newline)
+    key = get_lexer_key(environment)
     lexer = _lexer_cache.get(key)
     if lexer is None:
-        lexer = Lexer(environment)
+        lexer = CombinedLexer(environment)
         _lexer_cache[key] = lexer
     return lexer
 
@@ -428,15 +467,7 @@ class Lexer(object):
         e = re.escape
 
         # lexing rules for tags
-        tag_rules = [
-            (whitespace_re, TOKEN_WHITESPACE, None),
-            (float_re, TOKEN_FLOAT, None),
-            (integer_re, TOKEN_INTEGER, None),
-            (name_re, TOKEN_NAME, None),
-            (string_re, TOKEN_STRING, None),
-            (sequence_re, TOKEN_SEQUENCE, None),
-            (operator_re, TOKEN_OPERATOR, None)
-        ]
+        tag_rules = list(_tag_rules)
 
         # assemble the root lexing rule. because "|" is ungreedy
         # we have to sort by length so that the lexer continues working
@@ -551,8 +582,24 @@ class Lexer(object):
             ]
         }
 
+    def _prepare_source(self, source):
+        """Converts the source to unicode with ``\\n`` line endings and
+        removes the trailing newline unless it should be kept.  Line breaks
+        are the ones recognized by `unicode.splitlines`.  Sources that only
+        use ``\\n`` are not copied.
+        """
+        source = text_type(source)
+        keep = self.keep_trailing_newline and source.endswith(('\r', '\n'))
+        if line_break_re.search(source) is not None:
+            source = line_break_re.sub('\n', source)
+        if not keep and source.endswith('\n'):
+            source = source[:-1]
+        return source
+
     def _normalize_newlines(self, value):
         """Called for strings and template data to normalize it to unicode."""
+        if self.newline_sequence == '\n' and '\r' not in value:
+            return value
         return newline_re.sub(self.newline_sequence, value)
 
     def tokenize(self, source, name=None, filename=None, state=None):
@@ -596,20 +643,14 @@ class Lexer(object):
                 value = float(value)
             elif token == 'operator':
                 token = operators[value]
-            yield Token(lineno, token, value)
+            # the token types are strings already, skip `Token.__new__`
+            yield new_token(Token, (lineno, intern(token), value))
 
     def tokeniter(self, source, name, filename=None, state=None):
         """This method tokenizes the text and returns the tokens in a
         generator.  Use this method if you just want to tokenize a template.
         """
-        source = text_type(source)
-        lines = source.splitlines()
-        if self.keep_trailing_newline and source:
-            for newline in ('\r\n', '\r', '\n'):
-                if source.endswith(newline):
-                    lines.append('')
-                    break
-        source = '\n'.join(lines)
+        source = self._prepare_source(source)
         pos = 0
         lineno = 1
         stack = ['root']
@@ -739,3 +780,280 @@ class Lexer(object):
                 raise TemplateSyntaxError('unexpected char %r at %d' %
                                           (source[pos], pos), lineno,
                                           name, filename)
+
+
+def _sensitive_flags(pattern):
+    """Returns the regular expression flags that change the meaning of
+    `pattern`, or `None` if the pattern uses numbered backreferences and
+    cannot be combined with other patterns.
+    """
+    rv = 0
+    in_class = False
+    pos = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == '\\':
+            escaped = pattern[pos + 1:pos + 2]
+            if escaped.isdigit() and not in_class:
+                return None
+            if escaped and escaped in 'wWbBdDsS':
+                rv |= re.U
+            pos += 2
+            continue
+        if in_class:
+            if char == ']':
+                in_class = False
+        elif char == '[':
+            in_class = True
+            # a closing bracket right after the opening one is literal
+            if pattern[pos + 1:pos + 2] == '^':
+                pos += 1
+            if pattern[pos + 1:pos + 2] == ']':
+                pos += 1
+        elif char == '.':
+            rv |= re.S
+        elif char in '^$':
+            rv |= re.M
+        pos += 1
+    return rv
+
+
+# the kinds of lexer rules the combined lexer distinguishes
+_RULE_SIMPLE = 0
+_RULE_OPERATOR = 1
+_RULE_GROUPS = 2
+
+
+class _Segment(object):
+    """A group of consecutive lexer rules that is matched with a single
+    regular expression.  Every rule is wrapped in a named group so the rule
+    that matched can be looked up by `lastgroup`.
+    """
+
+    def __init__(self):
+        self.rules = []
+        self.mask = 0
+        self.flags = 0
+        self.other_flags = None
+        self.group_names = set()
+
+    def accepts(self, regex, sensitive):
+        if not self.rules:
+            return True
+        if sensitive is None or self.mask is None:
+            return False
+        other_flags = regex.flags & ~(re.M | re.S | re.U)
+        common = sensitive & self.mask
+        return other_flags == self.other_flags and \
+            regex.flags & common == self.flags & common and \
+            not self.group_names.intersection(regex.groupindex)
+
+    def add(self, rule, sensitive):
+        regex = rule[0]
+        self.rules.append(rule)
+        self.other_flags = regex.flags & ~(re.M | re.S | re.U)
+        self.group_names.update(regex.groupindex)
+        if sensitive is None:
+            self.mask = None
+        else:
+            self.mask |= sensitive
+            self.flags |= regex.flags & sensitive
+
+    def compile(self):
+        """Returns the regular expression, a dict that maps the name of the
+        wrapping group to the rule and the rule itself if the segment only
+        has one rule that is not wrapped.
+        """
+        if len(self.rules) == 1 and self.mask is None:
+            return self.rules[0][0], {}, _make_rule(self.rules[0], 0)
+        patterns = []
+        dispatch = {}
+        offset = 1
+        for idx, rule in enumerate(self.rules):
+            key = '_rule%d' % idx
+            patterns.append('(?P<%s>%s)' % (key, rule[0].pattern))
+            dispatch[key] = _make_rule(rule, offset)
+            offset += rule[0].groups + 1
+        regex = re.compile('|'.join(patterns), self.other_flags | self.flags)
+        return regex, dispatch, None
+
+
+def _make_rule(rule, offset):
+    """Converts a lexer rule into the tuple used by the combined lexer:
+    ``(kind, tokens, new_state, offset, group_names, skip_if_empty,
+    ignored)`` where `offset` is the index of the group that holds the whole
+    match and `ignored` is true for tokens the parser never sees.
+    """
+    regex, tokens, new_state = rule
+    if isinstance(tokens, tuple):
+        kind = _RULE_GROUPS
+    elif tokens == 'operator':
+        kind = _RULE_OPERATOR
+    else:
+        kind = _RULE_SIMPLE
+    group_names = [x[0] for x in sorted(iteritems(regex.groupindex),
+                                        key=itemgetter(1))]
+    simple = kind != _RULE_GROUPS
+    return (kind, tokens, new_state, offset, group_names,
+            simple and tokens in ignore_if_empty,
+            simple and tokens in ignored_tokens)
+
+
+def _combine_rules(rules):
+    segments = []
+    for rule in rules:
+        sensitive = _sensitive_flags(rule[0].pattern)
+        if not segments or not segments[-1].accepts(rule[0], sensitive):
+            segments.append(_Segment())
+        segments[-1].add(rule, sensitive)
+    return [x.compile() for x in segments]
+
+
+def _combine_state_rules(rules):
+    """Combines the rules of a lexer state.  The tag rules at the end are
+    compiled only once for all lexers because the regular expression for
+    unicode names is expensive to compile.
+    """
+    global _combined_tag_rules
+    rules = list(rules)
+    if tuple(rules[-len(_tag_rules):]) != _tag_rules:
+        return _combine_rules(rules)
+    if _combined_tag_rules is None:
+        _combined_tag_rules = _combine_rules(_tag_rules)
+    return _combine_rules(rules[:-len(_tag_rules)]) + _combined_tag_rules
+
+
+class CombinedLexer(Lexer):
+    """A lexer that produces the same tokens as :class:`Lexer` but compiles
+    the rules of every state into one alternation of named groups.  Instead
+    of trying one regular expression after another it matches once and
+    dispatches on the group that matched.  Rules that cannot share a regular
+    expression (because they need different flags) end up in separate
+    alternations.  This is the lexer returned by :func:`get_lexer`.
+    """
+
+    def __init__(self, environment):
+        Lexer.__init__(self, environment)
+        self.combined_rules = {}
+        for state, rules in iteritems(self.rules):
+            # while braces are open the end of the tag is lexed as operator,
+            # which means the rule for the end tag is skipped.
+            balanced = [x for x in rules if x[1] not in
+                        ('variable_end', 'block_end', 'linestatement_end')]
+            self.combined_rules[state] = (_combine_state_rules(rules),
+                                          _combine_state_rules(balanced))
+
+    def tokenize(self, source, name=None, filename=None, state=None):
+        stream = self._tokeniter(source, name, filename, state, True)
+        return TokenStream(self.wrap(stream, name, filename), name, filename)
+
+    def tokeniter(self, source, name, filename=None, state=None):
+        return self._tokeniter(source, name, filename, state, False)
+
+    def _tokeniter(self, source, name, filename, state, skip_ignored,
+                   pos=None, lineno=1):
+        # with `skip_ignored` tokens that `wrap` drops anyways (whitespace
+        # inside of tags) are not sliced out of the source at all.  If a
+        # `pos` is given the source is already prepared and lexing starts
+        # there at line `lineno`.
+        if pos is None:
+            source = self._prepare_source(source)
+            pos = 0
+        stack = ['root']
+        if state is not None and state != 'root':
+            assert state in ('variable', 'block'), 'invalid state'
+            stack.append(state + '_begin')
+        else:
+            state = 'root'
+        statetokens = self.combined_rules[stack[-1]]
+        source_length = len(source)
+
+        balancing_stack = []
+
+        while 1:
+            for regex, dispatch, rule in statetokens[bool(balancing_stack)]:
+                m = regex.match(source, pos)
+                if m is not None:
+                    break
+            else:
+                # end of text
+                if pos >= source_length:
+                    return
+                raise TemplateSyntaxError('unexpected char %r at %d' %
+                                          (source[pos], pos), lineno,
+                                          name, filename)
+
+            kind, tokens, new_state, offset, groups, skip_if_empty, \
+                ignored = rule or dispatch[m.lastgroup]
+
+            if kind == _RULE_GROUPS:
+                for idx, token in enumerate(tokens):
+                    if token.__class__ is Failure:
+                        raise token(lineno, filename)
+                    elif token == '#bygroup':
+                        for key in groups:
+                            value = m.group(key)
+                            if value is not None:
+                                yield lineno, key, value
+                                lineno += value.count('\n')
+                                break
+                        else:
+                            raise RuntimeError('%r wanted to resolve '
+                                               'the token dynamically'
+                                               ' but no group matched'
+                                               % regex)
+                    else:
+                        data = m.group(offset + idx + 1)
+                        if data or token not in ignore_if_empty:
+                            yield lineno, token, data
+                        lineno += data.count('\n')
+            elif ignored and skip_ignored:
+                lineno += source.count('\n', m.start(offset), m.end(offset))
+            else:
+                data = m.group(offset)
+                if kind == _RULE_OPERATOR:
+                    if data == '{':
+                        balancing_stack.append('}')
+                    elif data == '(':
+                        balancing_stack.append(')')
+                    elif data == '[':
+                        balancing_stack.append(']')
+                    elif data in ('}', ')', ']'):
+                        if not balancing_stack:
+                            raise TemplateSyntaxError('unexpected \'%s\'' %
+                                                      data, lineno, name,
+                                                      filename)
+                        expected_op = balancing_stack.pop()
+                        if expected_op != data:
+                            raise TemplateSyntaxError('unexpected \'%s\', '
+                                                      'expected \'%s\'' %
+                                                      (data, expected_op),
+                                                      lineno, name,
+                                                      filename)
+                if data or not skip_if_empty:
+                    yield lineno, tokens, data
+                lineno += data.count('\n')
+
+            if new_state is not None:
+                if new_state == '#pop':
+                    stack.pop()
+                elif new_state == '#bygroup':
+                    for key in groups:
+                        if m.group(key) is not None:
+                            stack.append(key)
+                            break
+                    else:
+                        raise RuntimeError('%r wanted to resolve the '
+                                           'new state dynamically but'
+                                           ' no group matched' %
+                                           regex)
+                else:
+                    stack.append(new_state)
+                statetokens = self.combined_rules[stack[-1]]
+            # we are still at the same position and no stack change.
+            # this means a loop without break condition, avoid that and
+            # raise error
+            elif m.end() == pos:
+                raise RuntimeError('%r yielded empty string without '
+                                   'stack change' % regex)
+            pos = m.end()
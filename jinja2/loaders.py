@@ -118,6 +118,10 @@ class BaseLoader(object):
         if bcc is not None:
             bucket = bcc.get_bucket(environment, name, filename, source)
             code = bucket.code
+            if environment.metrics is not None:
+                environment.metrics.increment(code is None and
+                                              'bytecode_cache.miss' or
+                                              'bytecode_cache.hit', name)
 
         # if we don't have code so far (not cached, no longer up to
         # date) etc. we compile the template
@@ -134,6 +138,30 @@ class BaseLoader(object):
         return environment.template_class.from_code(environment, code,
                                                     globals, uptodate)
 
+    def get_source_async(self, environment, template):
+        """An async version of :meth:`get_source`.  Loaders that fetch
+        templates over the network can override this to not block the event
+        loop.  The default implementation calls :meth:`get_source`.
+
+        .. versionadded:: 2.10
+        """
+        # see asyncsupport for the actual implementation
+        raise NotImplementedError('This feature is not available for this '
+                                  'version of Python')
+
+    def load_async(self, environment, name, globals=None):
+        """An async version of :meth:`load` that is used by
+        :meth:`Environment.get_template_async`.  It gets the source from
+        :meth:`get_source_async` and uses the async methods of the bytecode
+        cache.  Loaders that override :meth:`load` but not this method are
+        called synchronously.
+
+        .. versionadded:: 2.10
+        """
+        # see asyncsupport for the actual implementation
+        raise NotImplementedError('This feature is not available for this '
+                                  'version of Python')
+
 
 class FileSystemLoader(BaseLoader):
     """Loads templates from the file system.  This loader can find templates
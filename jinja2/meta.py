@@ -73,7 +73,7 @@ def find_referenced_templates(ast):
     to rebuild parts of the website after a layout template has changed.
     """
     for node in ast.find_all((nodes.Extends, nodes.FromImport, nodes.Import,
-                              nodes.Include)):
+                              nodes.Include, nodes.Section)):
         if not isinstance(node.template, nodes.Const):
             # a tuple with some non consts in there
             if isinstance(node.template, (nodes.Tuple, nodes.List)):
@@ -96,7 +96,7 @@ def find_referenced_templates(ast):
         # a tuple or list (latter *should* not happen) made of consts,
         # yield the consts that are strings.  We could warn here for
         # non string values
-        elif isinstance(node, nodes.Include) and \
+        elif isinstance(node, (nodes.Include, nodes.Section)) and \
              isinstance(node.template.value, (tuple, list)):
             for template_name in node.template.value:
                 if isinstance(template_name, string_types):
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja2.metrics
+    ~~~~~~~~~~~~~~
+
+    Sinks for the metrics an environment reports while loading, compiling
+    and rendering templates.  An environment without a sink does not
+    collect anything.
+
+    :copyright: (c) 2017 by the Jinja Team.
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+from bisect import bisect_left
+from threading import Lock
+
+
+default_timer = getattr(time, 'perf_counter', time.time)
+
+#: the default upper bounds (in seconds) of the histogram buckets of the
+#: :class:`MemoryMetrics` sink.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class MetricsSink(object):
+    """The interface of a metrics sink.  Pass an instance as `metrics` to
+    the :class:`~jinja2.Environment` to receive its metrics.  All methods
+    of this class do nothing so subclasses only have to implement what they
+    are interested in, for example forwarding to statsd or Prometheus.
+
+    The `template` is the name of the template the metric belongs to or
+    `None` for templates without a name.  The sink is called from every
+    thread that renders templates.
+    """
+
+    def increment(self, name, template=None, value=1):
+        """Increments the counter `name` by `value`."""
+
+    def timing(self, name, seconds, template=None):
+        """Records a duration of `seconds` for the timer `name`."""
+
+
+class Histogram(object):
+    """The durations recorded for a timer of :class:`MemoryMetrics`.
+    `counts` holds the number of durations that were at most the bound at
+    the same position in `buckets`, the last item counts the durations
+    above the largest bound.
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'total')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    @property
+    def mean(self):
+        """The mean duration or ``0`` if nothing was recorded."""
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def __repr__(self):
+        return '<%s count=%d mean=%f>' % (
+            self.__class__.__name__,
+            self.count,
+            self.mean
+        )
+
+
+class MemoryMetrics(MetricsSink):
+    """A sink that keeps the metrics in memory, mostly useful for tests and
+    for exporting the numbers periodically::
+
+        metrics = MemoryMetrics()
+        env = Environment(loader=loader, metrics=metrics)
+        ...
+        metrics.counter('template_cache.miss', 'index.html')
+        metrics.histogram('render', 'index.html').mean
+
+    Durations are sorted into histogram buckets with the upper bounds
+    given as `buckets`.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        #: maps ``(name, template)`` to the value of the counter
+        self.counters = {}
+        #: maps ``(name, template)`` to a :class:`Histogram`
+        self.timings = {}
+        self._lock = Lock()
+
+    def increment(self, name, template=None, value=1):
+        key = (name, template)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def timing(self, name, seconds, template=None):
+        key = (name, template)
+        with self._lock:
+            histogram = self.timings.get(key)
+            if histogram is None:
+                histogram = self.timings[key] = Histogram(self.buckets)
+            histogram.add(seconds)
+
+    def counter(self, name, template=None):
+        """Returns the value of a counter."""
+        return self.counters.get((name, template), 0)
+
+    def histogram(self, name, template=None):
+        """Returns the :class:`Histogram` of a timer.  If nothing was
+        recorded for it an empty histogram is returned.
+        """
+        rv = self.timings.get((name, template))
+        if rv is None:
+            rv = Histogram(self.buckets)
+        return rv
+
+    def clear(self):
+        """Resets all metrics."""
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
@@ -18,6 +18,9 @@
 """
 from jinja2 import nodes
 from jinja2.visitor import NodeTransformer
+from jinja2.defaults import DEFAULT_FILTERS
+from jinja2.runtime import Undefined, DebugUndefined
+from jinja2._compat import iteritems, string_types
 
 
 def optimize(node, environment):
@@ -47,3 +50,556 @@ class Optimizer(NodeTransformer):
     visit_Not = visit_Compare = visit_Getitem = visit_Getattr = visit_Call = \
     visit_Filter = visit_Test = visit_CondExpr = fold
     del fold
+
+
+def _copy_node(node, changes):
+    rv = object.__new__(node.__class__)
+    rv.__dict__.update(node.__dict__)
+    rv.__dict__.update(changes)
+    return rv
+
+
+def _contains(nodes_, node_type):
+    for node in nodes_:
+        if isinstance(node, node_type) or node.find(node_type) is not None:
+            return True
+    return False
+
+
+def _stored_names(node):
+    """Returns the names that are assigned somewhere in the tree."""
+    rv = []
+    for child in [node] + list(node.find_all((nodes.Name, nodes.Macro,
+                                              nodes.Import,
+                                              nodes.FromImport))):
+        if isinstance(child, nodes.Name):
+            if child.ctx in ('store', 'param'):
+                rv.append(child.name)
+        elif isinstance(child, nodes.Macro):
+            rv.append(child.name)
+        elif isinstance(child, nodes.Import):
+            rv.append(child.target)
+        elif isinstance(child, nodes.FromImport):
+            for name in child.names:
+                if isinstance(name, tuple):
+                    name = name[1]
+                rv.append(name)
+    return rv
+
+
+# names that have a special meaning in some scopes and are never replaced
+_special_names = frozenset(['loop', 'caller', 'varargs', 'kwargs', 'self',
+                            'super'])
+
+# statements with a body that is not executed where it's defined
+_deferred_bodies = (nodes.Block, nodes.Macro, nodes.CallBlock,
+                    nodes.OverlayScope)
+
+
+class TreePass(object):
+    """Baseclass for the passes of :func:`optimize_template`.  Unlike the
+    :class:`~jinja2.visitor.NodeTransformer` a pass does not modify the
+    tree it's given, a node is copied if something below it changes.
+    Visitor methods for statements can return a list of nodes that
+    replaces the statement.
+    """
+
+    #: passes that evaluate constant expressions are skipped for templates
+    #: that change the eval context.
+    uses_eval_context = False
+
+    def __init__(self, environment, eval_ctx, template):
+        self.environment = environment
+        self.eval_ctx = eval_ctx
+
+    def visit(self, node):
+        f = getattr(self, 'visit_' + node.__class__.__name__, None)
+        if f is None:
+            return self.generic_visit(node)
+        return f(node)
+
+    def generic_visit(self, node):
+        changes = {}
+        for field, value in node.iter_fields():
+            if isinstance(value, list):
+                new_value = self.visit_list(value)
+            elif isinstance(value, nodes.Node):
+                new_value = self.visit(value)
+            else:
+                continue
+            if new_value is not value:
+                changes[field] = new_value
+        if changes:
+            return _copy_node(node, changes)
+        return node
+
+    def visit_list(self, items):
+        rv = []
+        changed = False
+        for item in items:
+            if isinstance(item, nodes.Node):
+                new_item = self.visit(item)
+                if new_item is not item:
+                    changed = True
+                    if isinstance(new_item, list):
+                        rv.extend(new_item)
+                        continue
+                item = new_item
+            rv.append(item)
+        if changed:
+            return rv
+        return items
+
+
+class MacroInliningPass(TreePass):
+    """Replaces calls of small macros in output statements by the body of
+    the macro in a `with` block that binds the arguments.  Only macros
+    defined once on the top level of the template are inlined, and only if
+    their body does not look up any variable besides the arguments and the
+    targets of loops and `with` blocks within the body.  This rules out
+    `caller`, `varargs`, `kwargs` and recursive calls.  Macros that include
+    or import templates with context are not inlined either.  Calls must
+    pass the arguments positionally, the defaults of missing arguments have
+    to be constants.
+    """
+    uses_eval_context = True
+
+    #: the maximum number of nodes in a macro that is inlined.
+    max_size = 30
+
+    def __init__(self, environment, eval_ctx, template):
+        TreePass.__init__(self, environment, eval_ctx, template)
+        counts = {}
+        for name in _stored_names(template):
+            counts[name] = counts.get(name, 0) + 1
+        self.candidates = set()
+        if environment.finalize is None and \
+           template.find(nodes.Extends) is None:
+            for node in template.body:
+                if isinstance(node, nodes.Macro) and \
+                   counts[node.name] == 1 and self.is_inlinable(node):
+                    self.candidates.add(id(node))
+        self.macros = {}
+
+    def is_inlinable(self, node):
+        for default in node.defaults:
+            if not isinstance(default, nodes.Const):
+                return False
+        if _contains(node.body, (nodes.Macro, nodes.CallBlock, nodes.Block,
+                                 nodes.OverlayScope)):
+            return False
+        # included templates and imports with context see the locals of
+        # the template, which would be the locals of the caller
+        for child in node.find_all((nodes.Include, nodes.Import,
+                                    nodes.FromImport)):
+            if child.with_context:
+                return False
+        size = 0
+        for child in node.find_all(nodes.Node):
+            size += 1
+            if size > self.max_size:
+                return False
+        known = frozenset(x.name for x in node.args)
+        if known & _special_names:
+            return False
+        return all(self.loads_known(x, known) for x in node.body)
+
+    def loads_known(self, node, known):
+        """Checks that `node` only looks up names in `known`.  Names that
+        are assigned in the macro are not known because the macro might
+        look them up before they are assigned.
+        """
+        if isinstance(node, nodes.Name):
+            return node.ctx != 'load' or (node.name in known and
+                                          node.name not in _special_names)
+        if isinstance(node, nodes.For):
+            inner = known | frozenset(_stored_names(node.target))
+            return self.loads_known(node.iter, known) and \
+                (node.test is None or self.loads_known(node.test, inner)) and \
+                all(self.loads_known(x, inner) for x in node.body) and \
+                all(self.loads_known(x, known) for x in node.else_)
+        if isinstance(node, nodes.With):
+            inner = known | frozenset(name for x in node.targets
+                                      for name in _stored_names(x))
+            return all(self.loads_known(x, known) for x in node.values) and \
+                all(self.loads_known(x, inner) for x in node.body)
+        return all(self.loads_known(x, known)
+                   for x in node.iter_child_nodes())
+
+    def visit_Macro(self, node):
+        rv = self.generic_visit(node)
+        if id(node) in self.candidates:
+            self.macros[node.name] = rv
+        return rv
+
+    def visit_barrier(self, node):
+        macros = self.macros
+        self.macros = {}
+        try:
+            return self.generic_visit(node)
+        finally:
+            self.macros = macros
+
+    visit_Block = visit_OverlayScope = visit_barrier
+
+    def get_macro(self, node):
+        if not isinstance(node, nodes.Call) or node.kwargs or \
+           node.dyn_args is not None or node.dyn_kwargs is not None or \
+           not isinstance(node.node, nodes.Name):
+            return None
+        macro = self.macros.get(node.node.name)
+        if macro is not None and \
+           len(macro.args) - len(macro.defaults) <= len(node.args) <= \
+           len(macro.args):
+            return macro
+
+    def inline(self, node, macro):
+        args = list(node.args)
+        if len(args) < len(macro.args):
+            args.extend(macro.defaults[len(args) - len(macro.args):])
+        targets = [nodes.Name(arg.name, 'param', lineno=node.lineno,
+                              environment=self.environment)
+                   for arg in macro.args]
+        return nodes.With(targets, args, list(macro.body),
+                          lineno=node.lineno, environment=self.environment)
+
+    def visit_Output(self, node):
+        node = self.generic_visit(node)
+        if not self.macros:
+            return node
+        rv = []
+        pending = []
+        for child in node.nodes:
+            macro = self.get_macro(child)
+            if macro is None:
+                pending.append(child)
+                continue
+            if pending:
+                rv.append(nodes.Output(pending, lineno=pending[0].lineno,
+                                       environment=self.environment))
+                pending = []
+            rv.append(self.inline(child, macro))
+        if not rv:
+            return node
+        if pending:
+            rv.append(nodes.Output(pending, lineno=pending[0].lineno,
+                                   environment=self.environment))
+        return rv
+
+
+class DeadBranchPass(TreePass):
+    """Replaces `if` statements with a constant test by the branch that is
+    taken and removes loops over constant empty sequences.  Branches that
+    define blocks or extend a template are kept.
+    """
+    uses_eval_context = True
+
+    def visit_If(self, node):
+        node = self.generic_visit(node)
+        try:
+            test = node.test.as_const(self.eval_ctx)
+        except nodes.Impossible:
+            return node
+        if _contains(node.body + node.else_, (nodes.Block, nodes.Extends)):
+            return node
+        if test:
+            return node.body
+        return node.else_
+
+    def visit_For(self, node):
+        node = self.generic_visit(node)
+        try:
+            iterable = node.iter.as_const(self.eval_ctx)
+        except nodes.Impossible:
+            return node
+        if not isinstance(iterable, (list, tuple, dict) + string_types) or \
+           iterable or _contains(node.body + node.else_,
+                                 (nodes.Block, nodes.Extends)):
+            return node
+        if not node.else_:
+            return []
+        # names assigned in the else block of a loop don't leak out
+        return nodes.Scope(node.else_, lineno=node.lineno,
+                           environment=self.environment)
+
+
+class ConstantInliningPass(TreePass):
+    """Replaces variables that are only assigned once with a constant by
+    the constant in the statements that follow the assignment.  Bodies that
+    are rendered somewhere else (blocks, macros and call blocks) are left
+    alone.
+    """
+
+    #: the types of constants that are inlined.  Mutable values have to
+    #: stay shared.
+    inline_types = (bool, int, float, type(None)) + string_types
+
+    def __init__(self, environment, eval_ctx, template):
+        TreePass.__init__(self, environment, eval_ctx, template)
+        counts = {}
+        for name in _stored_names(template):
+            counts[name] = counts.get(name, 0) + 1
+        self.inlinable = set(name for name, count in iteritems(counts)
+                             if count == 1 and name not in _special_names)
+        self.constants = {}
+
+    def visit_list(self, items):
+        constants = self.constants
+        try:
+            return TreePass.visit_list(self, items)
+        finally:
+            self.constants = constants
+
+    def visit_Assign(self, node):
+        node = self.generic_visit(node)
+        target = node.target
+        if isinstance(target, nodes.Name) and \
+           target.name in self.inlinable and \
+           isinstance(node.node, nodes.Const) and \
+           type(node.node.value) in self.inline_types:
+            self.constants = dict(self.constants)
+            self.constants[target.name] = node.node.value
+        return node
+
+    def visit_Name(self, node):
+        if node.ctx == 'load' and node.name in self.constants:
+            return nodes.Const(self.constants[node.name],
+                               lineno=node.lineno,
+                               environment=self.environment)
+        return node
+
+    def visit_deferred(self, node):
+        constants = self.constants
+        self.constants = {}
+        try:
+            return self.generic_visit(node)
+        finally:
+            self.constants = constants
+
+    visit_Block = visit_Macro = visit_CallBlock = visit_OverlayScope = \
+        visit_deferred
+
+
+class FilterHoistingPass(TreePass):
+    """Computes filter calls on variables that don't change within a loop
+    only once per loop.  The result is stored in an internal name when the
+    filter is used for the first time in the loop and reused afterwards.
+    Only builtin filters that don't depend on anything but their input are
+    considered, and only in loops that don't call any functions, filters,
+    tests or other templates that could modify the filtered object.
+    """
+
+    hoistable_filters = frozenset(['upper', 'lower', 'title', 'capitalize',
+                                   'trim', 'escape', 'e', 'forceescape',
+                                   'striptags', 'string'])
+
+    def __init__(self, environment, eval_ctx, template):
+        TreePass.__init__(self, environment, eval_ctx, template)
+        self.counter = 0
+        self.enabled = not environment.sandboxed and \
+            environment.undefined in (Undefined, DebugUndefined)
+
+    def internal_name(self, name, lineno=None):
+        rv = object.__new__(nodes.InternalName)
+        nodes.Node.__init__(rv, name, lineno=lineno,
+                            environment=self.environment)
+        return rv
+
+    def next_name(self):
+        self.counter += 1
+        return '_hoisted_%d' % self.counter
+
+    def is_invariant(self, node, stored):
+        if node.name not in self.hoistable_filters or \
+           self.environment.filters.get(node.name) is not \
+           DEFAULT_FILTERS.get(node.name) or \
+           node.dyn_args is not None or node.dyn_kwargs is not None:
+            return False
+        if not isinstance(node.node, nodes.Name) or \
+           node.node.ctx != 'load' or node.node.name in stored or \
+           node.node.name in _special_names:
+            return False
+        for arg in node.args + [x.value for x in node.kwargs]:
+            if not isinstance(arg, nodes.Const):
+                return False
+        return True
+
+    def find_invariants(self, node, stored, rv):
+        for child in node.iter_child_nodes():
+            if isinstance(child, _deferred_bodies):
+                continue
+            if isinstance(child, nodes.Filter) and \
+               self.is_invariant(child, stored):
+                rv.append(child)
+            else:
+                self.find_invariants(child, stored, rv)
+
+    def is_constant(self, node):
+        try:
+            node.as_const(self.eval_ctx)
+        except nodes.Impossible:
+            return False
+        return True
+
+    def visit_For(self, node):
+        node = self.generic_visit(node)
+        # the body of recursive loops is a function of its own
+        if not self.enabled or node.recursive:
+            return node
+        checked = node.body + [node.iter]
+        if node.test is not None:
+            checked.append(node.test)
+        if _contains(checked, (
+           nodes.Call, nodes.ExprStmt, nodes.EvalContextModifier,
+           nodes.OverlayScope, nodes.Include, nodes.Import,
+           nodes.FromImport, nodes.Extends)):
+            return node
+        stored = set(_stored_names(node.target))
+        for child in node.body:
+            stored.update(_stored_names(child))
+        found = []
+        for child in node.body:
+            self.find_invariants(child, stored, found)
+        if not found:
+            return node
+
+        # any other filter or test could modify the filtered objects
+        hoisted = set(id(x) for x in found)
+        for child in checked:
+            for other in [child] + list(child.find_all((nodes.Filter,
+                                                        nodes.Test))):
+                if isinstance(other, (nodes.Filter, nodes.Test)) and \
+                   id(other) not in hoisted and not self.is_constant(other):
+                    return node
+
+        assignments = []
+        replacements = {}
+        for filter_node in found:
+            for value, name in assignments:
+                if value == filter_node:
+                    break
+            else:
+                name = self.next_name()
+                assignments.append((filter_node, name))
+            replacements[id(filter_node)] = (name, filter_node)
+        node = _HoistedFilterReplacer(self, replacements).visit(node)
+        rv = [nodes.Assign(self.internal_name(name, value.lineno),
+                           self.internal_name('missing', value.lineno),
+                           lineno=value.lineno, environment=self.environment)
+              for value, name in assignments]
+        rv.append(node)
+        return rv
+
+
+class _HoistedFilterReplacer(TreePass):
+    """Replaces the hoisted filter calls by their internal name.  In front
+    of every statement that uses a name the filter is called if the name
+    is still `missing`, so filters are only called if the unoptimized
+    template would call them as well.
+    """
+
+    def __init__(self, hoisting_pass, replacements):
+        self.environment = hoisting_pass.environment
+        self.hoisting_pass = hoisting_pass
+        self.replacements = replacements
+        self.used = []
+
+    def visit_list(self, items):
+        rv = []
+        changed = False
+        for item in items:
+            if not isinstance(item, nodes.Stmt):
+                new_item = self.visit(item)
+                changed = changed or new_item is not item
+                rv.append(new_item)
+                continue
+            self.used.append([])
+            try:
+                new_item = self.visit(item)
+            finally:
+                used = self.used.pop()
+            for name, filter_node in used:
+                rv.append(self.compute(name, filter_node))
+            changed = changed or used or new_item is not item
+            rv.append(new_item)
+        if changed:
+            return rv
+        return items
+
+    def compute(self, name, filter_node):
+        make_name = self.hoisting_pass.internal_name
+        attributes = dict(lineno=filter_node.lineno,
+                          environment=self.environment)
+        missing = nodes.Operand('eq', make_name('missing'), **attributes)
+        return nodes.Assign(
+            make_name(name, filter_node.lineno),
+            nodes.CondExpr(
+                nodes.Compare(make_name(name), [missing], **attributes),
+                filter_node, make_name(name), **attributes),
+            **attributes)
+
+    def visit_Filter(self, node):
+        replacement = self.replacements.get(id(node))
+        if replacement is None:
+            return self.generic_visit(node)
+        if replacement not in self.used[-1]:
+            self.used[-1].append(replacement)
+        return self.hoisting_pass.internal_name(replacement[0], node.lineno)
+
+
+class OutputMergingPass(TreePass):
+    """Merges output statements that directly follow each other.  Outputs
+    that only consist of template data are moved in front of assignments
+    that separate them from an earlier output.
+    """
+
+    def visit_list(self, items):
+        items = TreePass.visit_list(self, items)
+        rv = []
+        last = None
+        changed = False
+        for item in items:
+            if isinstance(item, nodes.Output):
+                if last is not None and (
+                   last == len(rv) - 1 or
+                   all(isinstance(x, nodes.TemplateData)
+                       for x in item.nodes)):
+                    rv[last] = nodes.Output(rv[last].nodes + item.nodes,
+                                            lineno=rv[last].lineno,
+                                            environment=self.environment)
+                    changed = True
+                    continue
+                last = len(rv)
+            elif not isinstance(item, nodes.Assign):
+                last = None
+            rv.append(item)
+        if changed:
+            return rv
+        return items
+
+
+#: the passes of :func:`optimize_template` in the order they run.  Each of
+#: them is enabled with the ``optimizer.<name>`` policy.
+passes = (
+    ('inline_macros', MacroInliningPass),
+    ('inline_constants', ConstantInliningPass),
+    ('dead_branches', DeadBranchPass),
+    ('hoist_filters', FilterHoistingPass),
+    ('merge_output', OutputMergingPass),
+)
+
+
+def optimize_template(node, environment, name=None):
+    """Runs the optimization passes that are enabled in the policies of the
+    environment over a template node and returns the optimized template.
+    The node passed is not modified.  This happens before the code is
+    generated if the environment is `optimized`.
+    """
+    eval_ctx = nodes.EvalContext(environment, name)
+    volatile = node.find(nodes.EvalContextModifier) is not None
+    for pass_name, pass_class in passes:
+        if not environment.policies.get('optimizer.' + pass_name) or \
+           (volatile and pass_class.uses_eval_context):
+            continue
+        node = pass_class(environment, eval_ctx, node).visit(node)
+    return node
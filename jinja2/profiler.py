@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja2.profiler
+    ~~~~~~~~~~~~~~~
+
+    Profiles template rendering by template line.  The profiler traces the
+    Python frames of the generated template code and maps their line numbers
+    back to the template with the debug information the code generator
+    writes into every template module.  Time is attributed to the template
+    line that is running, including the time spent in filters, tests and
+    other Python functions called from it.
+
+    :copyright: (c) 2017 by the Jinja Team.
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import dis
+import time
+import marshal
+from weakref import WeakKeyDictionary
+
+
+# generators and coroutines report a 'return' event whenever they yield
+_generator_flags = 0x20 | 0x80 | 0x100 | 0x200
+
+# the instructions a generator or coroutine is suspended at.  Depending on
+# the Python version the frame points to the yield, to the `RESUME` after it
+# or to the instruction before `YIELD_FROM`.
+_yield_opcodes = frozenset(dis.opmap[x] for x in ('YIELD_VALUE', 'YIELD_FROM',
+                                                  'RESUME')
+                           if x in dis.opmap)
+_yield_from = dis.opmap.get('YIELD_FROM')
+
+
+default_timer = getattr(time, 'perf_counter', time.time)
+
+
+def _is_suspended(frame):
+    """Checks if a frame that returned is a generator or coroutine that
+    only yielded and will be resumed.
+    """
+    code = frame.f_code
+    if not code.co_flags & _generator_flags:
+        return False
+    ops = bytearray(code.co_code[frame.f_lasti:frame.f_lasti + 3])
+    return bool(ops) and (ops[0] in _yield_opcodes or
+                          len(ops) == 3 and ops[2] == _yield_from)
+
+
+def _function_label(name):
+    if name.startswith('write_'):
+        name = name[6:]
+    if name == 'root':
+        return 'top-level template code'
+    if name.startswith('block_'):
+        return 'block "%s"' % name[6:]
+    return name
+
+
+class RenderProfiler(object):
+    """Records how much time is spent on every line of the templates
+    rendered while the profiler is active::
+
+        profiler = RenderProfiler(env)
+        with profiler:
+            template.render(...)
+        profiler.get_stats().sort_stats('tottime').print_stats(10)
+
+    If an `environment` is given only its templates are recorded.  The
+    profiler uses :func:`sys.settrace` and only sees the thread it was
+    activated in.  An existing trace function is restored when the
+    profiler is stopped.
+
+    For every template line the profiler records the number of times the
+    line was entered, the time spent on the line itself (exclusive) and the
+    time including other template code called from it like blocks, macros
+    and included templates (inclusive).  The same is recorded for the
+    template functions: the top-level code, blocks and macros.
+    """
+
+    def __init__(self, environment=None, timer=None):
+        self.environment = environment
+        self.timer = timer or default_timer
+        #: maps ``(filename, lineno, function)`` of a template line to
+        #: ``[hits, exclusive time, inclusive time]``
+        self.lines = {}
+        #: maps ``(filename, lineno, function)`` of a template function to
+        #: ``[calls, exclusive time, inclusive time]``
+        self.functions = {}
+        #: maps stacks of template lines to the exclusive time spent in them
+        self.stacks = {}
+        self.stats = {}
+        self._stack = []
+        # the ids of the generator and coroutine frames that yielded.  The
+        # frames themselves are not kept alive.
+        self._frames = set()
+        self._last = None
+        self._linenos = WeakKeyDictionary()
+        self._old_trace = None
+
+    def start(self):
+        """Starts recording."""
+        self._old_trace = sys.gettrace()
+        self._last = self.timer()
+        sys.settrace(self._trace_call)
+
+    def stop(self):
+        """Stops recording."""
+        sys.settrace(self._old_trace)
+        self._old_trace = None
+        self._charge(self.timer())
+        del self._stack[:]
+        self._frames.clear()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    def _lineno(self, template, lineno):
+        linenos = self._linenos.get(template)
+        if linenos is None:
+            linenos = self._linenos[template] = {}
+        rv = linenos.get(lineno)
+        if rv is None:
+            rv = linenos[lineno] = template.get_corresponding_lineno(lineno)
+        return rv
+
+    def _charge(self, now):
+        stack = self._stack
+        elapsed = now - self._last
+        self._last = now
+        if not stack:
+            return
+        path = []
+        seen_lines = set()
+        seen_functions = set()
+        for frame, function, lineno in stack:
+            line = (function[0], lineno, function[2])
+            path.append(line)
+            if line not in seen_lines:
+                seen_lines.add(line)
+                self.lines[line][2] += elapsed
+            if function not in seen_functions:
+                seen_functions.add(function)
+                self.functions[function][2] += elapsed
+        self.lines[line][1] += elapsed
+        self.functions[function][1] += elapsed
+        path = tuple(path)
+        self.stacks[path] = self.stacks.get(path, 0) + elapsed
+
+    def _enter_line(self, function, lineno):
+        line = (function[0], lineno, function[2])
+        stats = self.lines.get(line)
+        if stats is None:
+            stats = self.lines[line] = [0, 0.0, 0.0]
+        stats[0] += 1
+
+    def _trace_call(self, frame, event, arg):
+        if event != 'call':
+            return None
+        template = frame.f_globals.get('__jinja_template__')
+        if template is None or (self.environment is not None and
+                                frame.f_globals.get('environment') is not
+                                self.environment):
+            return None
+        code = frame.f_code
+        # temporary functions like the argument binders of macros or the
+        # filters of loops count as part of the line that calls them
+        if code.co_name.startswith('t_'):
+            return None
+        self._charge(self.timer())
+        filename = template.name or template.filename or '<template>'
+        function = (filename, self._lineno(template, code.co_firstlineno),
+                    _function_label(code.co_name))
+        stats = self.functions.get(function)
+        if stats is None:
+            stats = self.functions[function] = [0, 0.0, 0.0]
+        # generators and coroutines are "called" again when resumed
+        if id(frame) in self._frames:
+            self._frames.discard(id(frame))
+        else:
+            stats[0] += 1
+        lineno = self._lineno(template, frame.f_lineno)
+        self._enter_line(function, lineno)
+        self._stack.append((frame, function, lineno))
+        self._last = self.timer()
+        return self._trace_frame
+
+    def _trace_frame(self, frame, event, arg):
+        if event == 'line':
+            top, function, lineno = self._stack[-1]
+            if top is not frame:
+                return self._trace_frame
+            template = frame.f_globals['__jinja_template__']
+            new_lineno = self._lineno(template, frame.f_lineno)
+            if new_lineno != lineno:
+                self._charge(self.timer())
+                self._enter_line(function, new_lineno)
+                self._stack[-1] = (frame, function, new_lineno)
+                self._last = self.timer()
+        elif event == 'return':
+            if self._stack and self._stack[-1][0] is frame:
+                self._charge(self.timer())
+                self._stack.pop()
+                if _is_suspended(frame):
+                    self._frames.add(id(frame))
+                self._last = self.timer()
+        return self._trace_frame
+
+    def create_stats(self):
+        """Fills `stats` in the format of :mod:`pstats` with an entry for
+        every template line.  This makes the profiler a valid argument for
+        :class:`pstats.Stats`.
+        """
+        self.stats = dict((line, (hits, hits, exclusive, inclusive, {}))
+                          for line, (hits, exclusive, inclusive)
+                          in self.lines.items())
+
+    def get_stats(self):
+        """Returns a :class:`pstats.Stats` object for the recorded lines."""
+        from pstats import Stats
+        return Stats(self)
+
+    def dump_stats(self, filename):
+        """Writes the recorded lines to a file that can be loaded with
+        :mod:`pstats`.
+        """
+        self.create_stats()
+        with open(filename, 'wb') as f:
+            marshal.dump(self.stats, f)
+
+    def write_flamegraph(self, fp, unit=1e-6):
+        """Writes the recorded time in the folded stack format used by
+        flame graph tools, one line for every stack of template lines with
+        the time spent in it in `unit` (microseconds by default).
+        """
+        for path, elapsed in sorted(self.stacks.items()):
+            value = int(round(elapsed / unit))
+            if not value:
+                continue
+            fp.write(u'%s %d\n' % (u';'.join(
+                (u'%s:%d (%s)' % line).replace(u';', u',')
+                for line in path), value))
@@ -22,10 +22,10 @@ from jinja2._compat import imap, text_type, iteritems, \
 
 
 # these variables are exported to the template runtime
-__all__ = ['LoopContext', 'TemplateReference', 'Macro', 'Markup',
-           'TemplateRuntimeError', 'missing', 'concat', 'escape',
+__all__ = ['LoopContext', 'CountingLoopContext', 'TemplateReference',
+           'Macro', 'Markup', 'TemplateRuntimeError', 'missing', 'concat', 'escape',
            'markup_join', 'unicode_join', 'to_string', 'identity',
-           'TemplateNotFound']
+           'TemplateNotFound', 'write_events', 'metered_undefined']
 
 #: the name of the function that is used to convert something into
 #: a string.  We can just use the text type here.
@@ -53,6 +53,38 @@ def unicode_join(seq):
     return concat(imap(text_type, seq))
 
 
+@internalcode
+def write_events(render_func, context, write):
+    """Passes the output of a root or block render function to `write`.
+    If the template was compiled with write functions the function that
+    writes the output itself is used, otherwise the events are written as
+    they are yielded.
+    """
+    write_func = getattr(render_func, 'write_func', None)
+    if write_func is not None:
+        # like in the render functions a StopIteration must not escape
+        try:
+            write_func(context, write)
+        except StopIteration:
+            raise RuntimeError('template code raised StopIteration')
+    else:
+        for event in render_func(context):
+            write(event)
+
+
+def metered_undefined(environment, template_name):
+    """Returns a factory for the undefined objects of a template that
+    counts them in the metrics sink of the environment.
+    """
+    metrics = environment.metrics
+    undefined = environment.undefined
+
+    def factory(*args, **kwargs):
+        metrics.increment('undefined', template_name)
+        return undefined(*args, **kwargs)
+    return factory
+
+
 def new_context(environment, template_name, blocks, vars=None,
                 shared=None, globals=None, locals=None):
     """Internal helper to for context creation."""
@@ -116,9 +148,44 @@ class ContextMeta(type):
              resolve_or_missing is default_resolve_or_missing:
             rv._fast_resolve_mode = True
 
+        # slots are only resolved for contexts that resolve names like the
+        # default context, all others are asked for every name.
+        rv._slot_resolve_mode = resolve is default_resolve and \
+            resolve_or_missing is default_resolve_or_missing
+
         return rv
 
 
+class ContextVars(dict):
+    """The dict holding the :attr:`Context.vars`.  It caches the values
+    :meth:`Context.resolve_slots` resolved and forgets them whenever the
+    variables are modified.
+    """
+    __slots__ = ('slot_cache',)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.slot_cache = {}
+
+    def _modifier(meth):
+        original = getattr(dict, meth)
+        def modifier(self, *args, **kwargs):
+            self.slot_cache.clear()
+            return original(self, *args, **kwargs)
+        modifier.__doc__ = original.__doc__
+        modifier.__name__ = meth
+        return modifier
+
+    __setitem__ = _modifier('__setitem__')
+    __delitem__ = _modifier('__delitem__')
+    update = _modifier('update')
+    setdefault = _modifier('setdefault')
+    pop = _modifier('pop')
+    popitem = _modifier('popitem')
+    clear = _modifier('clear')
+    del _modifier
+
+
 def resolve_or_missing(context, key, missing=missing):
     if key in context.vars:
         return context.vars[key]
@@ -150,10 +217,11 @@ class Context(with_metaclass(ContextMeta)):
     # remove it.
     _legacy_resolve_mode = False
     _fast_resolve_mode = False
+    _slot_resolve_mode = True
 
     def __init__(self, environment, parent, name, blocks):
         self.parent = parent
-        self.vars = {}
+        self.vars = ContextVars()
         self.environment = environment
         self.eval_ctx = EvalContext(self.environment, name)
         self.exported_vars = set()
@@ -213,6 +281,43 @@ class Context(with_metaclass(ContextMeta)):
             return rv
         return resolve_or_missing(self, key)
 
+    def resolve_slots(self, names):
+        """Resolves a tuple of `names` like :meth:`resolve_or_missing` and
+        returns a list with their values.  The compiler assigns every name a
+        template looks up in the context an index in such a tuple so that
+        the render functions only have to look up the values by index.
+
+        The result is cached until :attr:`vars` are modified, the tuple has
+        to be the same object for every call.  Subclasses that override
+        :meth:`resolve` or :meth:`resolve_or_missing` are asked for every
+        name.
+
+        .. versionadded:: 2.10
+        """
+        if not self._slot_resolve_mode:
+            return [self.resolve_or_missing(x) for x in names]
+        vars = self.vars
+        try:
+            cache = vars.slot_cache
+        except AttributeError:
+            cache = None
+        else:
+            cached = cache.get(id(names))
+            if cached is not None and cached[0] is names:
+                return cached[1]
+        parent = self.parent
+        rv = []
+        for name in names:
+            if name in vars:
+                rv.append(vars[name])
+            elif name in parent:
+                rv.append(parent[name])
+            else:
+                rv.append(missing)
+        if cache is not None:
+            cache[id(names)] = (names, rv)
+        return rv
+
     def get_exported(self):
         """Get a new dict with the exported variables."""
         return dict((k, self.vars[k]) for k in self.exported_vars)
@@ -346,6 +451,7 @@ class BlockReference(object):
 
 class LoopContextBase(object):
     """A loop context for dynamic iteration."""
+    __slots__ = ('_recurse', 'index0', 'depth0')
 
     _after = _last_iteration
     _length = None
@@ -394,6 +500,7 @@ class LoopContextBase(object):
 
 
 class LoopContext(LoopContextBase):
+    __slots__ = ('_iterator', '_length', '_after')
 
     def __init__(self, iterable, recurse=None, depth0=0):
         LoopContextBase.__init__(self, recurse, depth0)
@@ -432,6 +539,46 @@ class LoopContext(LoopContextBase):
             return _last_iteration
 
 
+class CountingLoopContext(LoopContextBase):
+    """The loop context the compiler uses for loops that don't access the
+    length of the loop or anything derived from it.  Unlike
+    :class:`LoopContext` it does not need to look ahead in the iterable and
+    only counts the iterations.
+    """
+    __slots__ = ('_iterable',)
+
+    #: the attributes of the loop variable that this context supports.
+    supported_attributes = frozenset(['index', 'index0', 'first', 'depth',
+                                      'depth0', 'cycle'])
+
+    def __init__(self, iterable, recurse=None, depth0=0):
+        LoopContextBase.__init__(self, recurse, depth0)
+        self._iterable = iterable
+
+    def _unsupported(name):
+        def fail(self):
+            raise TemplateRuntimeError('loop.%s is not available in this '
+                                       'loop' % name)
+        return property(fail)
+
+    last = _unsupported('last')
+    length = _unsupported('length')
+    revindex = rindex = _unsupported('revindex')
+    revindex0 = rindex0 = _unsupported('revindex0')
+    del _unsupported
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for item in self._iterable:
+            self.index0 += 1
+            yield item, self, self
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.index)
+
+
 @implements_iterator
 class LoopContextIterator(object):
     """The iterator for a loop context."""
@@ -458,9 +605,10 @@ class Macro(object):
 
     def __init__(self, environment, func, name, arguments,
                  catch_kwargs, catch_varargs, caller,
-                 default_autoescape=None):
+                 default_autoescape=None, binder=None):
         self._environment = environment
         self._func = func
+        self._binder = binder
         self._argument_count = len(arguments)
         self.name = name
         self.arguments = arguments
@@ -498,6 +646,17 @@ class Macro(object):
         else:
             autoescape = self._default_autoescape
 
+        # the compiler creates a function that binds the arguments for
+        # macros without special arguments.  If it fails the arguments
+        # don't match and we go the slow way to report the right error.
+        if self._binder is not None:
+            try:
+                arguments = self._binder(*args, **kwargs)
+            except TypeError:
+                pass
+            else:
+                return self._invoke(arguments, autoescape)
+
         # try to consume the positional arguments
         arguments = list(args[:self._argument_count])
         off = len(arguments)
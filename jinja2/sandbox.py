@@ -375,7 +375,7 @@ class SandboxedEnvironment(Environment):
                         if self.is_safe_attribute(obj, argument, value):
                             return value
                         return self.unsafe_undefined(obj, argument)
-        return self.undefined(obj=obj, name=argument)
+        return self._lookup_undefined(obj, argument)
 
     def getattr(self, obj, attribute):
         """Subscribe an object from sandboxed code and prefer the
@@ -392,7 +392,7 @@ class SandboxedEnvironment(Environment):
             if self.is_safe_attribute(obj, attribute, value):
                 return value
             return self.unsafe_undefined(obj, attribute)
-        return self.undefined(obj=obj, name=attribute)
+        return self._lookup_undefined(obj, attribute)
 
     def unsafe_undefined(self, obj, attribute):
         """Return an undefined object for unsafe attributes."""
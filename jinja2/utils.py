@@ -11,10 +11,9 @@
 import re
 import json
 import errno
-from collections import deque
-from threading import Lock
+from threading import Lock, RLock
 from jinja2._compat import text_type, string_types, implements_iterator, \
-     url_quote
+     url_quote, OrderedDict
 
 
 _word_split_re = re.compile(r'(\s+)')
@@ -306,32 +305,47 @@ def unicode_urlencode(obj, charset='utf-8', for_qs=False):
 class LRUCache(object):
     """A simple LRU Cache implementation."""
 
-    # this is fast for small capacities (something below 1000) but doesn't
-    # scale.  But as long as it's only used as storage for templates this
-    # won't do any harm.
+    # the mapping is an ordered dict that keeps the least recently used
+    # key first.  Moving a key to the end and evicting from the front are
+    # both constant time operations so this scales to large capacities.
+    # On Python 3 the C implementation of `move_to_end` is atomic under
+    # the GIL which means reads do not have to take the lock.
 
     def __init__(self, capacity):
         self.capacity = capacity
-        self._mapping = {}
-        self._queue = deque()
+        self._mapping = OrderedDict()
         self._postinit()
 
     def _postinit(self):
-        # alias all queue methods for faster lookup
-        self._popleft = self._queue.popleft
-        self._pop = self._queue.pop
-        self._remove = self._queue.remove
-        self._wlock = Lock()
-        self._append = self._queue.append
+        # alias all mapping methods for faster lookup
+        self._popitem = self._mapping.popitem
+        self._wlock = RLock()
+        self._move_to_end = getattr(self._mapping, 'move_to_end', None)
+        if self._move_to_end is None:
+            self._move_to_end = self._locked_move_to_end
+
+    def _locked_move_to_end(self, key):
+        # the pure python ordered dict of Python 2 is not thread safe, so
+        # reordering has to happen under the lock there.
+        self._wlock.acquire()
+        try:
+            self._mapping[key] = self._mapping.pop(key)
+        finally:
+            self._wlock.release()
 
     def __getstate__(self):
         return {
             'capacity':     self.capacity,
-            '_mapping':     self._mapping,
-            '_queue':       self._queue
+            '_mapping':     self._mapping
         }
 
     def __setstate__(self, d):
+        # caches pickled by older versions stored the order in a queue
+        # next to a plain dict.
+        queue = d.pop('_queue', None)
+        if queue is not None:
+            d['_mapping'] = OrderedDict((key, d['_mapping'][key])
+                                        for key in queue)
         self.__dict__.update(d)
         self._postinit()
 
@@ -342,7 +356,6 @@ class LRUCache(object):
         """Return a shallow copy of the instance."""
         rv = self.__class__(self.capacity)
         rv._mapping.update(self._mapping)
-        rv._queue = deque(self._queue)
         return rv
 
     def get(self, key, default=None):
@@ -371,7 +384,6 @@ class LRUCache(object):
         self._wlock.acquire()
         try:
             self._mapping.clear()
-            self._queue.clear()
         finally:
             self._wlock.release()
 
@@ -386,7 +398,7 @@ class LRUCache(object):
     def __repr__(self):
         return '<%s %r>' % (
             self.__class__.__name__,
-            self._mapping
+            dict(self._mapping)
         )
 
     def __getitem__(self, key):
@@ -395,21 +407,14 @@ class LRUCache(object):
 
         Raise a `KeyError` if it does not exist.
         """
-        self._wlock.acquire()
+        rv = self._mapping[key]
         try:
-            rv = self._mapping[key]
-            if self._queue[-1] != key:
-                try:
-                    self._remove(key)
-                except ValueError:
-                    # if something removed the key from the container
-                    # when we read, ignore the ValueError that we would
-                    # get otherwise.
-                    pass
-                self._append(key)
-            return rv
-        finally:
-            self._wlock.release()
+            self._move_to_end(key)
+        except KeyError:
+            # if something removed the key from the container when we
+            # read, ignore the KeyError that we would get otherwise.
+            pass
+        return rv
 
     def __setitem__(self, key, value):
         """Sets the value for an item. Moves the item up so that it
@@ -418,10 +423,9 @@ class LRUCache(object):
         self._wlock.acquire()
         try:
             if key in self._mapping:
-                self._remove(key)
-            elif len(self._mapping) == self.capacity:
-                del self._mapping[self._popleft()]
-            self._append(key)
+                del self._mapping[key]
+            elif len(self._mapping) >= self.capacity:
+                self._popitem(last=False)
             self._mapping[key] = value
         finally:
             self._wlock.release()
@@ -433,17 +437,12 @@ class LRUCache(object):
         self._wlock.acquire()
         try:
             del self._mapping[key]
-            try:
-                self._remove(key)
-            except ValueError:
-                # __getitem__ is not locked, it might happen
-                pass
         finally:
             self._wlock.release()
 
     def items(self):
         """Return a list of items."""
-        result = [(key, self._mapping[key]) for key in list(self._queue)]
+        result = list(self._mapping.items())
         result.reverse()
         return result
 
@@ -467,7 +466,7 @@ class LRUCache(object):
         """Iterate over all keys in the cache dict, ordered by
         the most recent usage.
         """
-        return reversed(tuple(self._queue))
+        return reversed(tuple(self._mapping))
 
     __iter__ = iterkeys
 
@@ -475,7 +474,7 @@ class LRUCache(object):
         """Iterate over the values in the cache dict, oldest items
         coming first.
         """
-        return iter(tuple(self._queue))
+        return iter(tuple(self._mapping))
 
     __copy__ = copy
 
@@ -488,6 +487,92 @@ except ImportError:
     pass
 
 
+class DependencyGraph(object):
+    """Keeps track of the templates a template extends, includes or imports.
+    The environment records the dependencies of every template it loads and
+    uses the graph to find the templates that have to be invalidated if a
+    template changes.
+    """
+
+    def __init__(self):
+        self._dependencies = {}
+        self._dependents = {}
+        self._lock = Lock()
+
+    def _unlink(self, name):
+        for dependency in self._dependencies.pop(name, ()):
+            dependents = self._dependents[dependency]
+            dependents.discard(name)
+            if not dependents:
+                del self._dependents[dependency]
+
+    def set_dependencies(self, name, dependencies):
+        """Record the names of the templates `name` depends on.  This
+        replaces the dependencies recorded before.
+        """
+        dependencies = frozenset(dependencies)
+        if self._dependencies.get(name) == dependencies:
+            return
+        self._lock.acquire()
+        try:
+            self._unlink(name)
+            self._dependencies[name] = dependencies
+            for dependency in dependencies:
+                self._dependents.setdefault(dependency, set()).add(name)
+        finally:
+            self._lock.release()
+
+    def remove(self, name):
+        """Forget the dependencies of a template."""
+        self._lock.acquire()
+        try:
+            self._unlink(name)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Forget all dependencies."""
+        self._lock.acquire()
+        try:
+            self._dependencies.clear()
+            self._dependents.clear()
+        finally:
+            self._lock.release()
+
+    def get_dependencies(self, name):
+        """Return the set of templates `name` directly depends on."""
+        return set(self._dependencies.get(name, ()))
+
+    def get_dependents(self, name, transitive=True):
+        """Return the set of templates that depend on `name`.  Unless
+        `transitive` is disabled templates that depend on the template
+        indirectly are included.
+        """
+        self._lock.acquire()
+        try:
+            rv = set(self._dependents.get(name, ()))
+            if not transitive:
+                return rv
+            todo = list(rv)
+            while todo:
+                for dependent in self._dependents.get(todo.pop(), ()):
+                    if dependent not in rv and dependent != name:
+                        rv.add(dependent)
+                        todo.append(dependent)
+            return rv
+        finally:
+            self._lock.release()
+
+    def __contains__(self, name):
+        return name in self._dependencies
+
+    def __len__(self):
+        return len(self._dependencies)
+
+    def __repr__(self):
+        return '<%s %d templates>' % (self.__class__.__name__, len(self))
+
+
 def select_autoescape(enabled_extensions=('html', 'htm', 'xml'),
                       disabled_extensions=(),
                       default_for_string=True,
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja2.watcher
+    ~~~~~~~~~~~~~~
+
+    Watches template folders for changes and drops changed templates from
+    the template cache of an environment.  With a watcher in place the
+    environment no longer has to ask the loader on every template access if
+    the template changed, so `auto_reload` can be disabled.
+
+    The watcher uses the Linux inotify API through ctypes and is not
+    available on other platforms.
+
+    :copyright: (c) 2017 by the Jinja Team.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import errno
+import struct
+import threading
+from jinja2._compat import string_types
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+_watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+_event_header = struct.Struct('iIII')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        if not sys.platform.startswith('linux'):
+            raise RuntimeError('inotify is only available on Linux')
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise RuntimeError('the C library does not support inotify')
+        _libc = libc
+    return _libc
+
+
+def _check(rv):
+    if rv < 0:
+        import ctypes
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return rv
+
+
+class InotifyWatcher(object):
+    """Watches the folders of a loader for changes and removes templates
+    from the cache of `environment` once their source changes.  Per default
+    the search path of the environment's
+    :class:`~jinja2.FileSystemLoader` is watched, a different list of
+    folders can be provided as `paths`.  Folders are watched recursively.
+
+    Events are processed when :meth:`poll` is called, or continuously in a
+    background thread after :meth:`start` was called::
+
+        env = Environment(loader=FileSystemLoader('templates'),
+                          auto_reload=False)
+        watcher = InotifyWatcher(env)
+        watcher.start()
+
+    A template is removed from the cache if its file changed or if a file
+    with the same template name was created, deleted or moved within one of
+    the watched folders.  If the kernel reports that events were lost the
+    whole cache is cleared.
+    """
+
+    def __init__(self, environment, paths=None):
+        if paths is None:
+            paths = getattr(environment.loader, 'searchpath', None)
+            if paths is None:
+                raise TypeError('paths have to be provided for loaders '
+                                'without a search path')
+        elif isinstance(paths, string_types):
+            paths = [paths]
+        self.environment = environment
+        self.paths = [os.path.abspath(x) for x in paths]
+        self._libc = _get_libc()
+        self._fd = _check(self._libc.inotify_init1(IN_NONBLOCK |
+                                                   IN_CLOEXEC))
+        self._watches = {}
+        self._thread = None
+        self._closed = False
+        for root in self.paths:
+            self._watch_tree(root, root)
+
+    def _watch_tree(self, root, folder):
+        for dirpath, dirnames, filenames in os.walk(folder):
+            self._add_watch(root, dirpath)
+
+    def _add_watch(self, root, folder):
+        path = folder
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+        try:
+            wd = _check(self._libc.inotify_add_watch(self._fd, path,
+                                                     _watch_mask))
+        except OSError as e:
+            # the folder disappeared before we could watch it
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        self._watches[wd] = (root, folder)
+
+    def poll(self):
+        """Processes all pending events without blocking.  Returns the
+        number of templates that were removed from the cache.
+        """
+        rv = 0
+        while 1:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return rv
+                raise
+            if not data:
+                return rv
+            rv += self._handle_events(data)
+
+    def _handle_events(self, data):
+        rv = 0
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                rv += self.invalidate_all()
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if wd not in self._watches or not name:
+                continue
+
+            root, folder = self._watches[wd]
+            filename = os.path.join(folder, name.decode(
+                sys.getfilesystemencoding() or 'utf-8'))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(root, filename)
+                continue
+            rv += self.invalidate(filename, root)
+        return rv
+
+    def invalidate(self, filename, root=None):
+        """Removes all templates that were loaded from `filename` from the
+        cache together with the templates that extend, include or import
+        them.  If the `root` folder of the file is given templates with the
+        same template name are removed as well.  Returns the number of
+        removed templates.
+        """
+        cache = self.environment.cache
+        if cache is None:
+            return 0
+        names = set()
+        if root is not None:
+            names.add(os.path.relpath(filename, root)
+                      .replace(os.path.sep, '/'))
+        for template in list(cache.values()):
+            if template.filename == filename:
+                names.add(template.name)
+        rv = set()
+        for name in names:
+            rv.update(self.environment.invalidate_template(name))
+        return len(rv)
+
+    def invalidate_all(self):
+        """Clears the template cache.  Returns the number of templates that
+        were removed.
+        """
+        cache = self.environment.cache
+        if cache is None:
+            return 0
+        rv = len(cache)
+        cache.clear()
+        self.environment._shared_templates.clear()
+        return rv
+
+    def start(self):
+        """Starts a daemon thread that processes events as they arrive."""
+        if self._thread is not None:
+            raise RuntimeError('watcher already started')
+        self._thread = threading.Thread(target=self._run,
+                                        name='jinja2-inotify-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        import select
+        while not self._closed:
+            try:
+                ready = select.select([self._fd], [], [], 0.5)[0]
+            except (OSError, select.error, ValueError):
+                # the descriptor was closed by `close`
+                return
+            if ready and not self._closed:
+                self.poll()
+
+    def close(self):
+        """Stops watching and releases the inotify descriptor."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
@@ -9,16 +9,19 @@
     :license: BSD, see LICENSE for more details.
 """
 import os
+import codecs
 import tempfile
 import shutil
+from io import BytesIO, StringIO
 
 import pytest
 from jinja2 import Environment, Undefined, DebugUndefined, \
      StrictUndefined, UndefinedError, meta, \
-     is_undefined, Template, DictLoader, make_logging_undefined
+     is_undefined, Template, DictLoader, make_logging_undefined, \
+     ChoiceLoader, FileSystemLoader
 from jinja2.compiler import CodeGenerator
 from jinja2.runtime import Context
-from jinja2.utils import Cycler
+from jinja2.utils import Cycler, missing
 
 
 @pytest.mark.api
@@ -152,6 +155,188 @@ class TestMeta(object):
         i = meta.find_referenced_templates(ast)
         assert list(i) == ['foo.html', 'bar.html', None]
 
+    def test_find_section_templates(self, env):
+        ast = env.parse('{% section "header.html" %}')
+        i = meta.find_referenced_templates(ast)
+        assert list(i) == ['header.html']
+
+
+@pytest.mark.api
+@pytest.mark.dependencies
+class TestDependencies(object):
+
+    def make_env(self, **options):
+        return Environment(loader=DictLoader({
+            'layout.html': '{% block body %}{% endblock %}',
+            'page.html': '{% extends "layout.html" %}',
+            'child.html': '{% extends "page.html" %}'
+                          '{% import "macros.html" as m %}',
+            'macros.html': '',
+            'dynamic.html': '{% include name %}',
+        }), **options)
+
+    def test_get_dependents(self):
+        env = self.make_env()
+        for name in env.list_templates():
+            env.get_template(name)
+        assert env.get_dependents('layout.html') == ['child.html',
+                                                     'page.html']
+        assert env.get_dependents('layout.html', transitive=False) == \
+            ['page.html']
+        assert env.get_dependents('macros.html') == ['child.html']
+        assert env.get_dependents('child.html') == []
+        assert env.dependency_graph.get_dependencies('dynamic.html') == set()
+
+    def test_referenced_templates(self):
+        env = self.make_env()
+        tmpl = env.get_template('child.html')
+        assert tmpl._referenced_templates == ('macros.html', 'page.html')
+
+    def test_invalidate_template(self):
+        env = self.make_env()
+        for name in env.list_templates():
+            env.get_template(name)
+        assert env.invalidate_template('page.html') == ['child.html',
+                                                        'page.html']
+        assert len(env.cache) == 3
+        assert env.invalidate_template('layout.html',
+                                       dependents=False) == ['layout.html']
+        assert len(env.cache) == 2
+
+    def test_overlay_has_own_graph(self):
+        env = self.make_env()
+        env.get_template('page.html')
+        overlay = env.overlay()
+        assert overlay.get_dependents('layout.html') == []
+
+
+@pytest.mark.api
+@pytest.mark.overlay
+class TestOverlayCodeSharing(object):
+
+    def make_env(self, **options):
+        return Environment(loader=DictLoader({
+            'index.html': '{% extends "layout.html" %}'
+                          '{% block body %}{{ foo }}{% endblock %}',
+            'layout.html': '<{% block body %}{% endblock %}>',
+        }), **options)
+
+    def test_shares_code(self):
+        env = self.make_env()
+        tmpl = env.get_template('index.html')
+        overlay = env.overlay()
+        overlay.globals = dict(env.globals, foo='overlay')
+        assert overlay.shares_code_with(env)
+        other = overlay.get_template('index.html')
+        assert other is not tmpl
+        assert other._code is tmpl._code
+        assert other.environment is overlay
+        assert tmpl.render(foo='env') == '<env>'
+        assert other.render() == '<overlay>'
+
+    def test_shares_code_between_overlays(self):
+        env = self.make_env()
+        first = env.overlay(undefined=StrictUndefined)
+        second = env.overlay()
+        tmpl = first.get_template('layout.html')
+        assert second.get_template('layout.html')._code is tmpl._code
+        assert env.get_template('layout.html')._code is tmpl._code
+
+    def test_different_code(self):
+        env = self.make_env()
+        tmpl = env.get_template('index.html')
+        for overlay in [env.overlay(autoescape=True),
+                        env.overlay(finalize=lambda x: x),
+                        env.overlay(trim_blocks=True),
+                        env.overlay(extensions=['jinja2.ext.do'])]:
+            assert not overlay.shares_code_with(env)
+            assert overlay.get_template('index.html')._code \
+                is not tmpl._code
+
+    def test_finalize_shape(self):
+        from jinja2.utils import contextfunction
+        finalize = contextfunction(lambda ctx, x: x)
+        env = self.make_env(finalize=finalize)
+        overlay = env.overlay(finalize=contextfunction(
+            lambda ctx, x: x or 42))
+        assert overlay.shares_code_with(env)
+        env.get_template('index.html')
+        assert overlay.get_template('index.html').render() == '<42>'
+
+    def test_invalidate(self):
+        env = self.make_env()
+        tmpl = env.get_template('layout.html')
+        env.invalidate_template('layout.html')
+        assert env.overlay().get_template('layout.html')._code \
+            is not tmpl._code
+
+    def test_cache_clear_reloads(self):
+        env = self.make_env(auto_reload=False)
+        overlay = env.overlay()
+        assert env.get_template('layout.html').render() == '<>'
+        assert overlay.get_template('layout.html').render() == '<>'
+        env.loader.mapping['layout.html'] = '[{% block body %}{% endblock %}]'
+        env.cache.clear()
+        assert env.get_template('layout.html').render() == '[]'
+        overlay.cache.clear()
+        assert overlay.get_template('layout.html').render() == '[]'
+
+    def test_evicted_template_shared_again(self):
+        env = self.make_env(cache_size=1)
+        overlay = env.overlay(cache_size=10)
+        tmpl = env.get_template('layout.html')
+        assert overlay.get_template('layout.html')._code is tmpl._code
+        env.get_template('index.html')
+        assert env.get_template('layout.html')._code is tmpl._code
+
+
+@pytest.mark.api
+@pytest.mark.snapshot
+class TestCacheSnapshot(object):
+
+    def test_restore(self, tmpdir):
+        mapping = {'layout.html': '[{% block body %}{% endblock %}]',
+                   'page.html': '{% extends "layout.html" %}'
+                                '{% block body %}{{ x }}{% endblock %}'}
+        env = Environment(loader=DictLoader(mapping))
+        env.get_template('page.html')
+        env.get_template('layout.html')
+        snapshot = str(tmpdir.join('snapshot'))
+        assert env.snapshot_cache(snapshot) == 2
+
+        env = Environment(loader=DictLoader(mapping))
+        env.compile = None
+        assert env.restore_cache(snapshot) == 2
+        assert [x[1] for x in env.cache.keys()] == ['layout.html',
+                                                    'page.html']
+        assert env.get_template('page.html').render(x=42) == '[42]'
+        assert env.get_dependents('layout.html') == ['page.html']
+
+    def test_outdated(self, tmpdir):
+        tmpdir.join('a.html').write('A')
+        mapping = {'b.html': 'B'}
+        loader = ChoiceLoader([FileSystemLoader(str(tmpdir)),
+                               DictLoader(mapping)])
+        env = Environment(loader=loader)
+        env.get_template('a.html')
+        env.get_template('b.html')
+        snapshot = str(tmpdir.join('snapshot'))
+        env.snapshot_cache(snapshot)
+
+        tmpdir.join('a.html').write('AA')
+        os.utime(str(tmpdir.join('a.html')), (0, 0))
+        mapping['b.html'] = 'BB'
+        env = Environment(loader=loader)
+        assert env.restore_cache(snapshot) == 2
+        assert env.get_template('a.html').render() == 'AA'
+        assert env.get_template('b.html').render() == 'BB'
+
+    def test_bad_snapshot(self, tmpdir):
+        snapshot = tmpdir.join('snapshot')
+        snapshot.write_binary(b'garbage')
+        env = Environment(loader=DictLoader({}))
+        assert env.restore_cache(str(snapshot)) == 0
+
 
 @pytest.mark.api
 @pytest.mark.streaming
@@ -196,6 +381,96 @@ class TestStreaming(object):
         finally:
             shutil.rmtree(tmp)
 
+    def test_buffered_streaming_by_chars(self, env):
+        tmpl = env.from_string("{% for item in seq %}{{ item }}{% endfor %}")
+        stream = tmpl.stream(seq=['ab', 'cde', 'f', 'ghij', 'k'])
+        stream.enable_buffering(size=None, chars=4)
+        assert list(stream) == [u'abcde', u'fghij', u'k']
+        stream = tmpl.stream(seq=['ab', 'cde', 'f', 'ghij', 'k'])
+        stream.enable_buffering(size=2, chars=4)
+        assert list(stream) == [u'abcde', u'fghij', u'k']
+        pytest.raises(TypeError, stream.enable_buffering, size=None)
+        pytest.raises(ValueError, stream.enable_buffering, chars=0)
+
+    def test_buffered_streaming_by_time(self, env, monkeypatch):
+        import time
+        clock = [0]
+        monkeypatch.setattr(time, 'time', lambda: clock[0])
+
+        def seq():
+            for x in 'abcd':
+                clock[0] += x == 'c' and 10 or 1
+                yield x
+
+        tmpl = env.from_string("{% for item in seq %}{{ item }}{% endfor %}")
+        stream = tmpl.stream(seq=seq())
+        stream.enable_buffering(size=100, interval=5)
+        assert list(stream) == [u'abc', u'd']
+
+    def test_encoded_streaming(self, env):
+        tmpl = env.from_string(u"{% for item in seq %}{{ item }}"
+                               u"{% endfor %}")
+        chunks = list(tmpl.stream(seq=[u'\u2713', u'a', u'bc', u'd'])
+                      .iter_encoded('utf-8', size=4))
+        assert chunks == [b'\xe2\x9c\x93a', b'bcd']
+        assert all(type(x) is bytes for x in chunks)
+        chunks = list(tmpl.stream(seq=[u'a', u'b'])
+                      .iter_encoded('utf-16', size=1))
+        assert b''.join(chunks).decode('utf-16') == u'ab'
+        assert len(chunks) == 2
+        assert list(tmpl.stream(seq=[]).iter_encoded()) == []
+
+
+@pytest.mark.api
+@pytest.mark.streaming
+class TestRenderTo(object):
+
+    @pytest.fixture(params=[False, True], ids=['generator', 'writer'])
+    def write_env(self, request):
+        env = Environment(loader=DictLoader({
+            'base': u'<{% block title %}base{% endblock %}|'
+                    u'{% block body %}{% endblock %}>',
+            'child': u'{% extends "base" %}{% block title %}'
+                     u'{{ super() }}-child{% endblock %}{% block body %}'
+                     u'{% for x in seq %}{% include "item" %}{% endfor %}'
+                     u'{% filter upper %}{% block inner %}a{% endblock %}'
+                     u'{% endfilter %}{% endblock %}',
+            'item': u'[{{ x }}]',
+        }))
+        env.policies['compiler.write_functions'] = request.param
+        return env
+
+    def test_render_to(self, write_env):
+        tmpl = write_env.get_template('child')
+        expected = tmpl.render(seq=[1, 2])
+        assert expected == u'<base-child|[1][2]A>'
+        out = []
+        assert tmpl.render_to(out.append, seq=[1, 2]) is None
+        assert u''.join(out) == expected
+        fp = StringIO()
+        tmpl.render_to(fp, {'seq': [1, 2]})
+        assert fp.getvalue() == expected
+
+    def test_render_to_encoded(self, write_env):
+        fp = BytesIO()
+        write_env.from_string(u'\u2713{{ x }}').render_to(
+            codecs.getwriter('utf-8')(fp), x=u'\u2713')
+        assert fp.getvalue() == b'\xe2\x9c\x93\xe2\x9c\x93'
+
+    def test_write_functions(self, write_env):
+        tmpl = write_env.get_template('child')
+        enabled = write_env.policies['compiler.write_functions']
+        assert hasattr(tmpl.root_render_func, 'write_func') is enabled
+        assert hasattr(tmpl.blocks['body'], 'write_func') is enabled
+
+    def test_render_to_errors(self, write_env):
+        tmpl = write_env.from_string(u'{% for x in seq %}{{ 2 // x }}|'
+                                     u'{% endfor %}')
+        out = []
+        pytest.raises(ZeroDivisionError, tmpl.render_to, out.append,
+                      seq=[1, 0])
+        assert u''.join(out) == u'2|'
+
 
 @pytest.mark.api
 @pytest.mark.undefined
@@ -338,3 +613,49 @@ class TestLowLevel(object):
         env = CustomEnvironment()
         tmpl = env.from_string('{{ foo }}')
         assert tmpl.render() == 'resolve-foo'
+
+    def test_custom_context_slots(self):
+        class CustomContext(Context):
+            def resolve_or_missing(self, key):
+                return 'resolve-' + key
+
+        class CustomEnvironment(Environment):
+            context_class = CustomContext
+
+        env = CustomEnvironment()
+        tmpl = env.from_string('{% block b %}{{ foo }}{{ bar }}{% endblock %}')
+        assert tmpl.render() == 'resolve-fooresolve-bar'
+
+    def test_legacy_custom_context_slots(self):
+        class CustomContext(Context):
+            def resolve(self, key):
+                return 'R:' + key
+
+        class CustomEnvironment(Environment):
+            context_class = CustomContext
+
+        env = CustomEnvironment()
+        assert env.from_string('{{ a }}|{{ b }}').render() == 'R:a|R:b'
+        assert env.from_string('{% block x %}{{ a }}|{{ b }}{% endblock %}'
+                               ).render() == 'R:a|R:b'
+
+    def test_slot_names(self, env):
+        tmpl = env.from_string('{% block b %}{{ foo }}{{ bar }}{% endblock %}'
+                               '{{ baz }}')
+        names = tmpl.root_render_func.__globals__['slot_names']
+        assert sorted(names) == ['bar', 'foo']
+        context = tmpl.new_context({'foo': 1})
+        values = context.resolve_slots(names)
+        assert values[names.index('foo')] == 1
+        assert values[names.index('bar')] is missing
+        assert context.resolve_slots(names) is values
+        context.vars['bar'] = 2
+        assert context.resolve_slots(names)[names.index('bar')] == 2
+
+    def test_slots_see_assignments(self, env):
+        tmpl = env.from_string('{% macro m() %}{{ a }}{{ b }}{% endmacro %}'
+                               '{% block x %}{{ a }}{{ b }}{% endblock %}'
+                               '{{ m() }}{% set a = 1 %}{{ self.x() }}'
+                               '{{ m() }}{% set b = 2 %}{% set a = 3 %}'
+                               '{{ self.x() }}{{ m() }}')
+        assert tmpl.render(b=0) == '01013232'
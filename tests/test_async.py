@@ -1,7 +1,9 @@
 import pytest
 import asyncio
 
-from jinja2 import Template, Environment, DictLoader
+from jinja2 import Template, Environment, DictLoader, PrefixLoader, \
+     ChoiceLoader, FileSystemBytecodeCache
+from jinja2.asyncbccache import AsyncKeyValueBytecodeCache
 from jinja2.exceptions import TemplateNotFound, TemplatesNotFound, \
      UndefinedError
 
@@ -483,3 +485,183 @@ class TestAsyncForLoop(object):
     def test_bare_async(self, test_env_async):
         t = test_env_async.from_string('{% extends "header" %}')
         assert t.render(foo=42) == '[42|23]'
+
+
+class FakeKeyValueServer(object):
+    """A tiny in-process key value server speaking a line based protocol
+    over TCP, used to test the async bytecode cache without a real one.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        while 1:
+            line = await reader.readline()
+            if not line:
+                break
+            command, key, size = line.decode('ascii').split()
+            if command == 'GET':
+                value = self.data.get(key)
+                if value is None:
+                    writer.write(b'-1\n')
+                else:
+                    writer.write(('%d\n' % len(value)).encode('ascii') +
+                                 value)
+            elif command == 'SET':
+                self.data[key] = await reader.readexactly(int(size))
+                writer.write(b'0\n')
+            elif command == 'DELETE':
+                self.data.pop(key, None)
+                writer.write(b'0\n')
+            await writer.drain()
+        writer.close()
+
+    def close(self):
+        self.server.close()
+
+
+class FakeKeyValueClient(object):
+
+    def __init__(self, port):
+        self.port = port
+        self.connection = None
+
+    async def request(self, command, key, value=b''):
+        if self.connection is None:
+            self.connection = await asyncio.open_connection('127.0.0.1',
+                                                            self.port)
+        reader, writer = self.connection
+        writer.write(('%s %s %d\n' % (command, key, len(value)))
+                     .encode('ascii') + value)
+        size = int(await reader.readline())
+        if size >= 0:
+            return await reader.readexactly(size)
+
+    async def get(self, key):
+        return await self.request('GET', key)
+
+    async def set(self, key, value, timeout=None):
+        await self.request('SET', key, value)
+
+    async def delete(self, key):
+        await self.request('DELETE', key)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection[1].close()
+
+
+class AsyncSourceLoader(DictLoader):
+
+    def __init__(self, mapping):
+        DictLoader.__init__(self, mapping)
+        self.loaded = []
+
+    async def get_source_async(self, environment, template):
+        await asyncio.sleep(0)
+        self.loaded.append(template)
+        return self.get_source(environment, template)
+
+
+@pytest.fixture
+def kv_server():
+    server = FakeKeyValueServer()
+    port = run(server.start())
+    client = FakeKeyValueClient(port)
+    yield server, client
+    client.close()
+    server.close()
+
+
+@pytest.mark.byte_code_cache
+class TestAsyncBytecodeCache(object):
+
+    templates = {
+        'layout': '[{% block body %}{% endblock %}]',
+        'index': '{% extends "layout" %}{% block body %}'
+                 '{% include "item" %}{% endblock %}',
+        'item': '{{ x }}',
+    }
+
+    def test_key_value_cache(self, kv_server):
+        server, client = kv_server
+        bcc = AsyncKeyValueBytecodeCache(client, prefix='t/')
+        env = Environment(loader=DictLoader(self.templates),
+                          bytecode_cache=bcc, enable_async=True)
+
+        async def render(env):
+            tmpl = await env.get_template_async('index')
+            return await tmpl.render_async(x=42)
+
+        assert run(render(env)) == '[42]'
+        assert len(server.data) == 3
+        assert all(key.startswith('t/') for key in server.data)
+
+        env = Environment(loader=DictLoader(self.templates),
+                          bytecode_cache=bcc, enable_async=True)
+        env.compile = None
+        assert run(render(env)) == '[42]'
+
+        assert env.invalidate_template('item') == ['index', 'item']
+        assert len(server.data) == 1
+
+    def test_sync_usage(self, kv_server):
+        server, client = kv_server
+        bcc = AsyncKeyValueBytecodeCache(client)
+        env = Environment(loader=DictLoader(self.templates),
+                          bytecode_cache=bcc)
+        assert env.get_template('item').render(x=1) == '1'
+        assert len(server.data) == 1
+        env = Environment(loader=DictLoader(self.templates),
+                          bytecode_cache=bcc)
+        env.compile = None
+        assert env.get_template('item').render(x=1) == '1'
+
+    def test_sync_cache_from_async(self, tmpdir):
+        bcc = FileSystemBytecodeCache(str(tmpdir))
+        env = Environment(loader=DictLoader(self.templates),
+                          bytecode_cache=bcc, enable_async=True)
+        tmpl = run(env.get_template_async('index'))
+        assert tmpl.render(x=1) == '[1]'
+        assert len(tmpdir.listdir()) == 3
+
+
+@pytest.mark.loaders
+class TestAsyncLoaders(object):
+
+    def test_get_source_async(self):
+        loader = AsyncSourceLoader({
+            'layout': '[{% block body %}{% endblock %}]',
+            'index': '{% extends "layout" %}{% block body %}'
+                     '{% from "macros" import m %}{{ m() }}{% endblock %}',
+            'macros': '{% macro m() %}M{% endmacro %}',
+        })
+        env = Environment(loader=loader, enable_async=True)
+        assert env.get_template('index').render() == '[M]'
+        assert loader.loaded == ['layout', 'macros']
+
+    def test_nested_loaders(self):
+        inner = AsyncSourceLoader({'a': 'A'})
+        env = Environment(loader=ChoiceLoader([
+            DictLoader({}),
+            PrefixLoader({'p': inner}),
+        ]), enable_async=True)
+        assert run(env.get_template_async('p/a')).render() == 'A'
+        assert inner.loaded == ['a']
+        pytest.raises(TemplateNotFound, run,
+                      env.get_template_async('p/missing'))
+
+    def test_select_template_async(self):
+        env = Environment(loader=DictLoader({'b': 'B'}), enable_async=True)
+        tmpl = run(env.select_template_async(['a', 'b']))
+        assert tmpl.render() == 'B'
+        tmpl = run(env.get_or_select_template_async('b'))
+        assert tmpl.render() == 'B'
+        pytest.raises(TemplatesNotFound, run,
+                      env.select_template_async(['a', 'c']))
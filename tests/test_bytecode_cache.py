@@ -8,10 +8,13 @@
     :copyright: (c) 2017 by the Jinja Team.
     :license: BSD, see LICENSE for more details.
 """
+import os
+
 import pytest
-from jinja2 import Environment
-from jinja2.bccache import FileSystemBytecodeCache
-from jinja2.exceptions import TemplateNotFound
+from jinja2 import Environment, DictLoader
+from jinja2.bccache import FileSystemBytecodeCache, PackedBytecodeCache, \
+     SharedMemoryBytecodeCache
+from jinja2.exceptions import TemplateNotFound, TemplateSyntaxError
 
 
 @pytest.fixture
@@ -30,3 +33,179 @@ class TestByteCodeCache(object):
         tmpl = env.get_template('test.html')
         assert tmpl.render().strip() == 'BAR'
         pytest.raises(TemplateNotFound, env.get_template, 'missing.html')
+
+    def test_invalidate_removes_bytecode(self, env, tmpdir):
+        env.bytecode_cache = FileSystemBytecodeCache(str(tmpdir))
+        tmpl = env.get_template('test.html')
+        assert len(tmpdir.listdir()) == 1
+        assert env.invalidate_template('test.html') == ['test.html']
+        assert tmpdir.listdir() == []
+
+
+@pytest.mark.byte_code_cache
+class TestPackedBytecodeCache(object):
+
+    def make_env(self, filename, templates, **options):
+        return Environment(loader=DictLoader(templates),
+                           bytecode_cache=PackedBytecodeCache(filename,
+                                                              **options))
+
+    def test_shared_file(self, tmpdir):
+        filename = str(tmpdir.join('cache.pack'))
+        templates = {'a': 'A{{ x }}', 'b': 'B'}
+        # two environments with their own caches act like two processes
+        env1 = self.make_env(filename, templates)
+        env2 = self.make_env(filename, templates)
+        env1.get_template('a')
+        size = tmpdir.join('cache.pack').size()
+        env2.get_template('b')
+        assert tmpdir.join('cache.pack').size() > size
+
+        size = tmpdir.join('cache.pack').size()
+        env1 = self.make_env(filename, templates)
+        env1.get_template('a')
+        env1.get_template('b')
+        # both templates were loaded from the cache, nothing was appended
+        assert tmpdir.join('cache.pack').size() == size
+        assert env1.get_template('a').render(x=1) == 'A1'
+
+    def test_changed_source(self, tmpdir):
+        filename = str(tmpdir.join('cache.pack'))
+        env = self.make_env(filename, {'a': 'A'})
+        env.get_template('a')
+        env = self.make_env(filename, {'a': 'B'})
+        assert env.get_template('a').render() == 'B'
+        assert env.bytecode_cache._dead > 0
+        env = self.make_env(filename, {'a': 'B'})
+        assert env.get_template('a').render() == 'B'
+
+    def test_compaction(self, tmpdir):
+        filename = str(tmpdir.join('cache.pack'))
+        env = self.make_env(filename, {}, compact_size=0)
+        other = self.make_env(filename, {})
+        for x in range(3):
+            env.loader.mapping['a'] = 'A%d' % x
+            env.cache.clear()
+            env.get_template('a')
+        assert env.bytecode_cache._dead == 0
+        # the other process picks up the replaced file
+        other.loader.mapping['a'] = 'A2'
+        assert other.get_template('a').render() == 'A2'
+        assert len(other.bytecode_cache._index) == 1
+
+    def test_bad_header(self, tmpdir):
+        tmpdir.join('cache.pack').write_binary(b'garbage')
+        env = self.make_env(str(tmpdir.join('cache.pack')), {'a': 'A'})
+        assert env.get_template('a').render() == 'A'
+        assert tmpdir.join('cache.pack').read_binary().startswith(b'j2pack')
+
+    def test_clear(self, tmpdir):
+        filename = str(tmpdir.join('cache.pack'))
+        env = self.make_env(filename, {'a': 'A'})
+        env.get_template('a')
+        env.bytecode_cache.clear()
+        assert len(tmpdir.listdir()) == 1
+        assert tmpdir.join('cache.pack').size() < 50
+
+    def test_torn_record(self, tmpdir):
+        filename = str(tmpdir.join('cache.pack'))
+        templates = {'a': 'A', 'b': 'B'}
+        self.make_env(filename, templates).get_template('a')
+        data = tmpdir.join('cache.pack').read_binary()
+        # a process died after writing the start of a record
+        record = data.index(b'j2rc')
+        tmpdir.join('cache.pack').write_binary(
+            data + data[record:record + 30])
+        env = self.make_env(filename, templates)
+        assert env.get_template('b').render() == 'B'
+        assert tmpdir.join('cache.pack').size() > len(data)
+        env = self.make_env(filename, templates)
+        env.compile = None
+        assert env.get_template('a').render() == 'A'
+        assert env.get_template('b').render() == 'B'
+
+    def test_corrupted_record(self, tmpdir):
+        filename = str(tmpdir.join('cache.pack'))
+        self.make_env(filename, {'a': 'A', 'b': 'B'}).get_template('a')
+        data = bytearray(tmpdir.join('cache.pack').read_binary())
+        data[-5] ^= 0xff
+        tmpdir.join('cache.pack').write_binary(bytes(data))
+        env = self.make_env(filename, {'a': 'A', 'b': 'B'})
+        assert env.get_template('a').render() == 'A'
+        assert env.bytecode_cache._dead > 0
+
+    def test_fork(self, tmpdir):
+        fork = getattr(os, 'fork', None)
+        if fork is None:
+            pytest.skip('fork is not available')
+        env = self.make_env(str(tmpdir.join('cache.pack')),
+                            {'a': 'A', 'b': 'B'})
+        env.get_template('a')
+        bcc = env.bytecode_cache
+        pid = fork()
+        if pid == 0:
+            try:
+                env.get_template('b')
+                os._exit(bcc._pid != os.getpid())
+            except BaseException:
+                os._exit(2)
+        assert os.waitpid(pid, 0)[1] == 0
+        assert bcc._pid == os.getpid()
+        env = self.make_env(str(tmpdir.join('cache.pack')), {'a': 'A'})
+        env.compile = None
+        assert env.get_template('a').render() == 'A'
+
+
+@pytest.mark.byte_code_cache
+class TestSharedMemoryBytecodeCache(object):
+
+    def test_preload(self):
+        loader = DictLoader({'a': 'A{{ x }}', 'b': '{% extends "a" %}',
+                             'broken': '{% if %}'})
+        bcc = SharedMemoryBytecodeCache()
+        env = Environment(loader=loader, bytecode_cache=bcc)
+        assert bcc.preload(env) == 2
+        assert bcc.preload(env, names=['a']) == 1
+        assert len(bcc._index) == 2
+
+        env = Environment(loader=loader, bytecode_cache=bcc)
+        compiled = []
+        env.compile = lambda *args, **kwargs: compiled.append(args)
+        assert env.get_template('a').render(x=1) == 'A1'
+        assert env.get_template('b').render(x=2) == 'A2'
+        assert compiled == []
+
+    def test_preload_errors(self):
+        env = Environment(loader=DictLoader({'broken': '{% if %}'}))
+        bcc = SharedMemoryBytecodeCache()
+        pytest.raises(TemplateSyntaxError, bcc.preload, env,
+                      ignore_errors=False)
+
+    def test_fork(self):
+        fork = getattr(os, 'fork', None)
+        if fork is None:
+            pytest.skip('fork is not available')
+        loader = DictLoader({'a': 'A'})
+        bcc = SharedMemoryBytecodeCache()
+        bcc.preload(Environment(loader=loader, bytecode_cache=bcc))
+        env = Environment(loader=loader, bytecode_cache=bcc)
+        pid = fork()
+        if pid == 0:
+            try:
+                env.compile = None
+                os._exit(env.get_template('a').render() != 'A')
+            except BaseException:
+                os._exit(2)
+        assert os.waitpid(pid, 0)[1] == 0
+
+    def test_outdated_and_fallback(self, tmpdir):
+        loader = DictLoader({'a': 'A'})
+        bcc = SharedMemoryBytecodeCache(FileSystemBytecodeCache(str(tmpdir)))
+        bcc.preload(Environment(loader=loader, bytecode_cache=bcc))
+        loader.mapping['a'] = 'B'
+        env = Environment(loader=loader, bytecode_cache=bcc)
+        assert env.get_template('a').render() == 'B'
+        assert len(tmpdir.listdir()) == 1
+        bcc.clear()
+        assert bcc._index == {}
+        assert tmpdir.listdir() == []
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja2.testsuite.cache
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests the template cache policies.
+
+    :copyright: (c) 2017 by the Jinja Team.
+    :license: BSD, see LICENSE for more details.
+"""
+import weakref
+
+import pytest
+
+from jinja2 import Environment, DictLoader, TemplateSyntaxError, nodes
+from jinja2.cache import WeightedLRUCache, TTLCache, LFUCache, \
+     template_weight
+from jinja2.ext import Extension
+from jinja2.utils import LRUCache
+
+
+class FakeTimer(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.cache
+class TestWeightedLRUCache(object):
+
+    def test_evicts_by_weight(self):
+        cache = WeightedLRUCache(10, weigh=len)
+        cache['a'] = 'xxxx'
+        cache['b'] = 'xxxx'
+        assert cache.total_weight == 8
+        cache['a']
+        cache['c'] = 'xxxx'
+        assert cache.keys() == ['c', 'a']
+        assert cache.total_weight == 8
+        assert cache.evictions == 1
+
+    def test_too_heavy(self):
+        cache = WeightedLRUCache(3, weigh=len)
+        cache['a'] = 'xxxx'
+        assert 'a' not in cache
+        assert cache.total_weight == 0
+
+    def test_too_heavy_keeps_entries(self):
+        cache = WeightedLRUCache(10, weigh=lambda x: x)
+        cache['a'] = cache['b'] = cache['c'] = 3
+        cache['d'] = 50
+        assert cache.keys() == ['c', 'b', 'a']
+        assert cache.total_weight == 9
+        assert cache.evictions == 1
+
+    def test_replace(self):
+        cache = WeightedLRUCache(10, weigh=len)
+        cache['a'] = 'xx'
+        cache['a'] = 'xxxxx'
+        assert cache.total_weight == 5
+        del cache['a']
+        assert cache.total_weight == 0
+
+    def test_template_weight(self):
+        env = Environment()
+        small = env.from_string('{{ foo }}')
+        big = env.from_string('{% block x %}' + 'x' * 1000 +
+                              '{% endblock %}')
+        assert template_weight(small) < 1000 < template_weight(big)
+
+    def test_statistics(self):
+        cache = WeightedLRUCache(10, weigh=len)
+        cache['a'] = 'x'
+        assert cache.get('a') == 'x'
+        assert cache.get('b') is None
+        pytest.raises(KeyError, lambda: cache['b'])
+        assert (cache.hits, cache.misses) == (1, 2)
+        cache.reset_statistics()
+        assert (cache.hits, cache.misses, cache.evictions) == (0, 0, 0)
+
+
+@pytest.mark.cache
+class TestTTLCache(object):
+
+    def test_expires(self):
+        timer = FakeTimer()
+        cache = TTLCache(10, 5, timer)
+        cache['a'] = 1
+        timer.now = 4
+        assert cache.get('a') == 1
+        timer.now = 5
+        assert cache.get('a') is None
+        assert 'a' not in cache
+        assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 1)
+
+    def test_capacity(self):
+        cache = TTLCache(2, 5, FakeTimer())
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+        assert cache.keys() == ['c', 'b']
+
+    def test_purge_expired(self):
+        timer = FakeTimer()
+        cache = TTLCache(10, 5, timer)
+        cache['a'] = 1
+        timer.now = 3
+        cache['b'] = 2
+        timer.now = 6
+        cache.purge_expired()
+        assert cache.keys() == ['b']
+
+
+@pytest.mark.cache
+class TestLFUCache(object):
+
+    def test_admission(self):
+        # integer keys have a stable hash which keeps this deterministic
+        cache = LFUCache(2)
+        for key in 1, 2:
+            cache.get(key)
+            cache[key] = key
+        for x in range(3):
+            cache.get(1)
+            cache.get(2)
+
+        # a one hit wonder does not replace popular templates
+        cache.get(3)
+        cache[3] = 3
+        assert sorted(cache.keys()) == [1, 2]
+        assert cache.evictions == 1
+
+        # but a frequently requested one does
+        for x in range(5):
+            cache.get(4)
+        cache[4] = 4
+        assert sorted(cache.keys()) == [2, 4]
+
+    def test_aging(self):
+        cache = LFUCache(2, sample_size=4)
+        for x in range(4):
+            cache.get(1)
+        assert cache._sketch.frequency(1) == 2
+
+
+@pytest.mark.cache
+class TestEnvironmentIntegration(object):
+
+    def test_policy_as_cache_size(self):
+        policy = LFUCache(10)
+        loader = DictLoader({'a': 'A', 'b': 'B'})
+        env = Environment(loader=loader, cache_size=policy)
+        assert env.cache is policy
+        env.get_template('a')
+        env.get_template('a')
+        assert (loader, 'a') not in policy
+        assert (weakref.ref(loader), 'a') in policy
+        assert policy.hits == 1
+
+    def test_overlay_copies_policy(self):
+        env = Environment(cache_size=TTLCache(10, 30))
+        overlay = env.overlay()
+        assert type(overlay.cache) is TTLCache
+        assert overlay.cache is not env.cache
+        assert (overlay.cache.capacity, overlay.cache.ttl) == (10, 30)
+
+
+@pytest.mark.cache
+class TestParseCache(object):
+
+    def test_shared_between_environments(self, monkeypatch):
+        from jinja2 import environment
+        parses = []
+        parse = environment.Parser.parse
+        monkeypatch.setattr(environment.Parser, 'parse',
+                            lambda self: parses.append(1) or parse(self))
+        cache = LRUCache(10)
+        env1 = Environment(parse_cache=cache)
+        env2 = Environment(parse_cache=cache)
+        source = '{% for x in seq %}{{ x + 1 }}{% endfor %}'
+        ast1 = env1.parse(source)
+        ast2 = env2.parse(source)
+        assert len(parses) == 1
+        assert ast1 == ast2
+        assert ast1 is not ast2
+        assert ast1.body[0] is not ast2.body[0]
+        assert all(x.environment is env2 for x in ast2.find_all(nodes.Node))
+
+        # compiling modifies the tree but not the cached one
+        assert env1.from_string(source).render(seq=[1]) == '2'
+        assert env2.from_string(source).render(seq=[1]) == '2'
+        assert env2.overlay().parse(source) == ast1
+        assert len(parses) == 1
+        assert len(cache) == 1
+
+    def test_keys(self):
+        cache = LRUCache(10)
+        env = Environment(parse_cache=cache)
+        env.parse('{{ foo }}')
+        Environment(parse_cache=cache).parse('{{ foo }}')
+        Environment(parse_cache=cache, trim_blocks=True).parse('{{ foo }}')
+        Environment(parse_cache=cache,
+                    extensions=['jinja2.ext.do']).parse('{{ foo }}')
+        env.parse('{{ bar }}')
+        env.parse('{{ bar }}', 'bar.html')
+        assert len(cache) == 5
+
+    def test_name_dependent_extension(self):
+        class UpperExtension(Extension):
+            def preprocess(self, source, name, filename=None):
+                if name is not None and name.endswith('.up'):
+                    return source.upper()
+                return source
+
+        env = Environment(parse_cache=LRUCache(10),
+                          extensions=[UpperExtension],
+                          loader=DictLoader({'a.txt': 'hello',
+                                             'b.up': 'hello'}))
+        assert env.get_template('a.txt').render() == 'hello'
+        assert env.get_template('b.up').render() == 'HELLO'
+
+    def test_shared_cache(self):
+        assert Environment(parse_cache=True).parse_cache is \
+            Environment(parse_cache=True).parse_cache
+        assert Environment().parse_cache is None
+
+    def test_syntax_errors_not_cached(self):
+        cache = LRUCache(10)
+        env = Environment(parse_cache=cache)
+        for x in range(2):
+            pytest.raises(TemplateSyntaxError, env.parse, '{% if %}')
+        assert len(cache) == 0
@@ -11,6 +11,8 @@
 import pytest
 from jinja2 import Environment, TemplateSyntaxError, UndefinedError, \
      DictLoader
+from jinja2.exceptions import TemplateRuntimeError
+from jinja2.runtime import CountingLoopContext
 
 
 @pytest.fixture
@@ -208,6 +210,65 @@ class TestForLoop(object):
                                '{% set x = item %}{{ x }}{% endfor %}')
         assert tmpl.render(x=0, seq=[1, 2, 3]) == '919293'
 
+    def test_counting_loop_context(self, env):
+        def gen(log):
+            for x in range(3):
+                log.append(x)
+                yield x
+
+        tmpl = env.from_string('{% for item in seq %}{{ log|length }}'
+                               '{{ loop.index }}{{ loop.cycle("a", "b") }}'
+                               '{% if loop.first %}!{% endif %}{% endfor %}')
+        assert 'CountingLoopContext(' in env.compile(
+            '{% for x in y %}{{ loop.index }}{% endfor %}', raw=True)
+        log = []
+        assert tmpl.render(seq=gen(log), log=log) == '11a!22b33a'
+
+        tmpl = env.from_string('{% for item in seq %}{{ log|length }}'
+                               '{% if loop.last %}!{% endif %}{% endfor %}')
+        log = []
+        assert tmpl.render(seq=gen(log), log=log) == '233!'
+
+    @pytest.mark.parametrize('source', [
+        '{% for x in y %}{{ loop.last }}{% endfor %}',
+        '{% for x in y %}{{ loop.length }}{% endfor %}',
+        '{% for x in y %}{{ loop }}{% endfor %}',
+        '{% for x in y %}{{ loop|attr("index") }}{% endfor %}',
+        '{% for x in y %}{% for z in x %}{{ loop.revindex }}'
+        '{% endfor %}{{ loop.index }}{% endfor %}',
+        '{% for x in y %}{{ loop.index }}{% include "i" %}{% endfor %}',
+        '{% for x in y %}{{ loop.index }}{% import "i" as i with context %}'
+        '{% endfor %}',
+        '{% for x in y %}{{ loop.index }}{% block b scoped %}{% endblock %}'
+        '{% endfor %}',
+        '{% for x in y %}{% include "a" ~ loop.length without context %}'
+        '{% endfor %}',
+    ])
+    def test_full_loop_context(self, env, source):
+        code = env.compile(source, raw=True)
+        assert 'CountingLoopContext(' not in code
+        assert 'LoopContext(' in code
+
+    def test_loop_passed_to_include(self):
+        env = Environment(loader=DictLoader({
+            'i': '[{{ loop.last }}|{{ loop.length }}]'}))
+        tmpl = env.from_string('{% for x in seq %}{{ loop.index }}'
+                               '{% include "i" %}{% endfor %}')
+        assert tmpl.render(seq=[1, 2]) == '1[False|2]2[True|2]'
+        assert 'CountingLoopContext(' in env.compile(
+            '{% for x in seq %}{{ loop.index }}'
+            '{% include "i" without context %}{% endfor %}', raw=True)
+        tmpl = env.from_string('{% for x in seq %}{% include "a" ~ '
+                               'loop.length without context %}{% endfor %}')
+        env.loader.mapping['a2'] = 'A2'
+        assert tmpl.render(seq=[1, 2]) == 'A2A2'
+
+    def test_counting_loop_context_unsupported(self):
+        loop = CountingLoopContext([1, 2])
+        for attr in 'last', 'length', 'revindex', 'revindex0':
+            with pytest.raises(TemplateRuntimeError):
+                getattr(loop, attr)
+
 
 @pytest.mark.core_tags
 @pytest.mark.if_condition
@@ -343,6 +404,32 @@ class TestMacros(object):
         assert tmpl.module.m(1, 2, 3) == '1|2|3'
         assert tmpl.module.m(1, x=7) == '1|7|7'
 
+    def test_argument_binding(self, env):
+        tmpl = env.from_string(
+            '{% macro m(a, b=2) %}{{ a }}|{{ b }}{% endmacro %}'
+            '{% macro c() %}{{ caller(1, b=3) }}{% endmacro %}')
+        m = tmpl.module.m
+        assert m._binder is not None
+        assert tmpl.module.c._binder is None
+        assert m(1) == '1|2'
+        assert m(b=3, a=1) == '1|3'
+        assert m() == '|2'
+        with pytest.raises(TypeError) as excinfo:
+            m(1, 2, 3)
+        assert 'takes not more than 2 argument(s)' in str(excinfo.value)
+        with pytest.raises(TypeError) as excinfo:
+            m(1, c=2)
+        assert 'no keyword argument \'c\'' in str(excinfo.value)
+        caller = env.from_string('{% call(a, b) c() %}{{ a }}{{ b }}'
+                                 '{% endcall %}')
+        assert caller.render(c=tmpl.module.c) == '13'
+
+    def test_keyword_argument_names(self, env):
+        tmpl = env.from_string('{% macro m(class, x) %}{{ class }}{{ x }}'
+                               '{% endmacro %}')
+        assert tmpl.module.m._binder is None
+        assert tmpl.module.m(1, x=2) == '12'
+
 
 @pytest.mark.core_tags
 @pytest.mark.set
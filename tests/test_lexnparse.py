@@ -12,9 +12,10 @@ import pytest
 
 from jinja2 import Environment, Template, TemplateSyntaxError, \
      UndefinedError, nodes
-from jinja2._compat import iteritems, text_type, PY2
+from jinja2._compat import iteritems, text_type, PY2, intern
 from jinja2.lexer import Token, TokenStream, TOKEN_EOF, \
-     TOKEN_BLOCK_BEGIN, TOKEN_BLOCK_END
+     TOKEN_BLOCK_BEGIN, TOKEN_BLOCK_END, Lexer, CombinedLexer, get_lexer, \
+     _token_expressions
 
 
 # how does a string look like in jinja syntax?
@@ -52,6 +53,26 @@ class TestTokenStream(object):
         ]
         assert token_types == ['block_begin', 'block_end', ]
 
+    def test_token_expressions(self, env):
+        token = Token(1, 'name', 'foo')
+        for x in range(2):
+            assert token.test('name')
+            assert token.test('name:foo')
+            assert not token.test('name:bar')
+            assert not token.test('string:foo')
+            assert token.test_any('integer', 'name:foo')
+
+    def test_token_expressions_bounded(self, env):
+        for x in range(1000):
+            env.parse('{%% block b%d %%}{%% endblock b%d %%}' % (x, x))
+        assert len(_token_expressions) <= _token_expressions.capacity
+
+    def test_interned_types(self, env):
+        stream = env.lexer.tokenize('{% for x in y %}{{ x + 1 }}{% endfor %}')
+        for token in stream:
+            assert token.type is intern(token.type)
+            assert type(token) is Token
+
 
 @pytest.mark.lexnparse
 @pytest.mark.lexer
@@ -127,6 +148,113 @@ class TestLexer(object):
                 assert result == expect, (keep, template, result, expect)
 
 
+def _lex(lexer, source, state=None):
+    try:
+        return list(lexer.tokeniter(source, 'test', state=state))
+    except TemplateSyntaxError as e:
+        return ('error', e.message, e.lineno)
+
+
+@pytest.mark.lexnparse
+@pytest.mark.lexer
+class TestCombinedLexer(object):
+    """The combined lexer has to produce exactly the same tokens and errors
+    as the rule by rule lexer.
+    """
+
+    sources = [
+        u'',
+        u'just data\r\nwith\rnewlines\n',
+        u'{{ foo }}{% if bar %}{{ baz|e }}{% endif %}',
+        u'{% for x in [1, 2.5, (3, 4), {"a": \'b\'}] %}{{ x }}{% endfor %}',
+        u'{{ {"a": {"b": 1}}["a"] }}{{ (1, (2, 3)) }}{{ [[1], [2]] }}',
+        u'{{ 1 // 2 ** 3 % 4 ~ "x" != 5 <= 6 >= 7 == 8 }}',
+        u'{# comment\n with newline #}  {#- trimmed -#}  x',
+        u'{% raw %}{{ not parsed }}{% endraw %}{%- raw -%} x {%- endraw -%}',
+        u'  {%- if x -%}  \n  {{- y -}}  \n{%+ endif %}\n',
+        u'{{ "a\\"b" }}{{ \'multi\nline\' }}',
+        u'{% macro m(a, b=1) %}{{ caller() }}{% endmacro %}',
+        u'{{ f(a=1)(b)[c].d }}',
+        u'# for x in y\n  ${x}\n# endfor\n## a line comment\nx ## trailing',
+        u'<% if x %><%= y %><# c #><% endif %>',
+        u'{{ unclosed',
+        u'{% if x %}{{ x ) }}{% endif %}',
+        u'{{ (x] }}',
+        u'{{ x }',
+        u'{# unclosed comment',
+        u'{% raw %} unclosed raw',
+        u'{{ 1 $ 2 }}',
+        u'{{ unicode \xe4\xf6\xfc }}\u2028after',
+    ]
+
+    configs = [
+        {},
+        {'trim_blocks': True},
+        {'lstrip_blocks': True},
+        {'trim_blocks': True, 'lstrip_blocks': True},
+        {'keep_trailing_newline': True},
+        {'line_statement_prefix': '#', 'line_comment_prefix': '##'},
+        {'block_start_string': '<%', 'block_end_string': '%>',
+         'variable_start_string': '<%=', 'variable_end_string': '%>',
+         'comment_start_string': '<#', 'comment_end_string': '#>'},
+        {'variable_start_string': '${', 'variable_end_string': '}',
+         'line_statement_prefix': '#', 'lstrip_blocks': True},
+        {'newline_sequence': '\r\n'},
+    ]
+
+    @pytest.mark.parametrize('config', configs)
+    def test_same_tokens(self, config):
+        env = Environment(**config)
+        lexer = Lexer(env)
+        combined = CombinedLexer(env)
+        for source in self.sources:
+            assert _lex(combined, source) == _lex(lexer, source), source
+            for state in 'variable', 'block':
+                assert _lex(combined, source, state) == \
+                    _lex(lexer, source, state), source
+
+    def test_same_stream(self):
+        env = Environment(trim_blocks=True)
+        for source in self.sources:
+            try:
+                expected = list(Lexer(env).tokenize(source))
+            except TemplateSyntaxError:
+                continue
+            assert list(CombinedLexer(env).tokenize(source)) == expected
+
+    @pytest.mark.parametrize('keep_trailing_newline', [False, True])
+    def test_prepare_source(self, keep_trailing_newline):
+        def reference(source):
+            lines = source.splitlines()
+            if keep_trailing_newline and source:
+                for newline in ('\r\n', '\r', '\n'):
+                    if source.endswith(newline):
+                        lines.append('')
+                        break
+            return '\n'.join(lines)
+
+        lexer = Lexer(Environment(keep_trailing_newline=keep_trailing_newline))
+        for source in [u'', u'\n', u'\n\n', u'a\r\nb\rc\n', u'a\r\n',
+                       u'a\r', u'a\r\r\n', u'a\x0cb\x0c', u'\u2028a\x85',
+                       u'a\x1c\x1d\x1eb\x0b']:
+            assert lexer._prepare_source(source) == reference(source)
+
+    def test_source_not_copied(self):
+        lexer = Lexer(Environment(keep_trailing_newline=True))
+        source = u'{{ foo }}\n' * 10
+        assert lexer._prepare_source(source) is source
+
+    def test_normalize_newlines(self):
+        env = Environment(newline_sequence='\r\n')
+        tmpl = env.from_string(u'a\nb\r\nc{{ "d\ne" }}')
+        assert tmpl.render() == u'a\r\nb\r\ncd\r\ne'
+
+    def test_get_lexer(self):
+        env = Environment()
+        assert isinstance(get_lexer(env), CombinedLexer)
+        assert get_lexer(env) is get_lexer(Environment())
+
+
 @pytest.mark.lexnparse
 @pytest.mark.parser
 class TestParser(object):
@@ -244,6 +372,120 @@ and bar comment #}
                      "Encountered unknown tag 'unknown_tag'.")
 
 
+def _linenos(node):
+    return [(type(x).__name__, x.lineno)
+            for x in [node] + list(node.find_all(nodes.Node))]
+
+
+@pytest.mark.lexnparse
+@pytest.mark.parser
+class TestIncrementalParser(object):
+    source = (u'{% extends "base" %}\n'
+              u'{# comment #}\n'
+              u'{% block a %}hello {{ x }}{% endblock %}\n'
+              u'  {% raw %}{{ raw }}{% endraw %}\n'
+              u'{% for i in seq -%}\n'
+              u'   {{ i }}\n'
+              u'{%- endfor %}\n'
+              u'{% macro m(a) %}{{ a }}{% endmacro %}\n'
+              u'text {{ y|upper }} more\n')
+
+    def check(self, env, ast, source, start, end, text):
+        rv = env.reparse(ast, source, start, end, text)
+        expected = env.parse(source[:start] + text + source[end:])
+        assert rv == expected
+        assert _linenos(rv) == _linenos(expected)
+        return rv
+
+    @pytest.mark.parametrize('options', [{}, {
+        'trim_blocks': True,
+        'lstrip_blocks': True,
+    }, {
+        'keep_trailing_newline': True,
+    }])
+    def test_edits(self, options):
+        env = Environment(**options)
+        source = self.source
+        ast = env.reparse(None, u'', 0, 0, source)
+        edits = [
+            (source.index('hello'), 5, u'bye\n'),
+            (source.index('{{ raw }}'), 2, u''),
+            (source.index('-%}'), 1, u''),
+            (source.index('{%- endfor'), 0, u'{% if i %}x{% endif %}\n'),
+            (source.index('text'), 0, u'{{ z }}\n\n'),
+            (source.index('{# comment'), 2, u'{{'),
+            (len(source) - 1, 1, u'{% block b %}{% endblock %}'),
+            (0, 0, u'\n'),
+        ]
+        for text in (u'{', u'\n', u'{% if a %}b{% endif %}'):
+            for offset in range(0, len(source), 2):
+                edits.append((offset, 0, text))
+        for offset, length, text in edits:
+            new_source = source[:offset] + text + source[offset + length:]
+            try:
+                env.parse(new_source)
+            except TemplateSyntaxError:
+                pytest.raises(TemplateSyntaxError, env.reparse, ast, source,
+                              offset, offset + length, text)
+                continue
+            self.check(env, ast, source, offset, offset + length, text)
+            ast = env.reparse(None, u'', 0, 0, source)
+
+    def test_line_statements(self):
+        env = Environment(line_statement_prefix='#',
+                          line_comment_prefix='##')
+        source = (u'# for i in x\n  {{ i }} ## comment\n# endfor\n'
+                  u'{% if a %}b{% endif %} ## c2\ntext\n')
+        ast = env.reparse(None, u'', 0, 0, source)
+        for offset in range(len(source)):
+            for text in (u'#', u'\n', u'## '):
+                new_source = source[:offset] + text + source[offset:]
+                try:
+                    env.parse(new_source)
+                except TemplateSyntaxError:
+                    continue
+                self.check(env, ast, source, offset, offset, text)
+                ast = env.reparse(None, u'', 0, 0, source)
+
+    def test_reuse(self, env):
+        source = u''.join(u'{%% block b%d %%}{{ x }}{%% endblock %%}\n' % x
+                          for x in range(10))
+        ast = env.reparse(None, u'', 0, 0, source)
+        offset = source.index('{{ x }}{% endblock %}\n{% block b5')
+        rv = self.check(env, ast, source, offset, offset, u'\n\n')
+        assert len(rv.body) == 19
+        for idx, node in enumerate(rv.body):
+            if idx in (7, 8):
+                assert node is not ast.body[idx]
+            else:
+                assert node is ast.body[idx]
+        assert rv.body[12].lineno == 9
+
+    def test_successive_edits(self, env):
+        source = u'{% for x in y %}{{ x }}{% endfor %}'
+        ast = env.reparse(None, u'', 0, 0, source)
+        for text in (u' a', u' {{ b }}', u'{% if c %}d{% endif %}'):
+            ast = self.check(env, ast, source, len(source), len(source),
+                             text)
+            source += text
+        assert env.from_string(ast).render(y=[1], b=2, c=True) == '1 a 2d'
+
+    def test_fallback(self, env):
+        source = u'a\r\n{{ x }}\r\nb'
+        ast = env.reparse(None, u'', 0, 0, source)
+        self.check(env, ast, source, 1, 1, u'c')
+        # trees that were not created by reparse are parsed completely
+        ast = env.parse(u'{{ x }}')
+        self.check(env, ast, u'{{ x }}', 0, 0, u'y')
+        self.check(env, None, u'{{ x }}', 0, 0, u'y')
+
+    def test_syntax_error(self, env):
+        source = u'{% if x %}y{% endif %}'
+        ast = env.reparse(None, u'', 0, 0, source)
+        pytest.raises(TemplateSyntaxError, env.reparse, ast, source,
+                      0, 2, u'')
+
+
 @pytest.mark.lexnparse
 @pytest.mark.syntax
 class TestSyntax(object):
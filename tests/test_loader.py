@@ -18,7 +18,7 @@ import weakref
 from jinja2 import Environment, loaders
 from jinja2._compat import PYPY, PY2
 from jinja2.loaders import split_template_path
-from jinja2.exceptions import TemplateNotFound
+from jinja2.exceptions import TemplateNotFound, TemplateSyntaxError
 
 
 @pytest.mark.loaders
@@ -79,6 +79,22 @@ class TestLoaders(object):
         assert tmpl is not env.get_template('template')
         changed = False
 
+    def test_auto_reload_interval(self):
+        checks = []
+
+        class TestLoader(loaders.BaseLoader):
+            def get_source(self, environment, template):
+                return u'foo', None, lambda: checks.append(1) or True
+        env = Environment(loader=TestLoader(), auto_reload_interval=60)
+        tmpl = env.get_template('template')
+        for x in range(5):
+            assert tmpl is env.get_template('template')
+        assert not checks
+        tmpl._last_checked -= 60
+        assert tmpl is env.get_template('template')
+        assert tmpl is env.get_template('template')
+        assert len(checks) == 1
+
     def test_no_cache(self):
         mapping = {'foo': 'one'}
         env = Environment(loader=loaders.DictLoader(mapping), cache_size=0)
@@ -124,7 +140,8 @@ class TestLoaders(object):
 class TestModuleLoader(object):
     archive = None
 
-    def compile_down(self, prefix_loader, zip='deflated', py_compile=False):
+    def compile_down(self, prefix_loader, zip='deflated', py_compile=False,
+                     workers=None):
         log = []
         self.reg_env = Environment(loader=prefix_loader)
         if zip is not None:
@@ -134,7 +151,8 @@ class TestModuleLoader(object):
             self.archive = tempfile.mkdtemp()
         self.reg_env.compile_templates(self.archive, zip=zip,
                                        log_function=log.append,
-                                       py_compile=py_compile)
+                                       py_compile=py_compile,
+                                       workers=workers)
         self.mod_env = Environment(loader=loaders.ModuleLoader(self.archive))
         return ''.join(log)
 
@@ -175,6 +193,78 @@ class TestModuleLoader(object):
         self.compile_down(prefix_loader, zip=None)
         self._test_common()
 
+    @pytest.mark.skipif(not hasattr(os, 'fork'),
+                        reason='workers require fork')
+    def test_parallel_compile(self, prefix_loader):
+        serial_log = self.compile_down(prefix_loader, zip=None)
+        serial_log = serial_log.replace(self.archive, '')
+        serial = dict((x, open(os.path.join(self.archive, x)).read())
+                      for x in os.listdir(self.archive))
+        self.teardown()
+        log = self.compile_down(prefix_loader, zip=None, workers=2)
+        assert log.replace(self.archive, '') == serial_log
+        for filename, source in serial.items():
+            with open(os.path.join(self.archive, filename)) as f:
+                assert f.read() == source
+        self._test_common()
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'),
+                        reason='workers require fork')
+    def test_parallel_compile_errors(self, prefix_loader):
+        env = Environment(loader=prefix_loader)
+        fd, self.archive = tempfile.mkstemp(suffix='.zip')
+        os.close(fd)
+        with pytest.raises(TemplateSyntaxError) as excinfo:
+            env.compile_templates(self.archive, ignore_errors=False,
+                                  workers=2)
+        assert excinfo.value.name == 'a/syntaxerror.html'
+        os.remove(self.archive)
+
+    @pytest.mark.parametrize('zip', [None, 'deflated'])
+    def test_incremental_compile(self, zip):
+        mapping = {
+            'layout.html': '{% block body %}{% endblock %}',
+            'index.html': '{% extends "layout.html" %}'
+                          '{% block body %}{% include "row.html" %}'
+                          '{% endblock %}',
+            'row.html': 'row',
+            'other.html': 'other',
+        }
+        env = Environment(loader=loaders.DictLoader(mapping))
+        if zip is not None:
+            fd, self.archive = tempfile.mkstemp(suffix='.zip')
+            os.close(fd)
+            os.remove(self.archive)
+        else:
+            self.archive = tempfile.mkdtemp()
+        manifest = os.path.normpath(self.archive) + '.manifest'
+
+        def compile_down():
+            log = []
+            env.compile_templates(self.archive, zip=zip, incremental=True,
+                                  log_function=log.append)
+            return sorted(x.split('"')[1] for x in log
+                          if x.startswith(('Compiled', 'Removed')))
+
+        try:
+            assert compile_down() == sorted(mapping)
+            assert compile_down() == []
+
+            mapping['row.html'] = 'new row'
+            assert compile_down() == ['index.html', 'row.html']
+
+            del mapping['other.html']
+            assert compile_down() == ['other.html']
+
+            self.mod_env = Environment(
+                loader=loaders.ModuleLoader(self.archive))
+            assert self.mod_env.get_template('index.html').render() == \
+                'new row'
+            pytest.raises(TemplateNotFound, self.mod_env.get_template,
+                          'other.html')
+        finally:
+            os.remove(manifest)
+
     def test_weak_references(self, prefix_loader):
         self.compile_down(prefix_loader)
         tmpl = self.mod_env.get_template('a/test.html')
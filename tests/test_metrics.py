@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja2.testsuite.metrics
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests the metrics an environment reports.
+
+    :copyright: (c) 2017 by the Jinja Team.
+    :license: BSD, see LICENSE for more details.
+"""
+import shutil
+import tempfile
+from io import StringIO
+
+import pytest
+
+from jinja2 import Environment, DictLoader, FileSystemBytecodeCache, \
+     TemplateSyntaxError, UndefinedError, StrictUndefined
+from jinja2.metrics import MetricsSink, MemoryMetrics, Histogram
+from jinja2.sandbox import SandboxedEnvironment
+from jinja2.utils import have_async_gen
+
+
+templates = {
+    'index.html': u'{% extends "base.html" %}'
+                  u'{% block body %}{{ title }}{% endblock %}',
+    'base.html': u'<h1>{% block body %}{% endblock %}</h1>'
+                 u'{% include "footer.html" %}',
+    'footer.html': u'{{ footer }}',
+    'broken.html': u'{{ foo.bar.baz }}',
+}
+
+
+@pytest.fixture
+def metrics():
+    return MemoryMetrics()
+
+
+@pytest.mark.metrics
+class TestMetrics(object):
+
+    def test_render(self, metrics):
+        env = Environment(loader=DictLoader(templates), metrics=metrics)
+        tmpl = env.get_template('index.html')
+        for x in range(3):
+            tmpl.render(title=u'Title', footer=u'Footer')
+        histogram = metrics.histogram('render', 'index.html')
+        assert histogram.count == 3
+        assert histogram.total > 0
+        assert sum(histogram.counts) == 3
+        assert metrics.histogram('render', 'base.html').count == 0
+
+    def test_render_to(self, metrics):
+        env = Environment(metrics=metrics)
+        out = StringIO()
+        env.from_string(u'{{ 42 }}').render_to(out)
+        assert out.getvalue() == u'42'
+        assert metrics.histogram('render', None).count == 1
+
+    def test_render_error(self, metrics):
+        env = Environment(loader=DictLoader(templates), metrics=metrics)
+        with pytest.raises(UndefinedError):
+            env.get_template('broken.html').render()
+        assert metrics.counter('render.error', 'broken.html') == 1
+        assert metrics.histogram('render', 'broken.html').count == 0
+
+    def test_template_cache(self, metrics):
+        env = Environment(loader=DictLoader(templates), metrics=metrics)
+        env.get_template('index.html').render()
+        env.get_template('index.html').render()
+        assert metrics.counter('template_cache.miss', 'index.html') == 1
+        assert metrics.counter('template_cache.hit', 'index.html') == 1
+        assert metrics.counter('template_cache.miss', 'base.html') == 1
+        assert metrics.counter('template_cache.hit', 'base.html') == 1
+        assert metrics.counter('template_cache.miss', 'footer.html') == 1
+
+    def test_compile(self, metrics):
+        env = Environment(loader=DictLoader(templates), metrics=metrics)
+        env.get_template('index.html')
+        env.get_template('index.html')
+        assert metrics.histogram('compile', 'index.html').count == 1
+        env.compile(u'{{ foo }}', raw=True)
+        assert metrics.histogram('compile', None).count == 1
+        with pytest.raises(TemplateSyntaxError):
+            env.from_string(u'{% if %}')
+        assert metrics.histogram('compile', None).count == 1
+
+    def test_bytecode_cache(self, metrics):
+        directory = tempfile.mkdtemp()
+        try:
+            for x in range(2):
+                env = Environment(loader=DictLoader(templates),
+                                  bytecode_cache=FileSystemBytecodeCache(
+                                      directory),
+                                  metrics=metrics)
+                env.get_template('footer.html')
+        finally:
+            shutil.rmtree(directory)
+        assert metrics.counter('bytecode_cache.miss', 'footer.html') == 1
+        assert metrics.counter('bytecode_cache.hit', 'footer.html') == 1
+        assert metrics.histogram('compile', 'footer.html').count == 1
+
+    @pytest.mark.skipif(not have_async_gen, reason='requires async support')
+    def test_async_loading(self, metrics):
+        import asyncio
+        directory = tempfile.mkdtemp()
+        try:
+            for x in range(2):
+                env = Environment(loader=DictLoader(templates),
+                                  bytecode_cache=FileSystemBytecodeCache(
+                                      directory),
+                                  enable_async=True, metrics=metrics)
+                for y in range(2):
+                    tmpl = asyncio.get_event_loop().run_until_complete(
+                        env.get_template_async('index.html'))
+                assert asyncio.get_event_loop().run_until_complete(
+                    tmpl.render_async(title=u'x')) == u'<h1>x</h1>'
+        finally:
+            shutil.rmtree(directory)
+        assert metrics.counter('template_cache.miss', 'index.html') == 2
+        assert metrics.counter('template_cache.hit', 'index.html') == 2
+        assert metrics.counter('template_cache.miss', 'base.html') == 2
+        assert metrics.counter('bytecode_cache.miss', 'index.html') == 1
+        assert metrics.counter('bytecode_cache.hit', 'index.html') == 1
+        assert metrics.counter('bytecode_cache.hit', 'base.html') == 1
+        assert metrics.histogram('render', 'index.html').count == 2
+
+    def test_undefined(self, metrics):
+        env = Environment(loader=DictLoader(templates), metrics=metrics)
+        tmpl = env.get_template('index.html')
+        tmpl.render(footer=u'Footer')
+        tmpl.render()
+        assert metrics.counter('undefined', 'index.html') == 2
+        assert metrics.counter('undefined', 'footer.html') == 1
+        assert metrics.counter('undefined', 'base.html') == 0
+
+    def test_undefined_lookups(self, metrics):
+        env = Environment(loader=DictLoader({
+            'lookup.html': u'{{ z }}|{{ d.q }}|{{ d["r"] }}|{{ d.a }}'}),
+            metrics=metrics)
+        assert env.get_template('lookup.html').render(d={'a': 1}) == \
+            u'|||1'
+        assert metrics.counter('undefined', 'lookup.html') == 1
+        assert metrics.counter('undefined') == 2
+
+    def test_undefined_lookups_sandbox(self, metrics):
+        env = SandboxedEnvironment(metrics=metrics)
+        env.from_string(u'{{ d.q }}{{ d["r"] }}').render(d={})
+        assert metrics.counter('undefined') == 2
+
+    def test_undefined_in_macro(self, metrics):
+        env = Environment(metrics=metrics, undefined=StrictUndefined)
+        tmpl = env.from_string(u'{% macro m(x) %}{{ x is defined }}'
+                               u'{% endmacro %}{{ m() }}{{ m(1) }}')
+        assert tmpl.render() == u'FalseTrue'
+        assert metrics.counter('undefined') == 1
+
+    def test_sink_set_later(self, metrics):
+        env = Environment()
+        tmpl = env.from_string(u'{{ foo }}')
+        env.metrics = metrics
+        tmpl.render()
+        assert metrics.histogram('render').count == 1
+        assert metrics.counter('undefined') == 1
+
+    def test_no_sink(self):
+        env = Environment(loader=DictLoader(templates))
+        assert env.metrics is None
+        assert env.get_template('index.html').render(title=u'x') == \
+            u'<h1>x</h1>'
+
+    def test_overlay(self, metrics):
+        env = Environment(loader=DictLoader(templates))
+        overlay = env.overlay(metrics=metrics)
+        overlay.get_template('footer.html').render()
+        env.get_template('footer.html').render()
+        assert metrics.histogram('render', 'footer.html').count == 1
+
+    def test_base_sink(self):
+        env = Environment(loader=DictLoader(templates),
+                          metrics=MetricsSink())
+        assert env.get_template('index.html').render(title=u'x') == \
+            u'<h1>x</h1>'
+
+
+@pytest.mark.metrics
+class TestMemoryMetrics(object):
+
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1.0))
+        for seconds in 0.05, 0.1, 0.5, 2.0:
+            histogram.add(seconds)
+        assert histogram.counts == [2, 1, 1]
+        assert histogram.count == 4
+        assert histogram.mean == pytest.approx(2.65 / 4)
+        assert Histogram().mean == 0.0
+
+    def test_counters(self, metrics):
+        metrics.increment('foo')
+        metrics.increment('foo', value=2)
+        metrics.increment('foo', 'index.html')
+        assert metrics.counter('foo') == 3
+        assert metrics.counter('foo', 'index.html') == 1
+        assert metrics.counter('bar') == 0
+        metrics.clear()
+        assert metrics.counter('foo') == 0
+
+    def test_buckets(self):
+        metrics = MemoryMetrics(buckets=(1.0, 0.5))
+        metrics.timing('render', 0.7)
+        assert metrics.histogram('render').buckets == (0.5, 1.0)
+        assert metrics.histogram('render').counts == [0, 1, 0]
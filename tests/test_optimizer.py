@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja2.testsuite.optimizer
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests the optimization passes that run before code generation.
+
+    :copyright: (c) 2017 by the Jinja Team.
+    :license: BSD, see LICENSE for more details.
+"""
+import pytest
+
+from jinja2 import Environment, DictLoader, StrictUndefined, nodes
+from jinja2.optimizer import optimize_template, passes
+from jinja2.sandbox import SandboxedEnvironment
+
+
+pass_names = [name for name, _ in passes]
+
+corpus = [
+    u'{% if true %}yes{% else %}no{% endif %}',
+    u'{% if 1 > 2 %}a{% elif 2 > 1 %}b{% else %}c{% endif %}',
+    u'{% if foo %}a{% elif false %}b{% else %}c{% endif %}',
+    u'{% if none %}{% set x = 1 %}{% else %}{% set x = 2 %}{% endif %}{{ x }}',
+    u'{% for x in [] %}{{ x }}{% else %}empty{% endfor %}',
+    u'{% for x in "" %}{{ x }}{% endfor %}done',
+    u'{% for x in [] %}{{ x }}{% else %}{% set y = 1 %}{{ y }}'
+    u'{% endfor %}{{ y }}',
+    u'{% for x in [1, 2] %}{{ x }}{% else %}empty{% endfor %}',
+    u'{% set x = 42 %}{{ x }} {{ x + 1 }}',
+    u'{% set x = "<b>" %}{{ x }}{{ x|upper }}',
+    u'{% set x = 1 %}{% set x = 2 %}{{ x }}',
+    u'{{ x }}{% set x = 1 %}{{ x }}',
+    u'{% if foo %}{% set x = 1 %}{% endif %}{{ x }}',
+    u'{% set x = 1 %}{% macro m() %}{{ x }}{% endmacro %}{{ m() }}',
+    u'{% set x = 1 %}{% for i in seq %}{{ x }}{{ loop.index }}{% endfor %}',
+    u'{% set x = 1 %}{% for x in seq %}{{ x }}{% endfor %}{{ x }}',
+    u'{% set debug = false %}{% if debug %}debug{% endif %}release',
+    u'{% set x = [1] %}{{ x }}',
+    u'{% for i in seq %}{{ name|upper }}{{ i }}{% endfor %}',
+    u'{% for i in seq %}{{ name|upper }}{{ name|upper }}'
+    u'{{ name|lower }}{% endfor %}',
+    u'{% for i in seq %}{{ i|upper }}{% endfor %}',
+    u'{% for i in seq %}{% set name = i %}{{ name|upper }}{% endfor %}',
+    u'{% for i in seq %}{{ name|truncate(3) }}{% endfor %}',
+    u'{% for i in seq %}{{ name|upper }}{{ f() }}{% endfor %}',
+    u'{% for i in seq %}{% for j in seq %}{{ name|title }}{{ j }}'
+    u'{% endfor %}{% endfor %}',
+    u'{% for i in seq %}{{ missing|upper }}{% endfor %}',
+    u'{% for i in [] %}{{ missing|int }}{% endfor %}',
+    u'{% for i in seq %}{{ name|wordcount }}{{ name|int }}{% endfor %}',
+    u'{% for i in seq %}{{ name|e }}{% endfor %}',
+    u'a{% set x = 1 %}b{{ x }}c',
+    u'a{% set x = foo %}b{{ x }}c',
+    u'{% for i in seq %}a{{ i }}b{% endfor %}c',
+    u'{% filter upper %}a{% set x = 2 %}b{{ x }}{% endfilter %}',
+    u'{% autoescape false %}{{ "<x>" }}{% endautoescape %}{{ "<x>" }}',
+    u'{% set _hoisted_1 = "taken" %}{% for i in seq %}{{ name|upper }}'
+    u'{{ _hoisted_1 }}{% endfor %}',
+    u'{% with x = 1 %}{{ x }}{% endwith %}{{ x }}',
+    u'{% call m2() %}{{ caller }}{% endcall %}',
+    u'{% macro m(x) %}<{{ x }}>{% endmacro %}{{ m(name) }}{{ m("<>") }}',
+    u'{% macro m(x, y=2) %}{{ x }}{{ y }}{% endmacro %}{{ m(1) }}{{ m(1, 3) }}'
+    u'{{ m() }}{{ m(1, y=4) }}{{ m(*seq) }}',
+    u'{% macro m(x, y) %}{{ x }}{{ y }}{% endmacro %}{{ m(seq, name) }}'
+    u'{% for name in seq %}{{ m(name, seq) }}{% endfor %}',
+    u'{% macro m(x) %}{% set y = x %}{{ y }}{% endmacro %}'
+    u'{% set y = 1 %}{{ m(2) }}{{ y }}',
+    u'{% macro m(x) %}{{ x }}{{ name }}{% endmacro %}{{ m(1) }}',
+    u'{% macro m(x) %}{{ caller() }}{% endmacro %}'
+    u'{% call m(1) %}c{% endcall %}',
+    u'{% macro m() %}{{ varargs }}{{ kwargs }}{% endmacro %}{{ m(1, a=2) }}',
+    u'{% macro m(x) %}{{ x }}{% endmacro %}{{ m(1)|upper }}{{ [m(2)] }}',
+    u'{% macro m(x) %}{{ x }}{% endmacro %}{% set m = "{}".format %}{{ m(1) }}',
+    u'{% if m is defined %}{{ m(1) }}{% endif %}'
+    u'{% macro m(x) %}{{ x }}{% endmacro %}{{ m(1) }}',
+    u'{% macro m(x) %}{% for i in x %}{{ i }}{% endfor %}{% endmacro %}'
+    u'{% filter upper %}a{{ m(name) }}b{% endfilter %}',
+    u'{% macro m(x) %}{{ x }}{% endmacro %}'
+    u'{% set v %}{{ m("<b>") }}{% endset %}{{ v }}',
+    u'{% macro m(x) %}{{ name }}{% set name = 1 %}{{ name }}{% endmacro %}'
+    u'{% for name in [5] %}{{ m(1) }}{% endfor %}',
+    u'{% macro m(x) %}{% for i in x %}{{ i }}{% else %}-{% endfor %}'
+    u'{% with y = x %}{{ y }}{% endwith %}{% endmacro %}'
+    u'{{ m(seq) }}{% for i in seq %}{{ m([i]) }}{% endfor %}',
+    u'{% for x in seq %}[{{ log|string }}]{{ x|record(log) }}{% endfor %}',
+    u'{% for x in seq %}[{{ log|string }}]{% if x is record(log) %}'
+    u'{% endif %}{% endfor %}',
+    u'{% for x in seq %}[{{ log|string }}]{% include "record" %}{% endfor %}',
+    u'{% for x in empty %}{{ bad|upper }}{% endfor %}done',
+    u'{% for x in seq %}{% if x > 5 %}{{ bad|upper }}{% endif %}'
+    u'{% endfor %}done',
+    u'{% for x in seq %}{% if x > 1 %}{{ name|upper }}{% endif %}'
+    u'{{ name|upper }}{% endfor %}',
+    u'{% for x in seq %}{{ name|e }}{% endfor %}{{ _hoisted_1 }}',
+    u'{% for x in seq recursive %}{{ name|upper }}{% endfor %}',
+    u'{% macro m(a) %}[{% include "inc" %}]{% endmacro %}'
+    u'{% for item in seq %}{{ m(1) }}{% endfor %}',
+    u'{% macro m(a) %}[{% from "inc_macro" import show with context %}'
+    u'{{ show() }}]{% endmacro %}{% for item in seq %}{{ m(1) }}{% endfor %}',
+]
+
+
+def optimized(env):
+    """Enables the optimizer passes besides the inlining of constants."""
+    for name in pass_names:
+        env.policies['optimizer.' + name] = name != 'inline_constants'
+    return env
+
+
+@pytest.fixture
+def env():
+    return optimized(Environment())
+
+
+class Unprintable(object):
+
+    def __str__(self):
+        raise ValueError('not printable')
+
+    __unicode__ = __str__
+
+
+def record(value, log):
+    log.append(value)
+    return u''
+
+
+def render_all(source, policies, **kwargs):
+    results = []
+    for autoescape in False, True:
+        env = Environment(autoescape=autoescape, loader=DictLoader({
+            'record': u'{{ x|record(log) }}',
+            'inc': u'{{ item }}|{{ a }}',
+            'inc_macro': u'{% macro show() %}{{ item }}|{{ a }}{% endmacro %}',
+        }), **kwargs)
+        env.policies.update(policies)
+        env.globals['m2'] = lambda caller=None: caller()
+        env.filters['record'] = env.tests['record'] = record
+        results.append(env.from_string(source).render(
+            foo=True, seq=[1, 2], name=u'<Jinja>', f=lambda: u'f',
+            log=[], empty=[], bad=Unprintable()))
+    return results
+
+
+@pytest.mark.optimizer
+class TestOptimizerPasses(object):
+
+    @pytest.mark.parametrize('source', corpus)
+    def test_equivalence(self, source):
+        disabled = dict(('optimizer.' + x, False) for x in pass_names)
+        expected = render_all(source, disabled)
+        for name in pass_names:
+            policies = dict(disabled)
+            policies['optimizer.' + name] = True
+            assert render_all(source, policies) == expected, name
+        enabled = dict(('optimizer.' + x, True) for x in pass_names)
+        assert render_all(source, enabled) == expected
+
+    def test_tree_not_modified(self, env):
+        source = u'{% set x = 1 %}{% if true %}a{% endif %}b'
+        tree = env.parse(source)
+        dump = repr(tree)
+        optimized = optimize_template(tree, env)
+        assert repr(tree) == dump
+        assert optimized is not tree
+
+    def test_nothing_to_do(self, env):
+        tree = env.parse(u'{{ foo }}{% for x in seq %}{{ x }}{% endfor %}')
+        assert optimize_template(tree, env) is tree
+
+    def test_dead_branches(self, env):
+        env.policies['optimizer.inline_constants'] = True
+        tree = optimize_template(env.parse(
+            u'{% set debug = false %}{% if debug %}a{% else %}b{% endif %}'
+            u'{% for x in [] %}{{ x }}{% endfor %}'), env)
+        assert not tree.find(nodes.If)
+        assert not tree.find(nodes.For)
+
+    def test_blocks_kept(self, env):
+        tree = optimize_template(env.parse(
+            u'{% if false %}{% block foo %}{% endblock %}{% endif %}'), env)
+        assert tree.find(nodes.If)
+
+    def test_merged_output(self, env):
+        env.policies['optimizer.inline_constants'] = True
+        tree = optimize_template(env.parse(
+            u'{{ foo }}{% set x = 1 %}a{% set y = 2 %}b{{ x }}'), env)
+        outputs = list(tree.find_all(nodes.Output))
+        assert len(outputs) == 2
+        assert [type(x) for x in outputs[0].nodes] == \
+            [nodes.Name, nodes.TemplateData]
+        assert [type(x) for x in outputs[1].nodes] == \
+            [nodes.TemplateData, nodes.Const]
+
+    def test_hoisted_filters(self, env):
+        tree = optimize_template(env.parse(
+            u'{% for i in seq %}{{ name|upper }}{{ name|upper }}'
+            u'{% endfor %}'), env)
+        assert isinstance(tree.body[0].target, nodes.InternalName)
+        assert tree.body[0].target.name == '_hoisted_1'
+        assert len(tree.body) == 2
+        # the filter is called when the name is used for the first time
+        loop_body = tree.body[1].body
+        assert len(loop_body) == 2
+        assert isinstance(loop_body[0], nodes.Assign)
+        assert len(list(tree.body[1].find_all(nodes.Filter))) == 1
+
+    def test_no_hoisting(self):
+        source = u'{% for i in seq %}{{ name|upper }}{% endfor %}'
+        env = optimized(Environment(undefined=StrictUndefined))
+        tree = optimize_template(env.parse(source), env)
+        assert isinstance(tree.body[0], nodes.For)
+        env = optimized(SandboxedEnvironment())
+        tree = optimize_template(env.parse(source), env)
+        assert isinstance(tree.body[0], nodes.For)
+        env = optimized(Environment())
+        env.filters['upper'] = lambda x: x
+        tree = optimize_template(env.parse(source), env)
+        assert isinstance(tree.body[0], nodes.For)
+        env = optimized(Environment())
+        for source in (u'{% for i in seq %}{{ name|upper }}{{ i|int }}'
+                       u'{% endfor %}',
+                       u'{% for i in seq %}{{ name|upper }}{{ i is odd }}'
+                       u'{% endfor %}',
+                       u'{% for i in seq %}{{ name|upper }}{% include "x" %}'
+                       u'{% endfor %}'):
+            tree = optimize_template(env.parse(source), env)
+            assert isinstance(tree.body[0], nodes.For), source
+
+    def test_strict_undefined_not_triggered(self):
+        env = optimized(Environment(undefined=StrictUndefined))
+        tmpl = env.from_string(u'{% for i in [] %}{{ missing|upper }}'
+                               u'{% endfor %}ok')
+        assert tmpl.render() == 'ok'
+
+    def test_policies(self, env):
+        source = u'{% set x = 1 %}{% if true %}{{ x }}{% endif %}'
+        env.policies['optimizer.dead_branches'] = False
+        tree = optimize_template(env.parse(source), env)
+        assert tree.find(nodes.If)
+        assert isinstance(tree.find(nodes.Output).nodes[0], nodes.Name)
+        env.policies['optimizer.inline_constants'] = True
+        tree = optimize_template(env.parse(source), env)
+        assert isinstance(tree.find(nodes.Output).nodes[0], nodes.Const)
+
+    def test_inlined_macros(self, env):
+        tree = optimize_template(env.parse(
+            u'{% macro m(x) %}[{{ x }}]{% endmacro %}a{{ m(1) }}b'), env)
+        assert [type(x) for x in tree.body] == \
+            [nodes.Macro, nodes.Output, nodes.With, nodes.Output]
+        assert tree.body[2].body == tree.body[0].body
+        tree = optimize_template(env.parse(
+            u'{% macro m(x) %}{% for i in x %}{{ i }}{% endfor %}'
+            u'{% endmacro %}{{ m(seq) }}'), env)
+        assert tree.find(nodes.With) is not None
+
+    def test_macros_not_inlined(self, env):
+        for source in (u'{% macro m(x) %}{{ m(x) }}{% endmacro %}{{ m(1) }}',
+                       u'{% macro m(x) %}{{ y }}{% endmacro %}{{ m(1) }}',
+                       u'{% if foo %}{% macro m(x) %}{% endmacro %}'
+                       u'{% endif %}{{ m(1) }}',
+                       u'{% macro m(x) %}{% endmacro %}'
+                       u'{% block b %}{{ m(1) }}{% endblock %}',
+                       u'{% macro m(x) %}{{ y }}{% set y = 1 %}{{ y }}'
+                       u'{% endmacro %}{{ m(1) }}',
+                       u'{% macro m(x) %}{% for i in x %}{% endfor %}{{ i }}'
+                       u'{% endmacro %}{{ m(1) }}'):
+            tree = optimize_template(env.parse(source), env)
+            assert tree.find(nodes.With) is None, source
+
+    def test_macro_inlining_with_finalize(self):
+        env = optimized(Environment(finalize=lambda x: u'[%s]' % x))
+        tmpl = env.from_string(u'{% macro m(x) %}{{ x }}{% endmacro %}'
+                               u'{{ m(1) }}')
+        assert tmpl.render() == '[[1]]'
+
+    def test_not_exported(self, env):
+        tmpl = env.from_string(u'{% set x = 1 %}{% for i in seq %}'
+                               u'{{ name|upper }}{% endfor %}')
+        module = tmpl.make_module({'seq': [1], 'name': 'foo'})
+        assert module.x == 1
+        assert not hasattr(module, '_hoisted_1')
+        context = tmpl.new_context({'seq': [1], 'name': 'foo'})
+        list(tmpl.root_render_func(context))
+        assert sorted(context.vars) == ['x']
+
+    @pytest.mark.parametrize('enabled', [True, False])
+    def test_inheritance(self, enabled):
+        env = Environment(loader=DictLoader({
+            'base': u'{% set title = "base" %}{% block body %}'
+                    u'{{ title }}{% endblock %}',
+            'child': u'{% extends "base" %}{% set title = "child" %}'
+                     u'{% block body %}[{{ title }}]{{ super() }}'
+                     u'{% endblock %}',
+        }))
+        for name in pass_names:
+            env.policies['optimizer.' + name] = enabled
+        assert env.get_template('child').render() == '[base]base'
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja2.testsuite.profiler
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests the render profiler.
+
+    :copyright: (c) 2017 by the Jinja Team.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import shutil
+import pstats
+import tempfile
+from io import StringIO
+
+import pytest
+
+from jinja2 import Environment, DictLoader
+from jinja2.profiler import RenderProfiler
+
+
+def make_env():
+    return Environment(loader=DictLoader({
+        'base.html': u'<title>{% block title %}{% endblock %}</title>\n'
+                     u'{% block body %}{% endblock %}\n',
+        'index.html': u'{% extends "base.html" %}\n'
+                      u'{% macro cell(x) %}<td>{{ x }}</td>{% endmacro %}\n'
+                      u'{% block title %}Index{% endblock %}\n'
+                      u'{% block body %}\n'
+                      u'{% for row in rows %}\n'
+                      u'{{ cell(row|slow) }}\n'
+                      u'{% endfor %}\n'
+                      u'{% endblock %}\n',
+    }))
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.profiler
+class TestRenderProfiler(object):
+
+    def render(self, profiler, clock, env):
+        def slow(value):
+            clock.now += 1.0
+            return value
+        env.filters['slow'] = slow
+        with profiler:
+            rv = env.get_template('index.html').render(rows=[1, 2, 3])
+        assert rv.count('<td>') == 3
+        return profiler
+
+    def test_lines(self):
+        env = make_env()
+        clock = Clock()
+        profiler = self.render(RenderProfiler(env, timer=clock), clock, env)
+        hits, exclusive, inclusive = \
+            profiler.lines[('index.html', 6, 'block "body"')]
+        assert hits >= 3
+        assert exclusive == inclusive == 3.0
+        calls, exclusive, inclusive = \
+            profiler.functions[('index.html', 4, 'block "body"')]
+        assert calls == 1
+        assert exclusive == inclusive == 3.0
+        assert profiler.functions[('base.html', 1,
+                                   'top-level template code')][2] == 3.0
+        assert profiler.functions[('index.html', 2, 'macro')][0] == 3
+        assert sys.gettrace() != profiler._trace_call
+
+    def test_frames_released(self):
+        env = make_env()
+        clock = Clock()
+        profiler = RenderProfiler(env, timer=clock)
+        env.filters['slow'] = lambda x: x
+        tmpl = env.get_template('index.html')
+        with profiler:
+            for x in range(2):
+                tmpl.render(rows=[1, 2, 3])
+            assert not profiler._frames
+        assert profiler.functions[('index.html', 4, 'block "body"')][0] == 2
+        assert profiler.functions[('index.html', 2, 'macro')][0] == 6
+        assert tmpl in profiler._linenos
+
+    def test_environment_filter(self):
+        env = make_env()
+        other = make_env()
+        with env.profile() as profiler:
+            other.get_template('base.html').render()
+        assert not profiler.lines
+        with env.profile() as profiler:
+            env.get_template('base.html').render()
+        assert ('base.html', 1, 'top-level template code') in profiler.lines
+
+    def test_pstats(self):
+        env = make_env()
+        clock = Clock()
+        profiler = self.render(RenderProfiler(env, timer=clock), clock, env)
+        stats = profiler.get_stats()
+        assert stats.total_tt == 3.0
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'render.prof')
+            profiler.dump_stats(filename)
+            stats = pstats.Stats(filename)
+            assert ('index.html', 6, 'block "body"') in stats.stats
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_flamegraph(self):
+        env = make_env()
+        clock = Clock()
+        profiler = self.render(RenderProfiler(env, timer=clock), clock, env)
+        fp = StringIO()
+        profiler.write_flamegraph(fp, unit=1.0)
+        stack, value = fp.getvalue().rsplit(None, 1)
+        assert value == u'3'
+        assert stack.split(u';')[-2:] == [
+            u'base.html:2 (top-level template code)',
+            u'index.html:6 (block "body")']
@@ -9,13 +9,14 @@
     :license: BSD, see LICENSE for more details.
 """
 import gc
+from collections import deque
 
 import pytest
 
 import pickle
 
 from jinja2.utils import LRUCache, escape, object_type_repr, urlize, \
-     select_autoescape
+     select_autoescape, DependencyGraph
 
 
 @pytest.mark.utils
@@ -42,7 +43,78 @@ class TestLRUCache(object):
             copy = pickle.loads(pickle.dumps(cache, protocol))
             assert copy.capacity == cache.capacity
             assert copy._mapping == cache._mapping
-            assert copy._queue == cache._queue
+            assert copy.keys() == cache.keys()
+
+    def test_unpickle_queue_state(self):
+        cache = LRUCache.__new__(LRUCache)
+        cache.__setstate__({
+            'capacity':     2,
+            '_mapping':     {'foo': 42, 'bar': 23},
+            '_queue':       deque(['bar', 'foo'])
+        })
+        assert cache.keys() == ['foo', 'bar']
+        cache['baz'] = 1
+        assert 'bar' not in cache
+
+    def test_recency_order(self):
+        cache = LRUCache(3)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+        cache['a']
+        assert cache.keys() == ['a', 'c', 'b']
+        assert list(reversed(cache)) == ['b', 'c', 'a']
+        assert cache.items() == [('a', 1), ('c', 3), ('b', 2)]
+        cache['b'] = 4
+        assert cache.keys() == ['b', 'a', 'c']
+        del cache['a']
+        assert cache.keys() == ['b', 'c']
+
+    def test_copy(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a']
+        copy = cache.copy()
+        assert copy.keys() == ['a', 'b']
+        copy['c'] = 3
+        assert 'b' not in copy
+        assert 'b' in cache
+
+    def test_setdefault(self):
+        cache = LRUCache(2)
+        assert cache.setdefault('a', 1) == 1
+        assert cache.setdefault('a', 2) == 1
+
+
+@pytest.mark.utils
+@pytest.mark.dependencies
+class TestDependencyGraph(object):
+
+    def test_transitive_dependents(self):
+        graph = DependencyGraph()
+        graph.set_dependencies('page', ['layout'])
+        graph.set_dependencies('child', ['page', 'macros'])
+        assert graph.get_dependents('layout') == set(['page', 'child'])
+        assert graph.get_dependents('layout', transitive=False) == \
+            set(['page'])
+        assert graph.get_dependencies('child') == set(['page', 'macros'])
+
+    def test_replace_and_remove(self):
+        graph = DependencyGraph()
+        graph.set_dependencies('page', ['layout'])
+        graph.set_dependencies('page', ['other'])
+        assert graph.get_dependents('layout') == set()
+        assert graph.get_dependents('other') == set(['page'])
+        graph.remove('page')
+        assert 'page' not in graph
+        assert graph.get_dependents('other') == set()
+
+    def test_cycles(self):
+        graph = DependencyGraph()
+        graph.set_dependencies('a', ['b'])
+        graph.set_dependencies('b', ['a'])
+        assert graph.get_dependents('a') == set(['b'])
 
 
 @pytest.mark.utils
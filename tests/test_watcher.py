@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja2.testsuite.watcher
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests the inotify based template watcher.
+
+    :copyright: (c) 2017 by the Jinja Team.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from jinja2 import Environment, FileSystemLoader
+
+
+try:
+    from jinja2.watcher import _get_libc
+    _get_libc()
+except (RuntimeError, OSError):
+    have_inotify = False
+else:
+    have_inotify = True
+
+
+@pytest.fixture
+def searchpath(request):
+    path = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(path))
+    with open(os.path.join(path, 'index.html'), 'w') as f:
+        f.write('{% include "sub/part.html" %}')
+    os.mkdir(os.path.join(path, 'sub'))
+    with open(os.path.join(path, 'sub', 'part.html'), 'w') as f:
+        f.write('one')
+    return path
+
+
+@pytest.mark.watcher
+@pytest.mark.skipif(not have_inotify, reason='inotify not available')
+class TestInotifyWatcher(object):
+
+    def test_invalidates_changed_templates(self, searchpath):
+        from jinja2.watcher import InotifyWatcher
+        env = Environment(loader=FileSystemLoader(searchpath),
+                          auto_reload=False)
+        with InotifyWatcher(env) as watcher:
+            assert env.get_template('index.html').render() == 'one'
+            assert watcher.poll() == 0
+            with open(os.path.join(searchpath, 'sub', 'part.html'),
+                      'w') as f:
+                f.write('two')
+            # the including template is invalidated as well
+            assert watcher.poll() == 2
+            assert not env.cache
+            assert env.get_template('index.html').render() == 'two'
+
+    def test_watches_new_folders(self, searchpath):
+        from jinja2.watcher import InotifyWatcher
+        env = Environment(loader=FileSystemLoader(searchpath),
+                          auto_reload=False)
+        with InotifyWatcher(env) as watcher:
+            os.mkdir(os.path.join(searchpath, 'new'))
+            watcher.poll()
+            with open(os.path.join(searchpath, 'new', 'a.html'), 'w') as f:
+                f.write('a')
+            assert env.get_template('new/a.html').render() == 'a'
+            os.remove(os.path.join(searchpath, 'new', 'a.html'))
+            assert watcher.poll() == 1
+            assert not env.cache
+
+    def test_requires_paths(self):
+        from jinja2.watcher import InotifyWatcher
+        pytest.raises(TypeError, InotifyWatcher, Environment())